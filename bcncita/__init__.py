@@ -1 +1,52 @@
-from .cita import *  # noqa
+from importlib import import_module
+
+from .profile import CustomerProfile, DocType, Engine, Office, OperationType, Province
+
+# The engine pulls in selenium, requests and anticaptcha, it is only imported when used
+_LAZY = {
+    "aio": ["async_run_profiles", "async_start_with"],
+    "checkpoint": ["Checkpoint", "CheckpointStore"],
+    "cita": ["init_wedriver", "start_with", "try_cita"],
+    "history": ["ObservationStore", "PollingSchedule", "polling_schedule", "release_times"],
+    "monitor": ["Monitor", "Observation", "ProbeStatus", "probe"],
+    "ocr": ["TesseractOcr", "new_ocr"],
+    "routes": ["ROUTES", "Route", "parse_citar", "refresh_routes", "route_urls"],
+    "scheduler": ["run_profiles"],
+    "sessions": ["BrowserPool", "is_poisoned"],
+    "sms": [
+        "Inbox",
+        "PushReceiver",
+        "SmsProvider",
+        "WebhookSiteProvider",
+        "clear_inbox",
+        "get_sms_provider",
+    ],
+    "workqueue": ["QueueBackend", "RedisQueue", "SQLiteQueue", "enqueue", "run_worker"],
+}
+_MODULES = {name: module for module, names in _LAZY.items() for name in names}
+
+# What a star import has always given, the engine is loaded for it through __getattr__.
+# The other lazy names are only imported when asked for by name.
+__all__ = [
+    "try_cita",
+    "start_with",
+    "init_wedriver",
+    "CustomerProfile",
+    "DocType",
+    "Engine",
+    "OperationType",
+    "Office",
+    "Province",
+]
+
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(f".{_MODULES[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_MODULES))
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from dataclasses import replace
+from typing import List, Optional, Tuple
+
+from selenium import webdriver
+
+from .captcha import presolving
+from .checkpoint import end_run, is_booked, resume
+from .cita import CYCLES, CustomerProfile, fast_forward_urls, init_wedriver, run_attempt, speaker
+from .sessions import BrowserPool
+from .sms import clear_inbox
+
+__all__ = ["async_run_profiles", "async_start_with"]
+
+
+async def async_run_attempt(
+    driver: webdriver, context: CustomerProfile, urls, ends: Optional[float] = None
+):
+    # Selenium is synchronous, the attempt runs in a worker thread while the loop keeps the
+    # time.monotonic() deadline. Returns (result, interrupted), interrupting closes the driver.
+    attempt = asyncio.ensure_future(asyncio.to_thread(run_attempt, driver, context, *urls))
+    timeout = None if ends is None else max(ends - time.monotonic(), 0)
+    try:
+        done, _ = await asyncio.wait({attempt}, timeout=timeout)
+    except asyncio.CancelledError:
+        await interrupt(driver, attempt)
+        raise
+
+    if not done:
+        logging.error(f"[{context.name}] Deadline reached")
+        await interrupt(driver, attempt)
+        return None, True
+    return attempt.result(), False
+
+
+async def interrupt(driver: webdriver, attempt: asyncio.Future):
+    # A thread can't be cancelled, closing the browser makes its pending command fail fast
+    try:
+        await asyncio.to_thread(driver.quit)
+    except Exception as e:
+        logging.error(e)
+    await asyncio.wait({attempt})
+
+
+async def async_start_with(
+    driver: webdriver,
+    context: CustomerProfile,
+    cycles: int = CYCLES,
+    deadline: Optional[float] = None,
+    quit_on_fail: bool = True,
+):
+    # deadline is in seconds from now, the attempt in flight when it passes is interrupted
+    ends = None if deadline is None else time.monotonic() + deadline
+    if await asyncio.to_thread(is_booked, context):
+        if quit_on_fail:
+            await asyncio.to_thread(driver.quit)
+        return True
+    await asyncio.to_thread(clear_inbox, context)
+
+    urls = fast_forward_urls(context)
+    success = False
+    with presolving([context]):
+        for i in range(await asyncio.to_thread(resume, context, driver), cycles):
+            logging.info(f"\033[33m[{context.name}] [Attempt {i + 1}/{cycles}]\033[0m")
+            result, interrupted = await async_run_attempt(driver, context, urls, ends)
+            if result:
+                success = True
+                logging.info(f"[{context.name}] WIN")
+                break
+            if interrupted:
+                return False
+
+    if not success:
+        logging.error(f"[{context.name}] FAIL")
+        speaker.say("FAIL")
+        await asyncio.to_thread(end_run, context)
+        if quit_on_fail:
+            await asyncio.to_thread(driver.quit)
+
+    return success
+
+
+async def async_run_profiles(
+    profiles: List[CustomerProfile],
+    pool_size: int = 4,
+    cycles: int = CYCLES,
+    deadline: Optional[float] = None,
+    pool: Optional[BrowserPool] = None,
+) -> List[Tuple[CustomerProfile, webdriver.Chrome]]:
+    # Every profile is a task on one loop, browsers are borrowed per attempt so waiting
+    # profiles don't hold one. deadline is in seconds from now and applies to each profile.
+    # A booking comes back with its browser, which is the caller's to quit.
+    if not profiles:
+        return []
+
+    logging.basicConfig(
+        format="%(asctime)s - %(message)s", level=logging.INFO, **profiles[0].log_settings  # type: ignore
+    )
+
+    own_pool = pool is None
+    if pool is None:
+        template = replace(profiles[0], chrome_profile_path=None, chrome_profile_name=None)
+        pool = BrowserPool(lambda: init_wedriver(template), pool_size)
+    browsers = asyncio.Semaphore(pool.size)
+    ends = None if deadline is None else time.monotonic() + deadline
+
+    async def run(context: CustomerProfile):
+        if await asyncio.to_thread(is_booked, context):
+            return None
+        context.exit_on_success = False
+        await asyncio.to_thread(clear_inbox, context)
+        urls = fast_forward_urls(context)
+
+        for i in range(await asyncio.to_thread(resume, context), cycles):
+            if ends is not None and time.monotonic() >= ends:
+                logging.error(f"[{context.name}] Deadline reached")
+                break
+
+            async with browsers:
+                try:
+                    driver = await asyncio.to_thread(pool.acquire, context)
+                except Exception as e:
+                    logging.error(f"SMTH BROKEN: {e}")
+                    continue
+                logging.info(f"\033[33m[{context.name}] [Attempt {i + 1}/{cycles}]\033[0m")
+                try:
+                    result, interrupted = await async_run_attempt(driver, context, urls, ends)
+                except asyncio.CancelledError:
+                    # async_run_attempt has quit the browser already, only the slot is left
+                    pool.discard(driver, quit=False)
+                    raise
+
+                if interrupted:
+                    pool.discard(driver, quit=False)
+                    break
+                if result:
+                    # Out of the pool and left open on the confirmation for the caller
+                    pool.discard(driver, quit=False)
+                    logging.info(f"[{context.name}] WIN")
+                    return context, driver
+                await asyncio.to_thread(pool.release, driver)
+
+        logging.error(f"[{context.name}] FAIL")
+        await asyncio.to_thread(end_run, context)
+        return None
+
+    try:
+        with presolving(profiles):
+            results = await asyncio.gather(*(run(context) for context in profiles))
+    finally:
+        if own_pool:
+            await asyncio.to_thread(pool.close)
+
+    return [booked for booked in results if booked is not None]
@@ -0,0 +1,493 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, replace
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+
+from .cita import (
+    DELAY,
+    REFRESH_INTERVAL,
+    REFRESH_PAGE_CYCLES,
+    USER_AGENT,
+    CustomerProfile,
+    OperationType,
+    cita_selection,
+    form_spec,
+    request_cita,
+    wait_exact_time,
+)
+from .history import record
+from .metrics import Outcome, tracer
+from .offices import mark_empty, rank_offices
+from .throttle import is_throttled, pace, report
+
+__all__ = ["cycle_cita_http", "new_http_session"]
+
+CAPTCHA_MARKERS = ["reCAPTCHA_site_key", "img-thumbnail", "g-recaptcha"]
+# Any same-origin document will do to replay a form from, as long as lean mode doesn't block it
+HANDOVER_PATH = "/robots.txt"
+SLOT_MARKERS = ["DISPONE DE 5 MINUTOS", "Seleccione una de las siguientes citas disponibles"]
+
+
+@dataclass
+class Form:
+    action: str = ""
+    method: str = "get"
+    fields: Dict[str, str] = field(default_factory=dict)
+    ids: Dict[str, str] = field(default_factory=dict)  # element id -> field name
+    options: Dict[str, List[Tuple[str, str]]] = field(default_factory=dict)  # (value, text)
+    radios: Dict[str, Tuple[str, str]] = field(default_factory=dict)  # id -> (name, value)
+
+
+class PageParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.forms: List[Form] = []
+        self.text: List[str] = []
+        self._select: Optional[str] = None
+        self._option: Optional[str] = None
+        self._option_text: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {k: v or "" for k, v in attrs}
+        if tag in ("script", "style"):
+            self._skip += 1
+        elif tag == "form":
+            self.forms.append(Form(attrs.get("action", ""), attrs.get("method", "get").lower()))
+            return
+
+        if tag not in ("input", "select", "textarea", "option"):
+            return
+        if not self.forms:
+            self.forms.append(Form())
+        form = self.forms[-1]
+
+        name = attrs.get("name", "")
+        if tag == "option":
+            self._option = attrs.get("value", "")
+            self._option_text = []
+            if "selected" in attrs and self._select:
+                form.fields[self._select] = self._option
+            return
+        if not name:
+            return
+        if attrs.get("id"):
+            form.ids[attrs["id"]] = name
+
+        if tag == "select":
+            self._select = name
+            form.options[name] = []
+            form.fields.setdefault(name, "")
+        elif tag == "textarea":
+            form.fields[name] = ""
+        elif attrs.get("type", "text").lower() == "radio":
+            form.radios[attrs.get("id", name)] = (name, attrs.get("value", "on"))
+            if "checked" in attrs:
+                form.fields[name] = attrs.get("value", "on")
+        elif attrs.get("type", "text").lower() == "checkbox":
+            if "checked" in attrs:
+                form.fields[name] = attrs.get("value", "on")
+        elif attrs.get("type", "text").lower() not in ("button", "submit", "image", "reset"):
+            form.fields[name] = attrs.get("value", "")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style"):
+            self._skip = max(self._skip - 1, 0)
+        elif tag == "option" and self._option is not None and self._select:
+            text = " ".join("".join(self._option_text).split())
+            self.forms[-1].options[self._select].append((self._option, text))
+            self._option = None
+        elif tag == "select":
+            self._select = None
+
+    def handle_data(self, data):
+        if self._option is not None:
+            self._option_text.append(data)
+        if not self._skip:
+            self.text.append(data)
+
+
+@dataclass
+class Page:
+    url: str
+    html: str
+    forms: List[Form]
+    text: str
+
+    @classmethod
+    def parse(cls, url: str, html: str):
+        parser = PageParser()
+        parser.feed(html)
+        parser.close()
+        return cls(url, html, parser.forms, " ".join(" ".join(parser.text).split()))
+
+    def form_with(self, element_id: str) -> Optional[Form]:
+        for form in self.forms:
+            if element_id in form.ids or element_id in form.radios:
+                return form
+        return self.forms[0] if self.forms else None
+
+    def has_captcha(self):
+        return any(marker in self.html for marker in CAPTCHA_MARKERS)
+
+
+@dataclass
+class Submission:
+    url: str
+    fields: Dict[str, str]
+
+
+def new_http_session(pool_size: int = 4):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"User-Agent": USER_AGENT})
+    return session
+
+
+def get(session: requests.Session, url: str) -> Page:
+    pace(url)
+    resp = session.get(url, timeout=DELAY)
+    if is_throttled(resp.text, resp.status_code):
+        report(False, url)
+    return Page.parse(resp.url, resp.text)
+
+
+def post(session: requests.Session, submission: Submission) -> Page:
+    pace(submission.url)
+    resp = session.post(submission.url, data=submission.fields, timeout=DELAY)
+    if is_throttled(resp.text, resp.status_code):
+        report(False, submission.url)
+    return Page.parse(resp.url, resp.text)
+
+
+def build_submission(page: Page, element_id: str, action: str, values: Dict[str, str]):
+    form = page.form_with(element_id)
+    if form is None:
+        return None
+
+    fields = dict(form.fields)
+    for key, value in values.items():
+        if key in form.radios:
+            name, radio_value = form.radios[key]
+            fields[name] = radio_value
+        elif key in form.ids:
+            fields[form.ids[key]] = value
+
+    return Submission(urljoin(page.url, action or form.action), fields)
+
+
+def option_value(form: Form, element_id: str, text: str):
+    for value, option_text in form.options.get(form.ids.get(element_id, ""), []):
+        if option_text == text:
+            return value
+    return None
+
+
+def personal_info_values(page: Page, context: CustomerProfile):
+    form = page.form_with("txtIdCitado")
+    spec = form_spec(context).values(context)
+    values = dict(spec["inputs"])
+    if spec["radio"]:
+        values[spec["radio"]] = "on"
+
+    for element_id, text in spec["selects"]:
+        if form and element_id in form.ids:
+            value = option_value(form, element_id, text)
+            if value is None:
+                logging.error(f"{text} not found in {element_id}")
+                return None
+            values[element_id] = value
+
+    return values
+
+
+def offered_offices(page: Page) -> List[str]:
+    form = page.form_with("idSede")
+    if form is None:
+        return []
+    return [v for v, _ in form.options.get(form.ids.get("idSede", ""), []) if v]
+
+
+def pick_office(page: Page, context: CustomerProfile, rank: int = 0):
+    ranked = rank_offices(context, offered_offices(page))
+    return ranked[rank] if rank < len(ranked) else None
+
+
+def copy_cookies(driver: webdriver, session: requests.Session):
+    for cookie in session.cookies:
+        driver.execute_cdp_cmd(
+            "Network.setCookie",
+            {
+                "name": cookie.name,
+                "value": cookie.value,
+                "domain": cookie.domain,
+                "path": cookie.path or "/",
+                "secure": bool(cookie.secure),
+            },
+        )
+
+
+def handover(driver: webdriver, session: requests.Session, submission: Submission):
+    copy_cookies(driver, session)
+    parts = urlsplit(submission.url)
+    driver.get(f"{parts.scheme}://{parts.netloc}{HANDOVER_PATH}")
+    driver.execute_script(
+        """
+        const form = document.createElement('form');
+        form.method = 'post';
+        form.action = arguments[0];
+        for (const [name, value] of Object.entries(arguments[1])) {
+            const input = document.createElement('input');
+            input.type = 'hidden';
+            input.name = name;
+            input.value = value;
+            form.appendChild(input);
+        }
+        document.body.appendChild(form);
+        form.submit();
+        """,
+        submission.url,
+        submission.fields,
+    )
+
+
+def handover_page(driver: webdriver, session: requests.Session, page: Page):
+    # The page was already fetched over HTTP, show it in Chrome without posting again
+    copy_cookies(driver, session)
+    parts = urlsplit(page.url)
+    driver.get(f"{parts.scheme}://{parts.netloc}{HANDOVER_PATH}")
+    base = f'<base href="{page.url}">'
+    html = (
+        page.html.replace("<head>", f"<head>{base}", 1)
+        if "<head>" in page.html
+        else base + page.html
+    )
+    driver.execute_script("document.open(); document.write(arguments[0]); document.close();", html)
+
+
+def walk_forms(context: CustomerProfile, fast_forward_url, fast_forward_url2):
+    # Returns (step, submission) to be replayed in Chrome, or None to end the attempt
+    if context.http_session is None:
+        context.http_session = new_http_session()
+    session = context.http_session
+
+    get(session, fast_forward_url)
+    page = get(session, fast_forward_url2)
+    if "INTERNET CITA PREVIA" not in page.text:
+        # get() has reported it already if the site was throttling
+        session.cookies.clear()
+        raise TimeoutException
+    report(True, fast_forward_url2)
+
+    # 1. Instructions page:
+    submission = build_submission(page, "btnEntrar", "acEntrada", {})
+    if submission is None:
+        logging.error("Instructions form not found")
+        return None
+    page = post(session, submission)
+
+    # 2. Personal info:
+    logging.info("[Step 1/6] Personal info")
+    if page.has_captcha():
+        return "personal", submission
+
+    values = personal_info_values(page, context)
+    if values is None:
+        return None
+    submission = build_submission(page, "txtIdCitado", "acValidarEntrada", values)
+    if submission is None:
+        logging.error("Personal info form not found")
+        return None
+    page = post(session, submission)
+
+    # 3. Solicitar cita:
+    submission = build_submission(page, "btnConsultar", "acCitar", {})
+    if submission is None:
+        logging.error("Solicitar form not found")
+        return None
+    return "solicitar", submission
+
+
+def request_office(
+    session: requests.Session,
+    context: CustomerProfile,
+    submission,
+    rank: int = 0,
+    cancelled: Optional[threading.Event] = None,
+):
+    # rank picks the office among the ranked ones, each fan-out branch takes its own
+    for i in range(REFRESH_PAGE_CYCLES):
+        if cancelled and cancelled.is_set():
+            return None
+        page = post(session, submission)
+
+        if "Seleccione la oficina donde solicitar la cita" in page.text:
+            logging.info("[Step 2/6] Office selection")
+            office = pick_office(page, context, rank)
+            if office is None:
+                # The attempt ends here, otherwise the slot page is recorded instead
+                record(context, shown=True)
+                return None
+            context.selected_office = office
+            office_submission = build_submission(
+                page, "idSede", "acVerFormulario", {"idSede": office}
+            )
+            if office_submission is None:
+                logging.error("Office form not found")
+                return None
+            page = post(session, office_submission)
+            break
+        elif "En este momento no hay citas disponibles" in page.text:
+            record(context, shown=False)
+            if cancelled is None:
+                time.sleep(REFRESH_INTERVAL)
+            elif cancelled.wait(REFRESH_INTERVAL):
+                return None
+            continue
+        else:
+            logging.info("[Step 2/6] Office selection -> No offices")
+            tracer.outcome(Outcome.NO_OFFICES)
+            return None
+    else:
+        tracer.outcome(Outcome.NO_CITAS)
+        return None
+
+    # 4. Contact info:
+    if "txtTelefonoCitado" not in page.html:
+        logging.error("Contact info page not found")
+        return None
+    logging.info("[Step 3/6] Contact info")
+    values = {"txtTelefonoCitado": context.phone, "emailUNO": context.email}
+    values["emailDOS"] = context.email
+    if context.operation_code == OperationType.SOLICITUD_ASILO:
+        values["txtObservaciones"] = context.reason_or_type
+    return build_submission(page, "txtTelefonoCitado", "acOfertarCita", values)
+
+
+def fan_out_branch(
+    context: CustomerProfile, rank: int, urls, cancelled: threading.Event, submission=None
+) -> Optional[Page]:
+    # Goes up to the slot page with the office of the given rank, walking a fresh session
+    # from the start unless it already has the Solicitar form
+    if submission is None:
+        walked = walk_forms(context, *urls)
+        if walked is None or walked[0] != "solicitar" or cancelled.is_set():
+            return None
+        submission = walked[1]
+
+    submission = request_office(context.http_session, context, submission, rank, cancelled)
+    if submission is None or cancelled.is_set():
+        return None
+
+    page = post(context.http_session, submission)
+    if any(marker in page.text for marker in SLOT_MARKERS):
+        return page
+    if "En este momento no hay citas disponibles" in page.text:
+        mark_empty(context, context.selected_office)
+        record(context, shown=True, slots=0, office=context.selected_office or "")
+    logging.info(f"[HTTP] Office {context.selected_office} -> no citas")
+    return None
+
+
+def fan_out(context: CustomerProfile, submission: Submission, urls):
+    # Returns the branch that reached the slot page first together with that page.
+    # The first branch carries on with the profile's session, the others start new ones
+    width = context.office_fanout
+    branches = [replace(context, selected_office=None)]
+    branches += [
+        replace(context, http_session=new_http_session(), selected_office=None)
+        for _ in range(1, width)
+    ]
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(width, thread_name_prefix="office")
+    futures = {
+        executor.submit(
+            fan_out_branch, branch, rank, urls, cancelled, None if rank else submission
+        ): branch
+        for rank, branch in enumerate(branches)
+    }
+
+    winner, timeouts = None, 0
+    try:
+        for future in as_completed(futures):
+            try:
+                page = future.result()
+            except TimeoutException:
+                timeouts += 1
+                continue
+            except Exception as e:
+                logging.error(f"[HTTP] Office branch failed: {e}")
+                continue
+            if page is not None:
+                winner = futures[future], page
+                break
+    finally:
+        # Release the other sessions, whatever they hold is dropped with them. A branch may
+        # still be inside a request, so its session is closed once its future is done.
+        cancelled.set()
+        for future, branch in futures.items():
+            if branch is not branches[0] and (winner is None or branch is not winner[0]):
+                future.add_done_callback(lambda _, session=branch.http_session: session.close())
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if winner is None and timeouts == width:
+        raise TimeoutException
+    return winner
+
+
+def cycle_cita_http(
+    driver: webdriver, context: CustomerProfile, fast_forward_url, fast_forward_url2
+):
+    with tracer.step("http_forms"):
+        walked = walk_forms(context, fast_forward_url, fast_forward_url2)
+    if walked is None:
+        return None
+
+    step, submission = walked
+    if step == "personal":
+        # Captcha on the personal info form, Chrome takes it from here
+        logging.info("[HTTP] Captcha on personal info, handing over to Chrome")
+        with tracer.step("handover"):
+            handover(driver, context.http_session, submission)
+        return request_cita(driver, context)
+
+    try:
+        wait_exact_time(driver, context)
+    except TimeoutException:
+        logging.error("Timed out waiting for exact time")
+        return None
+
+    if context.office_fanout > 1:
+        with tracer.step("office_selection"):
+            winner = fan_out(context, submission, (fast_forward_url, fast_forward_url2))
+        if winner is None:
+            tracer.outcome(Outcome.NO_CITAS)
+            return None
+
+        branch, page = winner
+        context.selected_office = branch.selected_office
+        logging.info(f"[HTTP] Office {branch.selected_office} first, handing over to Chrome")
+        with tracer.step("handover"):
+            handover_page(driver, branch.http_session, page)
+        return cita_selection(driver, context)
+
+    with tracer.step("office_selection"):
+        submission = request_office(context.http_session, context, submission)
+    if submission is None:
+        return None
+
+    logging.info("[HTTP] Handing over to Chrome for slot selection")
+    with tracer.step("handover"):
+        handover(driver, context.http_session, submission)
+    return cita_selection(driver, context)
@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from anticaptchaofficial.imagecaptcha import imagecaptcha
+from anticaptchaofficial.recaptchav3proxyless import recaptchaV3Proxyless
+
+from .profile import ICP_URL
+
+__all__ = ["TokenCache", "RecaptchaPresolver", "get_presolver", "presolving"]
+
+TOKEN_TTL = 120  # reCAPTCHA v3 tokens are valid for 2 minutes
+TOKEN_MARGIN = 20  # drop them a bit earlier to leave time for the form to be sent
+
+
+class TokenCache:
+    def __init__(self, ttl: float = TOKEN_TTL - TOKEN_MARGIN):
+        self.ttl = ttl
+        self._tokens: Deque[Tuple[str, float]] = deque()
+
+    def _purge(self):
+        now = time.monotonic()
+        while self._tokens and now - self._tokens[0][1] >= self.ttl:
+            self._tokens.popleft()
+
+    def __len__(self):
+        self._purge()
+        return len(self._tokens)
+
+    def put(self, token: str, issued_at: float):
+        self._tokens.append((token, issued_at))
+
+    def pop(self) -> Optional[str]:
+        # Oldest first, so fewer tokens expire unused
+        self._purge()
+        return self._tokens.popleft()[0] if self._tokens else None
+
+    def seconds_to_expiry(self) -> Optional[float]:
+        self._purge()
+        if not self._tokens:
+            return None
+        return self.ttl - (time.monotonic() - self._tokens[0][1])
+
+
+class RecaptchaPresolver:
+    def __init__(
+        self,
+        solve: Callable[[], Optional[str]],
+        size: int = 1,
+        workers: int = 1,
+        ttl: float = TOKEN_TTL - TOKEN_MARGIN,
+        retry_delay: float = 10,
+    ):
+        self.solve = solve
+        self.size = size
+        self.retry_delay = retry_delay
+        self.cache = TokenCache(ttl)
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = [
+            threading.Thread(target=self._run, daemon=True) for _ in range(workers)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def take(self) -> Optional[str]:
+        with self._cond:
+            token = self.cache.pop()
+            self._cond.notify_all()
+        return token
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._cond:
+                while (
+                    not self._stopped.is_set() and len(self.cache) + self._in_flight >= self.size
+                ):
+                    self._cond.wait(timeout=self.cache.seconds_to_expiry())
+                if self._stopped.is_set():
+                    return
+                self._in_flight += 1
+
+            # The token's clock starts when the task is sent, not when it comes back
+            issued_at = time.monotonic()
+            try:
+                token = self.solve()
+            except Exception as e:
+                logging.error(f"Anticaptcha: presolve failed: {e}")
+                token = None
+
+            with self._cond:
+                self._in_flight -= 1
+                if token:
+                    self.cache.put(token, issued_at)
+                self._cond.notify_all()
+
+            if not token:
+                self._stopped.wait(self.retry_delay)
+
+
+def new_recaptcha_solver(api_key: str, site_key: str, page_action: str):
+    solver = recaptchaV3Proxyless()
+    solver.set_verbose(1)
+    solver.set_key(api_key)
+    solver.set_website_url(ICP_URL)
+    solver.set_website_key(site_key)
+    solver.set_page_action(page_action)
+    solver.set_min_score(0.9)
+    return solver
+
+
+def solve_image_body(solver: imagecaptcha, body: str):
+    # Same task as solve_and_return_solution, from the base64 text instead of a file
+    task = {
+        "type": "ImageToTextTask",
+        "body": body,
+        "phrase": solver.phrase,
+        "case": solver.case,
+        "numeric": solver.numeric,
+        "math": solver.math,
+        "minLength": solver.minLength,
+        "maxLength": solver.maxLength,
+        "comment": solver.comment,
+    }
+    if solver.create_task({"clientKey": solver.client_key, "task": task}) != 1:
+        return 0
+    result = solver.wait_for_result(60)
+    return 0 if result == 0 else result["solution"]["text"]
+
+
+def anticaptcha_recaptcha(api_key: str, site_key: str, page_action: str):
+    def solve():
+        # One solver per call, the official client is not thread safe
+        solver = new_recaptcha_solver(api_key, site_key, page_action)
+        return solver.solve_and_return_solution() or None
+
+    return solve
+
+
+_presolvers: Dict[Tuple[str, str, str], RecaptchaPresolver] = {}
+_presolvers_lock = threading.Lock()
+_runs = 0  # runs using the presolvers, the last one to finish stops them
+
+
+def get_presolver(api_key: str, site_key: str, page_action: str, size: int = 1):
+    # Shared by every profile of the process hitting the same site key and action
+    key = (api_key, site_key, page_action)
+    with _presolvers_lock:
+        if key not in _presolvers:
+            logging.info(f"Anticaptcha: presolving {size} token(s) for action {page_action}")
+            solve = anticaptcha_recaptcha(api_key, site_key, page_action)
+            _presolvers[key] = RecaptchaPresolver(solve, size=size, workers=size).start()
+        return _presolvers[key]
+
+
+def start_presolver(context):
+    # With the site key and action in the profile, tokens are ready for the first slot page
+    if context.presolve_captcha and context.anticaptcha_api_key:
+        if context.recaptcha_site_key and context.recaptcha_action:
+            get_presolver(
+                context.anticaptcha_api_key,
+                context.recaptcha_site_key,
+                context.recaptcha_action,
+                context.presolve_captcha,
+            )
+
+
+def stop_presolvers():
+    with _presolvers_lock:
+        presolvers = list(_presolvers.values())
+        _presolvers.clear()
+    for presolver in presolvers:
+        presolver.stop()
+
+
+@contextmanager
+def presolving(profiles: list):
+    global _runs
+    with _presolvers_lock:
+        _runs += 1
+    try:
+        for context in profiles:
+            start_presolver(context)
+        yield
+    finally:
+        with _presolvers_lock:
+            _runs -= 1
+            last = _runs == 0
+        if last:
+            # Every unused token is paid for, stop buying once nobody is booking
+            stop_presolvers()
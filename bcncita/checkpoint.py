@@ -0,0 +1,209 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from .profile import Engine
+
+__all__ = ["Checkpoint", "CheckpointStore"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    profile TEXT PRIMARY KEY,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_step TEXT NOT NULL DEFAULT '',
+    outcome TEXT NOT NULL DEFAULT '',
+    failed_loads INTEGER NOT NULL DEFAULT 0,
+    cookies TEXT NOT NULL DEFAULT '[]',
+    booked INTEGER NOT NULL DEFAULT 0,
+    justificante TEXT NOT NULL DEFAULT '',
+    updated REAL NOT NULL DEFAULT 0
+);
+"""
+COOKIE_TTL = 20 * 60  # older sessions have expired on the server, start cold
+
+
+@dataclass
+class Checkpoint:
+    profile: str
+    attempts: int = 0  # in the current run of cycles, reset when it ends without a cita
+    last_step: str = ""
+    outcome: str = ""
+    failed_loads: int = 0
+    cookies: List[dict] = field(default_factory=list)
+    booked: bool = False
+    justificante: str = ""
+    updated: float = 0
+
+
+class CheckpointStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def get(self, profile: str) -> Checkpoint:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT profile, attempts, last_step, outcome, failed_loads, cookies, booked, "
+                "justificante, updated FROM checkpoints WHERE profile = ?",
+                (profile,),
+            ).fetchone()
+        if row is None:
+            return Checkpoint(profile)
+        *head, cookies, booked, justificante, updated = row
+        return Checkpoint(*head, json.loads(cookies), bool(booked), justificante, updated)
+
+    def save(self, checkpoint: Checkpoint):
+        checkpoint.updated = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO checkpoints (profile, attempts, last_step, outcome, "
+                "failed_loads, cookies, booked, justificante, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    checkpoint.profile,
+                    checkpoint.attempts,
+                    checkpoint.last_step,
+                    checkpoint.outcome,
+                    checkpoint.failed_loads,
+                    json.dumps(checkpoint.cookies),
+                    int(checkpoint.booked),
+                    checkpoint.justificante,
+                    checkpoint.updated,
+                ),
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_stores: Dict[str, CheckpointStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path: str) -> CheckpointStore:
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = CheckpointStore(path)
+        return _stores[path]
+
+
+def profile_key(context) -> str:
+    return f"{context.province.name}/{context.operation_code.name}/{context.doc_value}"
+
+
+def load(context) -> Optional[Checkpoint]:
+    if not context.checkpoint_path:
+        return None
+    try:
+        return get_store(context.checkpoint_path).get(profile_key(context))
+    except (sqlite3.Error, ValueError) as e:
+        logging.error(f"Unable to read checkpoint: {e}")
+        return None
+
+
+def store(checkpoint: Checkpoint, context):
+    # Called from the booking flow, a broken store must never cost an attempt
+    try:
+        get_store(context.checkpoint_path).save(checkpoint)
+    except sqlite3.Error as e:
+        logging.error(f"Unable to save checkpoint: {e}")
+
+
+def is_booked(context) -> bool:
+    checkpoint = load(context)
+    if checkpoint and checkpoint.booked:
+        logging.info(f"[{context.name}] Already booked ({checkpoint.justificante}), skipping")
+        return True
+    return False
+
+
+def resume(context, driver=None) -> int:
+    # Returns the attempts already made in this run and warms the session back up
+    checkpoint = load(context)
+    if checkpoint is None or not checkpoint.attempts:
+        return 0
+
+    logging.info(f"[{context.name}] Resuming after attempt {checkpoint.attempts}")
+    context.failed_loads = checkpoint.failed_loads
+    if checkpoint.cookies and time.time() - checkpoint.updated < COOKIE_TTL:
+        try:
+            restore_cookies(context, driver, checkpoint.cookies)
+            context.first_load = False
+        except Exception as e:
+            logging.error(f"Unable to restore cookies: {e}")
+    return checkpoint.attempts
+
+
+def session_cookies(context, driver) -> List[dict]:
+    if context.http_session is not None:
+        return [
+            {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path or "/"}
+            for c in context.http_session.cookies
+        ]
+    if driver is not None:
+        return driver.get_cookies()
+    return []
+
+
+def restore_cookies(context, driver, cookies: List[dict]):
+    if context.engine == Engine.HTTP:
+        from .browserless import new_http_session
+
+        context.http_session = context.http_session or new_http_session()
+        for c in cookies:
+            context.http_session.cookies.set(
+                c["name"], c["value"], domain=c["domain"], path=c["path"]
+            )
+    elif driver is not None:
+        for c in cookies:
+            cookie = {
+                k: c[k]
+                for k in ("name", "value", "domain", "path", "secure", "httpOnly")
+                if k in c
+            }
+            if "expiry" in c:
+                cookie["expires"] = c["expiry"]
+            driver.execute_cdp_cmd("Network.setCookie", cookie)
+
+
+def save_attempt(context, trace, driver=None):
+    checkpoint = load(context)
+    if checkpoint is None:
+        return
+    checkpoint.attempts += 1
+    checkpoint.last_step = trace.steps[-1]["step"] if trace.steps else ""
+    checkpoint.outcome = trace.outcome or ""
+    checkpoint.failed_loads = context.failed_loads
+    try:
+        checkpoint.cookies = [] if context.first_load else session_cookies(context, driver)
+    except Exception as e:
+        logging.error(f"Unable to read cookies: {e}")
+        checkpoint.cookies = []
+    store(checkpoint, context)
+
+
+def save_booked(context, justificante: str = ""):
+    checkpoint = load(context)
+    if checkpoint is None:
+        return
+    checkpoint.booked = True
+    checkpoint.outcome = "booked"
+    checkpoint.justificante = justificante
+    store(checkpoint, context)
+
+
+def end_run(context):
+    # The cycles ran out, the next start begins a new run from attempt 1
+    checkpoint = load(context)
+    if checkpoint is None:
+        return
+    checkpoint.attempts = 0
+    store(checkpoint, context)
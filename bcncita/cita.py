@@ -2,20 +2,13 @@ import io
 import json
 import logging
 import os
-import random
-import re
-import sys
-import tempfile
 import time
 from base64 import b64decode
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from datetime import datetime as dt
-from enum import Enum
-from json.decoder import JSONDecodeError
-from typing import Any, Dict, Optional
+from typing import Optional
 
 import backoff
-import requests
 from anticaptchaofficial.imagecaptcha import imagecaptcha
 from anticaptchaofficial.recaptchav3proxyless import recaptchaV3Proxyless
 from selenium import webdriver
@@ -26,7 +19,27 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select
 from selenium.webdriver.support.wait import WebDriverWait
 
-from .speaker import new_speaker
+from .captcha import (
+    RecaptchaPresolver,
+    get_presolver,
+    new_recaptcha_solver,
+    presolving,
+    solve_image_body,
+    stop_presolvers,
+)
+from .checkpoint import end_run, is_booked, resume, save_attempt, save_booked
+from .claims import pick_slot, share_slots
+from .history import record
+from .lean import LEAN_ARGUMENTS, enable_lean_mode
+from .metrics import Outcome, tracer
+from .offices import mark_empty, rank_offices
+from .profile import CustomerProfile, DocType, Engine, Office, OperationType, Province
+from .readiness import wait_ready
+from .sessions import BrowserPool, is_poisoned
+from .slots import extract_slot_labels, extract_slot_table
+from .sms import clear_inbox, get_sms_provider
+from .speaker import notifier as speaker
+from .throttle import is_throttled, pace, report, retry_after
 
 __all__ = [
     "try_cita",
@@ -34,6 +47,7 @@ __all__ = [
     "init_wedriver",
     "CustomerProfile",
     "DocType",
+    "Engine",
     "OperationType",
     "Office",
     "Province",
@@ -41,163 +55,11 @@ __all__ = [
 
 CYCLES = 144
 REFRESH_PAGE_CYCLES = 12
+COLD_RESET_AFTER = 3  # failed warm loads in a row before wiping the session anyway
 
 DELAY = 30  # timeout for page load
-
-speaker = new_speaker()
-
-
-class DocType(str, Enum):
-    DNI = "dni"
-    NIE = "nie"
-    PASSPORT = "passport"
-
-
-class OperationType(str, Enum):
-    AUTORIZACION_DE_REGRESO = "20"  # POLICIA-AUTORIZACIÓN DE REGRESO
-    BREXIT = "4094"  # POLICÍA-EXP.TARJETA ASOCIADA AL ACUERDO DE RETIRADA CIUDADANOS BRITÁNICOS Y SUS FAMILIARES (BREXIT)
-    CARTA_INVITACION = "4037"  # POLICIA-CARTA DE INVITACIÓN
-    CERTIFICADOS_NIE = "4096"  # POLICIA-CERTIFICADOS Y ASIGNACION NIE
-    CERTIFICADOS_NIE_NO_COMUN = "4079"  # POLICIA-CERTIFICADOS Y ASIGNACION NIE (NO COMUNITARIOS)
-    CERTIFICADOS_RESIDENCIA = "4049"  # POLICIA-CERTIFICADOS (DE RESIDENCIA, DE NO RESIDENCIA Y DE CONCORDANCIA) #fmt: off
-    CERTIFICADOS_UE = "4038"  # POLICIA-CERTIFICADO DE REGISTRO DE CIUDADANO DE LA U.E.
-    RECOGIDA_DE_TARJETA = "4036"  # POLICIA - RECOGIDA DE TARJETA DE IDENTIDAD DE EXTRANJERO (TIE)
-    SOLICITUD_ASILO = "4078"  # POLICIA - SOLICITUD ASILO
-    TOMA_HUELLAS = "4010"  # POLICIA-TOMA DE HUELLAS (EXPEDICIÓN DE TARJETA) Y RENOVACIÓN DE TARJETA DE LARGA DURACIÓN
-    ASIGNACION_NIE = "4031"  # Asignación de N.I.E.
-    FINGERP_RINT = "4047"  # POLICÍA-EXPEDICIÓN DE TARJETAS CUYA AUTORIZACIÓN RESUELVE LA DIRECCIÓN GENERAL DE MIGRACIONES
-
-
-class Office(str, Enum):
-    # Barcelona
-    BADALONA = "18"  # CNP-COMISARIA BADALONA, AVDA. DELS VENTS (9)
-    BARCELONA = "16"  # CNP - RAMBLA GUIPUSCOA 74, RAMBLA GUIPUSCOA (74)
-    BARCELONA_MALLORCA = "14"  # CNP MALLORCA-GRANADOS, MALLORCA (213)
-    CASTELLDEFELS = "19"  # CNP-COMISARIA CASTELLDEFELS, PLAÇA DE L`ESPERANTO (4)
-    CERDANYOLA = "20"  # CNP-COMISARIA CERDANYOLA DEL VALLES, VERGE DE LES FEIXES (4)
-    CORNELLA = "21"  # CNP-COMISARIA CORNELLA DE LLOBREGAT, AV. SANT ILDEFONS, S/N
-    ELPRAT = "23"  # CNP-COMISARIA EL PRAT DE LLOBREGAT, CENTRE (4)
-    GRANOLLERS = "28"  # CNP-COMISARIA GRANOLLERS, RICOMA (65)
-    HOSPITALET = "17"  # CNP-COMISARIA L`HOSPITALET DE LLOBREGAT, Rbla. Just Oliveres (43)
-    IGUALADA = "26"  # CNP-COMISARIA IGUALADA, PRAT DE LA RIBA (13)
-    MANRESA = "38"  # CNP-COMISARIA MANRESA, SOLER I MARCH (5)
-    MATARO = "27"  # CNP-COMISARIA MATARO, AV. GATASSA (15)
-    MONTCADA = "31"  # CNP-COMISARIA MONTCADA I REIXAC, MAJOR (38)
-    RIPOLLET = "32"  # CNP-COMISARIA RIPOLLET, TAMARIT (78)
-    RUBI = "29"  # CNP-COMISARIA RUBI, TERRASSA (16)
-    SABADELL = "30"  # CNP-COMISARIA SABADELL, BATLLEVELL (115)
-    SANTACOLOMA = "35"  # CNP-COMISARIA SANTA COLOMA DE GRAMENET, IRLANDA (67)
-    SANTADRIA = "33"  # CNP-COMISARIA SANT ADRIA DEL BESOS, AV. JOAN XXIII (2)
-    SANTBOI = "24"  # CNP-COMISARIA SANT BOI DE LLOBREGAT, RIERA BASTÉ (43)
-    SANTCUGAT = "34"  # CNP-COMISARIA SANT CUGAT DEL VALLES, VALLES (1)
-    SANTFELIU = "22"  # CNP-COMISARIA SANT FELIU DE LLOBREGAT, CARRERETES (9)
-    TERRASSA = "36"  # CNP-COMISARIA TERRASSA, BALDRICH (13)
-    VIC = "37"  # CNP-COMISARIA VIC, BISBE MORGADES (4)
-    VILADECANS = "25"  # CNP-COMISARIA VILADECANS, AVDA. BALLESTER (2)
-    VILAFRANCA = "46"  # CNP COMISARIA VILAFRANCA DEL PENEDES, Avinguda Ronda del Mar, 109
-    VILANOVA = "39"  # CNP-COMISARIA VILANOVA I LA GELTRU, VAPOR (19)
-
-    # Tenerife
-    OUE_SANTA_CRUZ = "1"  # 1 OUE SANTA CRUZ DE TENERIFE,  C/LA MARINA, 20
-    PLAYA_AMERICAS = "2"  # CNP-Playa de las Américas, Av. de los Pueblos, 2
-    PUERTO_CRUZ = "3"  # CNP-Puerto de la Cruz/Los Realejos, Av. del Campo y Llarena, 3
-
-
-class Province(str, Enum):
-    A_CORUÑA = "15"
-    ALBACETE = "2"
-    ALICANTE = "3"
-    ALMERÍA = "4"
-    ARABA = "1"
-    ASTURIAS = "33"
-    ÁVILA = "5"
-    BADAJOZ = "6"
-    BARCELONA = "8"
-    BIZKAIA = "48"
-    BURGOS = "9"
-    CÁCERES = "10"
-    CÁDIZ = "11"
-    CANTABRIA = "39"
-    CASTELLÓN = "12"
-    CEUTA = "51"
-    CIUDAD_REAL = "13"
-    CÓRDOBA = "14"
-    CUENCA = "16"
-    GIPUZKOA = "20"
-    GIRONA = "17"
-    GRANADA = "18"
-    GUADALAJARA = "19"
-    HUELVA = "21"
-    HUESCA = "22"
-    ILLES_BALEARS = "7"
-    JAÉN = "23"
-    LA_RIOJA = "26"
-    LAS_PALMAS = "35"
-    LEÓN = "24"
-    LLEIDA = "25"
-    LUGO = "27"
-    MADRID = "28"
-    MÁLAGA = "29"
-    MELILLA = "52"
-    MURCIA = "30"
-    NAVARRA = "31"
-    ORENSE = "32"
-    PALENCIA = "34"
-    PONTEVEDRA = "36"
-    SALAMANCA = "37"
-    S_CRUZ_TENERIFE = "38"
-    SEGOVIA = "40"
-    SEVILLA = "41"
-    SORIA = "42"
-    TARRAGONA = "43"
-    TERUEL = "44"
-    TOLEDO = "45"
-    VALENCIA = "46"
-    VALLADOLID = "47"
-    ZAMORA = "49"
-    ZARAGOZA = "50"
-
-
-@dataclass
-class CustomerProfile:
-    name: str
-    doc_type: DocType
-    doc_value: str  # Passport? "123123123"; Nie? "Y1111111M"
-    phone: str
-    email: str
-    province: Province = Province.BARCELONA
-    operation_code: OperationType = OperationType.TOMA_HUELLAS
-    country: str = "RUSIA"
-    year_of_birth: Optional[str] = None
-    offices: Optional[list] = field(default_factory=list)
-    except_offices: Optional[list] = field(default_factory=list)
-
-    anticaptcha_api_key: Optional[str] = None
-    auto_captcha: bool = True
-    auto_office: bool = True
-    chrome_driver_path: str = "/usr/local/bin/chromedriver"
-    chrome_profile_name: Optional[str] = None
-    chrome_profile_path: Optional[str] = None
-    min_date: Optional[str] = None  # "dd/mm/yyyy"
-    max_date: Optional[str] = None  # "dd/mm/yyyy"
-    min_time: Optional[str] = None  # "hh:mm"
-    max_time: Optional[str] = None  # "hh:mm"
-    save_artifacts: bool = False
-    sms_webhook_token: Optional[str] = None
-    wait_exact_time: Optional[list] = None  # [[minute, second]]
-    reason_or_type: str = "solicitud de asilo"
-
-    # Internals
-    bot_result: bool = False
-    first_load: Optional[bool] = True  # Wait more on the first load to cache stuff
-    log_settings: Optional[dict] = field(default_factory=lambda: {"stream": sys.stdout})
-    recaptcha_solver: Any = None
-    image_captcha_solver: Any = None
-    current_solver: Any = None
-
-    def __post_init__(self):
-        if self.operation_code == OperationType.RECOGIDA_DE_TARJETA:
-            assert len(self.offices) == 1, "Indicate the office where you need to pick up the card"
+REFRESH_INTERVAL = 5  # pause between refreshes while there are no citas
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.5005.63 Safari/537.36"
 
 
 def init_wedriver(context: CustomerProfile):
@@ -208,13 +70,17 @@ def init_wedriver(context: CustomerProfile):
     if context.chrome_profile_name:
         options.add_argument(f"profile-directory={context.chrome_profile_name}")
 
-    ua = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.5005.63 Safari/537.36"
-
     options.add_experimental_option("excludeSwitches", ["enable-automation", "enable-logging"])
     options.add_experimental_option("useAutomationExtension", False)
     options.add_argument("--ignore-certificate-errors")
     options.add_argument("--ignore-ssl-errors")
     options.add_argument("--disable-gpu")
+    if context.headless:
+        options.add_argument("--headless")
+        options.add_argument("--window-size=1280,1024")
+    if context.lean_mode:
+        for argument in LEAN_ARGUMENTS:
+            options.add_argument(argument)
 
     settings = {
         "recentDestinations": [{"id": "Save as PDF", "origin": "local", "account": ""}],
@@ -230,252 +96,189 @@ def init_wedriver(context: CustomerProfile):
 
     browser = webdriver.Chrome(context.chrome_driver_path, options=options)
     browser.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-    browser.execute_cdp_cmd("Network.setUserAgentOverride", {"userAgent": ua})
+    browser.execute_cdp_cmd("Network.setUserAgentOverride", {"userAgent": USER_AGENT})
+    if context.lean_mode:
+        enable_lean_mode(browser)
 
     return browser
 
 
-def try_cita(context: CustomerProfile, cycles: int = CYCLES):
-    driver = init_wedriver(context)
-    start_with(driver, context, cycles)
+def try_cita(context: CustomerProfile, cycles: int = CYCLES, pool: Optional[BrowserPool] = None):
+    if is_booked(context):
+        return
 
+    if pool is None:
+        driver = init_wedriver(context)
+        start_with(driver, context, cycles)
+        return
 
-def start_with(driver: webdriver, context: CustomerProfile, cycles: int = CYCLES):
-    logging.basicConfig(
-        format="%(asctime)s - %(message)s", level=logging.INFO, **context.log_settings  # type: ignore
-    )
-    if context.sms_webhook_token:
-        delete_message(context.sms_webhook_token)
-
-    operation_category = "icpplus"
-    operation_param = "tramiteGrupo[1]"
-
-    if context.province == Province.BARCELONA:
-        operation_category = "icpplustieb"
-        operation_param = "tramiteGrupo[0]"
-    elif context.province in [
-        Province.ALICANTE,
-        Province.ILLES_BALEARS,
-        Province.LAS_PALMAS,
-        Province.S_CRUZ_TENERIFE,
-    ]:
-        operation_category = "icpco"
-    elif context.province == Province.MADRID:
-        operation_category = "icpplustiem"
-    elif context.province == Province.MÁLAGA:
-        operation_category = "icpco"
-        operation_param = "tramiteGrupo[0]"
-    elif context.province in [
-        Province.MELILLA,
-        Province.SEVILLA,
-    ]:
-        operation_param = "tramiteGrupo[0]"
-
-    fast_forward_url = "https://icp.administracionelectronica.gob.es/{}/citar?p={}".format(
-        operation_category, context.province
-    )
-    fast_forward_url2 = "https://icp.administracionelectronica.gob.es/{}/acInfo?{}={}".format(
-        operation_category, operation_param, context.operation_code
-    )
-
+    # Warm browser from the pool, handed back for the next run unless it booked
+    driver = pool.acquire(context)
     success = False
-    result = False
-    for i in range(cycles):
-        try:
-            logging.info(f"\033[33m[Attempt {i + 1}/{cycles}]\033[0m")
-            result = cycle_cita(driver, context, fast_forward_url, fast_forward_url2)
-        except KeyboardInterrupt:
-            raise
-        except TimeoutException:
-            logging.error("Timeout exception")
-        except Exception as e:
-            logging.error(f"SMTH BROKEN: {e}")
-            continue
-
-        if result:
-            success = True
-            logging.info("WIN")
-            break
-
-    if not success:
-        logging.error("FAIL")
-        speaker.say("FAIL")
-        driver.quit()
-
-
-def toma_huellas_step2(driver: webdriver, context: CustomerProfile):
-    try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtPaisNac")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
-
-    # Select country
-    select = Select(driver.find_element(By.ID, "txtPaisNac"))
-    select.select_by_visible_text(context.country)
-
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
-
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
-
-    return True
-
-
-def recogida_de_tarjeta_step2(driver: webdriver, context: CustomerProfile):
-    try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
-
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
-
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
-
-    return True
-
-
-def solicitud_asilo_step2(driver: webdriver, context: CustomerProfile):
-    try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
-
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
-
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name, Keys.TAB, context.year_of_birth)
-
-    # Select country
-    select = Select(driver.find_element(By.ID, "txtPaisNac"))
-    select.select_by_visible_text(context.country)
-
-    return True
-
-
-def brexit_step2(driver: webdriver, context: CustomerProfile):
     try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
-
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
+        success = start_with(driver, context, cycles, quit_on_fail=False)
+    finally:
+        if success:
+            pool.discard(driver, quit=False)
+        else:
+            pool.release(driver)
 
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
 
-    return True
+def fast_forward_urls(context: CustomerProfile):
+    from .routes import route_urls
 
+    return route_urls(context.province, context.operation_code)
 
-def carta_invitacion_step2(driver: webdriver, context: CustomerProfile):
-    try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
 
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.DNI:
-        driver.find_element(By.ID, "rdbTipoDocDni").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
+def run_attempt(driver: webdriver, context: CustomerProfile, fast_forward_url, fast_forward_url2):
+    cycle = cycle_cita
+    if context.engine == Engine.HTTP:
+        from .browserless import cycle_cita_http as cycle
 
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
+    result = None
+    with tracer.attempt(context) as trace:
+        try:
+            result = cycle(driver, context, fast_forward_url, fast_forward_url2)
+            if result:
+                tracer.outcome(Outcome.BOOKED)
+        except KeyboardInterrupt:
+            raise
+        except TimeoutException:
+            logging.error("Timeout exception")
+            tracer.outcome(Outcome.TIMEOUT)
+        except Exception as e:
+            logging.error(f"SMTH BROKEN: {e}")
+            tracer.outcome(Outcome.ERROR)
 
-    return True
+    if context.checkpoint_path:
+        save_attempt(context, trace, driver)
+    return result
 
 
-def certificados_step2(driver: webdriver, context: CustomerProfile):
-    try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
-        return None
-
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.DNI:
-        driver.find_element(By.ID, "rdbTipoDocDni").send_keys(Keys.SPACE)
+def start_with(
+    driver: webdriver, context: CustomerProfile, cycles: int = CYCLES, quit_on_fail: bool = True
+):
+    logging.basicConfig(
+        format="%(asctime)s - %(message)s", level=logging.INFO, **context.log_settings  # type: ignore
+    )
+    if is_booked(context):
+        if quit_on_fail:
+            driver.quit()
+        return True
+    clear_inbox(context)
 
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
+    fast_forward_url, fast_forward_url2 = fast_forward_urls(context)
 
-    return True
+    success = False
+    with presolving([context]):
+        for i in range(resume(context, driver), cycles):
+            logging.info(f"\033[33m[Attempt {i + 1}/{cycles}]\033[0m")
+            result = run_attempt(driver, context, fast_forward_url, fast_forward_url2)
+            if result:
+                success = True
+                logging.info("WIN")
+                break
 
+    if not success:
+        logging.error("FAIL")
+        speaker.say("FAIL")
+        end_run(context)
+        if quit_on_fail:
+            driver.quit()
 
-def autorizacion_de_regreso_step2(driver: webdriver, context: CustomerProfile):
+    return success
+
+
+# 2. Personal info form, one spec per operation
+DOC_RADIOS = {
+    DocType.PASSPORT: "rdbTipoDocPas",
+    DocType.NIE: "rdbTipoDocNie",
+    DocType.DNI: "rdbTipoDocDni",
+}
+NAME_FIELDS = (("txtIdCitado", "doc_value"), ("txtDesCitado", "name"))
+BIRTH_FIELDS = NAME_FIELDS + (("txtAnnoCitado", "year_of_birth"),)
+ALL_DOCS = (DocType.PASSPORT, DocType.NIE, DocType.DNI)
+
+# Sets every field in one round trip, returns the ids it couldn't find
+FILL_FORM_SCRIPT = """
+const form = arguments[0];
+const missing = [];
+const fire = (el, ...events) => events.forEach(e => el.dispatchEvent(new Event(e, {bubbles: true})));
+if (form.radio) {
+    const el = document.getElementById(form.radio);
+    if (el) el.click(); else missing.push(form.radio);
+}
+for (const [id, value] of form.inputs) {
+    const el = document.getElementById(id);
+    if (!el) { missing.push(id); continue; }
+    el.focus();
+    el.value = value;
+    fire(el, 'input', 'change', 'blur');
+}
+for (const [id, text] of form.selects) {
+    const el = document.getElementById(id);
+    const option = el && Array.from(el.options).find(o => o.text.trim() === text);
+    if (!option) { missing.push(`${id}=${text}`); continue; }
+    el.value = option.value;
+    fire(el, 'change');
+}
+return missing;
+"""
+
+
+@dataclass(frozen=True)
+class FormSpec:
+    fields: tuple = NAME_FIELDS  # (element id, CustomerProfile attribute), in tab order
+    doc_types: tuple = (DocType.PASSPORT, DocType.NIE)  # doc types with a radio button
+    country: bool = False  # txtPaisNac select
+    wait_for: str = "txtIdCitado"
+
+    def values(self, context: CustomerProfile):
+        inputs = [
+            [element_id, getattr(context, attr)]
+            for element_id, attr in self.fields
+            if getattr(context, attr) is not None
+        ]
+        return {
+            "radio": DOC_RADIOS[context.doc_type] if context.doc_type in self.doc_types else None,
+            "inputs": inputs,
+            "selects": [["txtPaisNac", context.country]] if self.country else [],
+        }
+
+
+FORM_SPECS = {
+    OperationType.TOMA_HUELLAS: FormSpec(country=True, wait_for="txtPaisNac"),
+    OperationType.RECOGIDA_DE_TARJETA: FormSpec(),
+    OperationType.SOLICITUD_ASILO: FormSpec(BIRTH_FIELDS, country=True),
+    OperationType.BREXIT: FormSpec(),
+    OperationType.CARTA_INVITACION: FormSpec(doc_types=ALL_DOCS),
+    OperationType.CERTIFICADOS_NIE: FormSpec(doc_types=ALL_DOCS),
+    OperationType.CERTIFICADOS_NIE_NO_COMUN: FormSpec(doc_types=ALL_DOCS),
+    OperationType.CERTIFICADOS_RESIDENCIA: FormSpec(doc_types=ALL_DOCS),
+    OperationType.CERTIFICADOS_UE: FormSpec(doc_types=ALL_DOCS),
+    OperationType.AUTORIZACION_DE_REGRESO: FormSpec(),
+    OperationType.ASIGNACION_NIE: FormSpec(BIRTH_FIELDS, (DocType.PASSPORT,), country=True),
+}
+
+
+def form_spec(context: CustomerProfile) -> FormSpec:
+    # Operations without an entry get the common document + name form
+    return FORM_SPECS.get(context.operation_code, FormSpec())
+
+
+def fill_personal_info(driver: webdriver, context: CustomerProfile):
+    spec = form_spec(context)
     try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
+        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, spec.wait_for)))
     except TimeoutException:
         logging.error("Timed out waiting for form to load")
         return None
 
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        driver.find_element(By.ID, "rdbTipoDocPas").send_keys(Keys.SPACE)
-    elif context.doc_type == DocType.NIE:
-        driver.find_element(By.ID, "rdbTipoDocNie").send_keys(Keys.SPACE)
-
-    # Enter doc number and name
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name)
-
-    return True
-
-
-def asignacion_nie_step2(driver: webdriver, context: CustomerProfile):
-    try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "txtIdCitado")))
-    except TimeoutException:
-        logging.error("Timed out waiting for form to load")
+    missing = driver.execute_script(FILL_FORM_SCRIPT, spec.values(context))
+    if missing:
+        logging.error(f"Personal info form is missing {', '.join(missing)}")
         return None
 
-    # Select doc type
-    if context.doc_type == DocType.PASSPORT:
-        option = driver.find_element(By.ID, "rdbTipoDocPas")
-        if option:
-            option.send_keys(Keys.SPACE)
-
-    # Enter doc number, name and year of birth
-    element = driver.find_element(By.ID, "txtIdCitado")
-    element.send_keys(context.doc_value, Keys.TAB, context.name, Keys.TAB, context.year_of_birth)
-
-    # Select country
-    select = Select(driver.find_element(By.ID, "txtPaisNac"))
-    select.select_by_visible_text(context.country)
-
     return True
 
 
@@ -515,43 +318,70 @@ def process_captcha(driver: webdriver, context: CustomerProfile):
         logging.info(
             "HEY, DO SOMETHING HUMANE TO TRICK THE CAPTCHA (select text, move cursor etc.) and press ENTER"
         )
-        for i in range(10):
-            speaker.say("ALARM")
+        speaker.say("ALARM", repeat=10)
         input()
 
     return True
 
 
 def solve_recaptcha(driver: webdriver, context: CustomerProfile):
-    if not context.recaptcha_solver:
+    if not context.recaptcha_solver or context.presolve_captcha:
         site_key = driver.find_element(By.ID, "reCAPTCHA_site_key").get_attribute("value")
         page_action = driver.find_element(By.ID, "action").get_attribute("value")
+
+    if context.presolve_captcha:
+        presolver = get_presolver(
+            context.anticaptcha_api_key, site_key, page_action, context.presolve_captcha
+        )
+        g_response = presolver.take()
+        if g_response:
+            logging.info("Anticaptcha: presolved g-response: " + g_response)
+            context.current_solver = RecaptchaPresolver
+            set_recaptcha_response(driver, g_response)
+            return True
+
+    if not context.recaptcha_solver:
         logging.info("Anticaptcha: site key: " + site_key)
         logging.info("Anticaptcha: action: " + page_action)
-
-        context.recaptcha_solver = recaptchaV3Proxyless()
-        context.recaptcha_solver.set_verbose(1)
-        context.recaptcha_solver.set_key(context.anticaptcha_api_key)
-        context.recaptcha_solver.set_website_url("https://icp.administracionelectronica.gob.es")
-        context.recaptcha_solver.set_website_key(site_key)
-        context.recaptcha_solver.set_page_action(page_action)
-        context.recaptcha_solver.set_min_score(0.9)
+        context.recaptcha_solver = new_recaptcha_solver(
+            context.anticaptcha_api_key, site_key, page_action
+        )
 
     context.current_solver = type(context.recaptcha_solver)
 
     g_response = context.recaptcha_solver.solve_and_return_solution()
     if g_response != 0:
         logging.info("Anticaptcha: g-response: " + g_response)
-        driver.execute_script(
-            f"document.getElementById('g-recaptcha-response').value = '{g_response}'"
-        )
+        set_recaptcha_response(driver, g_response)
         return True
     else:
         logging.error("Anticaptcha: " + context.recaptcha_solver.err_string)
         return None
 
 
+def set_recaptcha_response(driver: webdriver, g_response: str):
+    driver.execute_script(
+        f"document.getElementById('g-recaptcha-response').value = '{g_response}'"
+    )
+
+
 def solve_image_captcha(driver: webdriver, context: CustomerProfile):
+    # The image is inline as a data URI, it never touches the disk
+    img = driver.find_elements(By.CSS_SELECTOR, "img.img-thumbnail")[0]
+    body = img.get_attribute("src").split(",", 1)[-1].strip()
+
+    if context.captcha_ocr:
+        try:
+            captcha_result = context.captcha_ocr.solve(memoryview(b64decode(body)))
+        except Exception as e:
+            logging.error(f"OCR: {e}")
+            captcha_result = None
+        if captcha_result:
+            logging.info("OCR: captcha text: " + captcha_result)
+            context.current_solver = type(context.captcha_ocr)
+            driver.find_element(By.ID, "captcha").send_keys(captcha_result)
+            return True
+
     if not context.image_captcha_solver:
         context.image_captcha_solver = imagecaptcha()
         context.image_captcha_solver.set_verbose(1)
@@ -559,32 +389,27 @@ def solve_image_captcha(driver: webdriver, context: CustomerProfile):
 
     context.current_solver = type(context.image_captcha_solver)
 
-    try:
-        img = driver.find_elements(By.CSS_SELECTOR, "img.img-thumbnail")[0]
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        tmp.write(b64decode(img.get_attribute("src").split(",")[1].strip()))
-        tmp.close()
-
-        captcha_result = context.image_captcha_solver.solve_and_return_solution(tmp.name)
-        if captcha_result != 0:
-            logging.info("Anticaptcha: captcha text: " + captcha_result)
-            element = driver.find_element(By.ID, "captcha")
-            element.send_keys(captcha_result)
-            return True
-        else:
-            logging.error("Anticaptcha: " + context.image_captcha_solver.err_string)
-            return None
-    finally:
-        os.unlink(tmp.name)
+    captcha_result = solve_image_body(context.image_captcha_solver, body)
+    if captcha_result != 0:
+        logging.info("Anticaptcha: captcha text: " + captcha_result)
+        element = driver.find_element(By.ID, "captcha")
+        element.send_keys(captcha_result)
+        return True
+    else:
+        logging.error("Anticaptcha: " + context.image_captcha_solver.err_string)
+        return None
 
 
 def find_best_date_slots(driver: webdriver, context: CustomerProfile):
     try:
-        els = driver.find_elements(By.CSS_SELECTOR, "[id^=lCita_]")
-        dates = sorted([*map(lambda x: x.text, els)])
-        best_date = find_best_date(dates, context)
+        labels = extract_slot_labels(driver)
+        record(context, shown=True, slots=len(labels), office=context.selected_office or "")
+        if not labels:
+            mark_empty(context, context.selected_office)
+        best_date = find_best_date(labels, context)
         if best_date:
-            return dates.index(best_date) + 1
+            # Radio buttons follow the order of the labels on the page
+            return labels.index(best_date) + 1
     except Exception as e:
         logging.error(e)
 
@@ -592,36 +417,24 @@ def find_best_date_slots(driver: webdriver, context: CustomerProfile):
 
 
 def find_best_date(dates, context: CustomerProfile):
-    if not context.min_date and not context.max_date:
+    best_date = context.constraints.best_label(dates)
+    if best_date:
+        return best_date
+    if context.constraints.is_open and dates:
         return dates[0]
 
-    pattern = re.compile(r"\d{2}/\d{2}/\d{4}")
-    date_format = "%d/%m/%Y"
+    log_nothing_found(context)
+    return None
 
-    for date in dates:
-        try:
-            found = pattern.findall(date)[0]
-            if found:
-                appt_date = dt.strptime(found, date_format)
-                if context.min_date:
-                    if appt_date < dt.strptime(context.min_date, date_format):
-                        continue
-                if context.max_date:
-                    if appt_date > dt.strptime(context.max_date, date_format):
-                        continue
-
-                return date
-        except Exception as e:
-            logging.error(e)
-            continue
 
+def log_nothing_found(context: CustomerProfile):
     logging.info(
         f"Nothing found for dates {context.min_date} - {context.max_date}, {context.min_time} - {context.max_time}, skipping"
     )
-    return None
 
 
 def select_office(driver: webdriver, context: CustomerProfile):
+    context.selected_office = None
     if not context.auto_office:
         speaker.say("MAKE A CHOICE")
         logging.info("Select office and press ENTER")
@@ -635,29 +448,17 @@ def select_office(driver: webdriver, context: CustomerProfile):
             with io.open(offices_path, "w", encoding="utf-8") as f:
                 f.write(el.get_attribute("innerHTML"))
 
-        if context.offices:
-            for office in context.offices:
-                try:
-                    select.select_by_value(office.value)
-                    return True
-                except Exception as e:
-                    logging.error(e)
-                    if context.operation_code == OperationType.RECOGIDA_DE_TARJETA:
-                        return None
-
-        for i in range(5):
-            options = list(filter(lambda o: o.get_attribute("value") != "", select.options))
-            default_count = len(select.options)
-            first_element = 0 if len(options) == default_count else 1
-            select.select_by_index(random.randint(first_element, default_count - 1))
-            if el.get_attribute("value") not in context.except_offices:  # type: ignore
-                return True
-            continue
-
-        return None
+        available = [o.get_attribute("value") for o in select.options]
+        ranked = rank_offices(context, [o for o in available if o])
+        if not ranked:
+            return None
+        select.select_by_value(ranked[0])
+        context.selected_office = ranked[0]
+        return True
 
 
 def office_selection(driver: webdriver, context: CustomerProfile):
+    pace()
     driver.execute_script("enviar('solicitud');")
 
     for i in range(REFRESH_PAGE_CYCLES):
@@ -667,7 +468,7 @@ def office_selection(driver: webdriver, context: CustomerProfile):
             logging.info("[Step 2/6] Office selection")
 
             # Office selection:
-            time.sleep(0.3)
+            wait_ready(driver)
             try:
                 WebDriverWait(driver, DELAY).until(
                     EC.presence_of_element_located((By.ID, "btnSiguiente"))
@@ -678,23 +479,42 @@ def office_selection(driver: webdriver, context: CustomerProfile):
 
             res = select_office(driver, context)
             if res is None:
-                time.sleep(5)
+                # Nothing to pick, otherwise the slot page is recorded instead
+                record(context, shown=True)
+                time.sleep(REFRESH_INTERVAL)
+                pace()
                 driver.refresh()
                 continue
 
             btn = driver.find_element(By.ID, "btnSiguiente")
+            pace()
             btn.send_keys(Keys.ENTER)
             return True
         elif "En este momento no hay citas disponibles" in resp_text:
-            time.sleep(5)
+            record(context, shown=False)
+            time.sleep(REFRESH_INTERVAL)
+            pace()
             driver.refresh()
             continue
         else:
             logging.info("[Step 2/6] Office selection -> No offices")
+            tracer.outcome(Outcome.NO_OFFICES)
             return None
 
+    tracer.outcome(Outcome.NO_CITAS)
+    return None
+
 
 def phone_mail(driver: webdriver, context: CustomerProfile):
+    with tracer.step("contact_info"):
+        success = contact_info(driver, context)
+    if not success:
+        return None
+
+    return cita_selection(driver, context)
+
+
+def contact_info(driver: webdriver, context: CustomerProfile):
     try:
         WebDriverWait(driver, DELAY).until(
             EC.presence_of_element_located((By.ID, "txtTelefonoCitado"))
@@ -718,12 +538,25 @@ def phone_mail(driver: webdriver, context: CustomerProfile):
 
     add_reason(driver, context)
 
+    pace()
     driver.execute_script("enviar();")
 
-    return cita_selection(driver, context)
+    return True
+
+
+def is_cancelled(context: CustomerProfile):
+    if context.cancelled is None or not context.cancelled.is_set():
+        return False
+    # Somebody else may be booking this profile by now
+    logging.error(f"[{context.name}] Cancelled, not confirming")
+    tracer.outcome(Outcome.CANCELLED)
+    return True
 
 
 def confirm_appointment(driver: webdriver, context: CustomerProfile):
+    if is_cancelled(context):
+        return None
+
     driver.find_element(By.ID, "chkTotal").send_keys(Keys.SPACE)
     driver.find_element(By.ID, "enviarCorreo").send_keys(Keys.SPACE)
 
@@ -737,6 +570,7 @@ def confirm_appointment(driver: webdriver, context: CustomerProfile):
         context.bot_result = True
         code = driver.find_element(By.ID, "justificanteFinal").text
         logging.info(f"[Step 6/6] Justificante cita: {code}")
+        save_booked(context, code)
         if context.save_artifacts:
             image_name = f"CONFIRMED-CITA-{ctime}.png".replace(":", "-")
             driver.save_screenshot(image_name)
@@ -761,9 +595,9 @@ def log_backoff(details):
 
 
 @backoff.on_exception(
-    backoff.constant,
+    backoff.runtime,
     TimeoutException,
-    interval=350,
+    value=lambda _: retry_after(),
     max_tries=(10 if os.environ.get("CITA_TEST") else None),
     on_backoff=log_backoff,
     logger=None,
@@ -773,10 +607,11 @@ def initial_page(driver: webdriver, context: CustomerProfile, fast_forward_url,
         driver.delete_all_cookies()
 
     driver.set_page_load_timeout(300 if context.first_load else 50)
-    # Fix chromedriver 103 bug
-    time.sleep(1)
+    # Fix chromedriver 103 bug: don't navigate away from a page that is still loading
+    wait_ready(driver)
+    pace(fast_forward_url)
     driver.get(fast_forward_url)
-    time.sleep(5)
+    wait_ready(driver)
     if context.first_load:
         try:
             driver.execute_script("window.localStorage.clear();")
@@ -784,77 +619,65 @@ def initial_page(driver: webdriver, context: CustomerProfile, fast_forward_url,
         except Exception as e:
             logging.error(e)
             pass
+    pace(fast_forward_url2)
     driver.get(fast_forward_url2)
-    time.sleep(5)
+    wait_ready(driver)
 
     resp_text = body_text(driver)
     if "INTERNET CITA PREVIA" not in resp_text:
-        context.first_load = True
+        # A slow or empty load is retried on the warm session, only a burnt one is wiped
+        context.failed_loads += 1
+        context.first_load = is_poisoned(resp_text) or context.failed_loads >= COLD_RESET_AFTER
+        if context.first_load:
+            context.failed_loads = 0
+        if is_throttled(resp_text):
+            report(False, fast_forward_url2)
         raise TimeoutException
 
+    report(True, fast_forward_url2)
     context.first_load = False
+    context.failed_loads = 0
 
 
 def cycle_cita(driver: webdriver, context: CustomerProfile, fast_forward_url, fast_forward_url2):
-    initial_page(driver, context, fast_forward_url, fast_forward_url2)
+    with tracer.step("initial_page"):
+        initial_page(driver, context, fast_forward_url, fast_forward_url2)
 
     # 1. Instructions page:
     try:
-        WebDriverWait(driver, DELAY).until(EC.presence_of_element_located((By.ID, "btnEntrar")))
+        with tracer.step("instructions"):
+            WebDriverWait(driver, DELAY).until(
+                EC.presence_of_element_located((By.ID, "btnEntrar"))
+            )
     except TimeoutException:
         logging.error("Timed out waiting for Instructions page to load")
+        tracer.outcome(Outcome.TIMEOUT)
         return None
 
-    if os.environ.get("CITA_TEST") and context.operation_code == OperationType.TOMA_HUELLAS:
-        logging.info("Instructions page loaded")
-        return True
-
+    pace()
     driver.find_element(By.ID, "btnEntrar").send_keys(Keys.ENTER)
 
+    return request_cita(driver, context)
+
+
+def request_cita(driver: webdriver, context: CustomerProfile):
     # 2. Personal info:
     logging.info("[Step 1/6] Personal info")
-    success = False
-    if context.operation_code == OperationType.TOMA_HUELLAS:
-        success = toma_huellas_step2(driver, context)
-    elif context.operation_code == OperationType.RECOGIDA_DE_TARJETA:
-        success = recogida_de_tarjeta_step2(driver, context)
-    elif context.operation_code == OperationType.SOLICITUD_ASILO:
-        success = solicitud_asilo_step2(driver, context)
-    elif context.operation_code == OperationType.BREXIT:
-        success = brexit_step2(driver, context)
-    elif context.operation_code == OperationType.CARTA_INVITACION:
-        success = carta_invitacion_step2(driver, context)
-    elif context.operation_code in [
-        OperationType.CERTIFICADOS_NIE,
-        OperationType.CERTIFICADOS_NIE_NO_COMUN,
-        OperationType.CERTIFICADOS_RESIDENCIA,
-        OperationType.CERTIFICADOS_UE,
-    ]:
-        success = certificados_step2(driver, context)
-    elif context.operation_code == OperationType.AUTORIZACION_DE_REGRESO:
-        success = autorizacion_de_regreso_step2(driver, context)
-    elif context.operation_code == OperationType.ASIGNACION_NIE:
-        success = asignacion_nie_step2(driver, context)
-
+    with tracer.step("personal_info"):
+        success = personal_info(driver, context)
     if not success:
         return None
 
-    time.sleep(2)
-    driver.find_element(By.ID, "btnEnviar").send_keys(Keys.ENTER)
-
     try:
-        WebDriverWait(driver, 7).until(EC.presence_of_element_located((By.ID, "btnConsultar")))
-    except TimeoutException:
-        logging.error("Timed out waiting for Solicitar page to load")
-
-    try:
-        wait_exact_time(driver, context)
+        with tracer.step("wait_exact_time"):
+            wait_exact_time(driver, context)
     except TimeoutException:
         logging.error("Timed out waiting for exact time")
         return None
 
     # 3. Solicitar cita:
-    selection_result = office_selection(driver, context)
+    with tracer.step("office_selection"):
+        selection_result = office_selection(driver, context)
     if selection_result is None:
         return None
 
@@ -862,6 +685,27 @@ def cycle_cita(driver: webdriver, context: CustomerProfile, fast_forward_url, fa
     return phone_mail(driver, context)
 
 
+def personal_info(driver: webdriver, context: CustomerProfile):
+    if not fill_personal_info(driver, context):
+        return None
+
+    try:
+        WebDriverWait(driver, DELAY).until(EC.element_to_be_clickable((By.ID, "btnEnviar")))
+    except TimeoutException:
+        logging.error("Timed out waiting for personal info form to be ready")
+        return None
+    wait_ready(driver)
+    pace()
+    driver.find_element(By.ID, "btnEnviar").send_keys(Keys.ENTER)
+
+    try:
+        WebDriverWait(driver, 7).until(EC.presence_of_element_located((By.ID, "btnConsultar")))
+    except TimeoutException:
+        logging.error("Timed out waiting for Solicitar page to load")
+
+    return True
+
+
 # 5. Cita selection
 def cita_selection(driver: webdriver, context: CustomerProfile):
     resp_text = body_text(driver)
@@ -871,13 +715,17 @@ def cita_selection(driver: webdriver, context: CustomerProfile):
         if context.save_artifacts:
             driver.save_screenshot(f"citas-{dt.now()}.png".replace(":", "-"))
 
-        position = find_best_date_slots(driver, context)
+        with tracer.step("slot_selection"):
+            position = find_best_date_slots(driver, context)
         if not position:
+            tracer.outcome(Outcome.NO_MATCHING_SLOT)
             return None
 
-        time.sleep(2)
-        success = process_captcha(driver, context)
+        with tracer.step("captcha"):
+            wait_ready(driver)
+            success = process_captcha(driver, context)
         if not success:
+            tracer.outcome(Outcome.CAPTCHA_FAILED)
             return None
 
         try:
@@ -889,7 +737,7 @@ def cita_selection(driver: webdriver, context: CustomerProfile):
             pass
 
         driver.execute_script("envia();")
-        time.sleep(0.5)
+        WebDriverWait(driver, DELAY).until(EC.alert_is_present())
         driver.switch_to.alert.accept()
     elif "Seleccione una de las siguientes citas disponibles" in resp_text:
         logging.info("[Step 4/6] Cita attempt -> selection hit!")
@@ -897,56 +745,56 @@ def cita_selection(driver: webdriver, context: CustomerProfile):
             driver.save_screenshot(f"citas-{dt.now()}.png".replace(":", "-"))
 
         try:
-            date_els = driver.find_elements(
-                By.CSS_SELECTOR, "#CitaMAP_HORAS thead [class^=colFecha]"
-            )
-            dates = sorted([*map(lambda x: x.text, date_els)])
-            slots: Dict[str, list] = {}
-            slot_table = driver.find_element(By.CSS_SELECTOR, "#CitaMAP_HORAS tbody")
-            for row in slot_table.find_elements(By.CSS_SELECTOR, "tr"):
-                appt_time = row.find_elements(By.TAG_NAME, "th")[0].text
-                if context.min_time:
-                    if appt_time < context.min_time:
-                        continue
-                if context.max_time:
-                    if appt_time > context.max_time:
-                        break
-
-                for idx, cell in enumerate(row.find_elements(By.TAG_NAME, "td")):
-                    try:
-                        if slots.get(dates[idx]):
-                            continue
-                        slot = cell.find_element(By.CSS_SELECTOR, "[id^=HUECO]").get_attribute(
-                            "id"
-                        )
-                        slots[dates[idx]] = [slot]
-                    except Exception:
-                        pass
-
-            best_date = find_best_date(sorted(slots), context)
-            if not best_date:
+            with tracer.step("slot_selection"):
+                offered = extract_slot_table(driver).slot_list()
+                record(
+                    context, shown=True, slots=len(offered), office=context.selected_office or ""
+                )
+                if not offered:
+                    mark_empty(context, context.selected_office)
+                slot = pick_slot(context, offered)
+                share_slots(context, offered, taken=slot)
+            if not slot:
+                log_nothing_found(context)
+                tracer.outcome(Outcome.NO_MATCHING_SLOT)
                 return None
-            slot = slots[best_date][0]
 
-            time.sleep(2)
-            success = process_captcha(driver, context)
+            with tracer.step("captcha"):
+                wait_ready(driver)
+                success = process_captcha(driver, context)
             if not success:
+                tracer.outcome(Outcome.CAPTCHA_FAILED)
                 return None
 
             driver.execute_script(f"confirmarHueco({{id: '{slot}'}}, {slot[5:]});")
             driver.switch_to.alert.accept()
         except Exception as e:
             logging.error(e)
+            tracer.outcome(Outcome.ERROR)
             return None
     else:
+        empty = "En este momento no hay citas disponibles" in resp_text
+        if empty:
+            mark_empty(context, context.selected_office)
+        record(
+            context, shown=True, slots=0 if empty else None, office=context.selected_office or ""
+        )
         logging.info("[Step 4/6] Cita attempt -> missed selection")
+        tracer.outcome(Outcome.MISSED_SELECTION)
         return None
 
     # 6. Confirmation
+    with tracer.step("confirmation"):
+        return confirm_cita(driver, context)
+
+
+def confirm_cita(driver: webdriver, context: CustomerProfile):
     resp_text = body_text(driver)
 
     if "Debe confirmar los datos de la cita asignada" in resp_text:
         logging.info("[Step 5/6] Cita attempt -> confirmation hit!")
+        if is_cancelled(context):
+            return None
         if context.current_solver == recaptchaV3Proxyless:
             context.recaptcha_solver.report_correct_recaptcha()
 
@@ -957,9 +805,10 @@ def cita_selection(driver: webdriver, context: CustomerProfile):
             sms_verification = None
             pass
 
-        if context.sms_webhook_token:
+        if get_sms_provider(context):
             if sms_verification:
-                code = get_code(context)
+                with tracer.step("sms_code"):
+                    code = get_code(context)
                 if code:
                     logging.info(f"Received code: {code}")
                     sms_verification = driver.find_element(By.ID, "txtCodigoVerificacion")
@@ -971,22 +820,27 @@ def cita_selection(driver: webdriver, context: CustomerProfile):
                 driver.save_screenshot(f"FINAL-SCREEN-{dt.now()}.png".replace(":", "-"))
 
             if context.bot_result:
-                driver.quit()
-                os._exit(0)
+                tracer.outcome(Outcome.BOOKED)
+                if not context.exit_on_success:
+                    return True
+                exit_booked(driver)
             return None
         else:
             if not sms_verification:
                 confirm_appointment(driver, context)
 
             speaker.say("ENTER THE SHORT CODE FROM SMS")
+            tracer.outcome(Outcome.HANDED_OVER)
+            if not context.exit_on_success:
+                return True
 
             logging.info("Press Any button to CLOSE browser")
             input()
-            driver.quit()
-            os._exit(0)
+            exit_booked(driver)
 
     else:
         logging.info("[Step 5/6] Cita attempt -> missed confirmation")
+        tracer.outcome(Outcome.MISSED_CONFIRMATION)
         if context.current_solver == recaptchaV3Proxyless:
             context.recaptcha_solver.report_incorrect_recaptcha()
         elif context.current_solver == imagecaptcha:
@@ -997,33 +851,16 @@ def cita_selection(driver: webdriver, context: CustomerProfile):
         return None
 
 
-def get_messages(sms_webhook_token):
-    try:
-        url = f"https://webhook.site/token/{sms_webhook_token}/requests?page=1&sorting=newest"
-        return requests.get(url).json()["data"]
-    except JSONDecodeError:
-        raise Exception("sms_webhook_token is incorrect")
-
-
-def delete_message(sms_webhook_token, message_id=""):
-    url = f"https://webhook.site/token/{sms_webhook_token}/request/{message_id}"
-    requests.delete(url)
+def exit_booked(driver: webdriver):
+    # os._exit skips every finally block, record the attempt first
+    tracer.finish()
+    stop_presolvers()
+    driver.quit()
+    os._exit(0)
 
 
 def get_code(context: CustomerProfile):
-    for i in range(60):
-        messages = get_messages(context.sms_webhook_token)
-        if not messages:
-            time.sleep(5)
-            continue
-
-        content = messages[0].get("text_content")
-        match = re.search("CODIGO (.*), DE", content)
-        if match:
-            delete_message(context.sms_webhook_token, messages[0].get("uuid"))
-            return match.group(1)
-
-    return None
+    return get_sms_provider(context).wait_code(context.phone)
 
 
 def add_reason(driver: webdriver, context: CustomerProfile):
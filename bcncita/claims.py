@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .constraints import Slot
+
+__all__ = ["Hint", "assign", "share_slots", "pick_slot"]
+
+HINT_TTL = 120  # the ICP keeps a slot on offer for a couple of minutes at most
+
+# A slot page belongs to the session that filled the form, it can't book for anybody else.
+# What it can do is tell the other waiting profiles which slots fit them, so they go for
+# those right away and don't all race for the same one.
+
+
+@dataclass
+class Hint:
+    office: Optional[str]
+    slot: Slot
+    seen: float
+
+
+_waiting: Dict[Tuple[str, str], Dict[int, object]] = {}
+_hints: Dict[int, Hint] = {}
+_claimed: Dict[Tuple[str, str, str], float] = {}  # slot -> when it was promised to somebody
+_listeners: List[Callable[[object], None]] = []
+_lock = threading.Lock()
+
+
+def group_key(context):
+    return (context.province.name, context.operation_code.name)
+
+
+def wait(context):
+    with _lock:
+        _waiting.setdefault(group_key(context), {})[id(context)] = context
+
+
+def leave(context):
+    with _lock:
+        _waiting.get(group_key(context), {}).pop(id(context), None)
+        _hints.pop(id(context), None)
+
+
+def on_hint(listener: Callable[[object], None]):
+    with _lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener: Callable[[object], None]):
+    with _lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def wants_office(context, office: Optional[str]):
+    if office is None:
+        return True
+    if context.offices:
+        return any(o.value == office for o in context.offices)
+    return office not in (context.except_offices or [])
+
+
+def assign(slots: List[Slot], profiles: list) -> List[Tuple[object, Slot]]:
+    # Slots sorted like slot_list() returns them. The pickiest profile chooses first,
+    # each one gets the earliest free slot it accepts.
+    fits = {
+        id(context): [s for s in slots if context.constraints.accepts(s.day, s.at)]
+        for context in profiles
+    }
+    taken = set()
+    assigned = []
+    for context in sorted(profiles, key=lambda c: len(fits[id(c)])):
+        for slot in fits[id(context)]:
+            if slot.value not in taken:
+                taken.add(slot.value)
+                assigned.append((context, slot))
+                break
+    return assigned
+
+
+def share_slots(context, offered: List[Slot], taken=None) -> List[Tuple[object, Slot]]:
+    office = context.selected_office
+    with _lock:
+        others = [
+            other
+            for other in _waiting.get(group_key(context), {}).values()
+            if other is not context
+            and not is_fresh(_hints.get(id(other)))
+            and wants_office(other, office)
+        ]
+    free = [s for s in offered if s.value != taken]
+    assigned = assign(free, others)
+    if not assigned:
+        return []
+
+    now = time.monotonic()
+    with _lock:
+        for key in [key for key, seen in _claimed.items() if now - seen >= HINT_TTL]:
+            del _claimed[key]
+        for other, slot in assigned:
+            _hints[id(other)] = Hint(office, slot, now)
+            _claimed[(*group_key(context), slot.value)] = now
+        listeners = list(_listeners)
+    for other, slot in assigned:
+        logging.info(f"[{context.name}] Slot {slot.day} {slot.at} is for [{other.name}]")
+        for listener in listeners:
+            listener(other)
+    return assigned
+
+
+def is_fresh(hint: Optional[Hint], ttl: float = HINT_TTL):
+    return hint is not None and time.monotonic() - hint.seen < ttl
+
+
+def hint_for(context) -> Optional[Hint]:
+    with _lock:
+        hint = _hints.get(id(context))
+    return hint if is_fresh(hint) else None
+
+
+def claimed_recently(context, value: str, ttl: float = HINT_TTL):
+    with _lock:
+        seen = _claimed.get((*group_key(context), value))
+    return seen is not None and time.monotonic() - seen < ttl
+
+
+def pick_slot(context, offered: List[Slot]):
+    # The slot promised to this profile if it's still there, otherwise the best one
+    # nobody else has been promised, and any acceptable one as a last resort
+    hint = hint_for(context)
+    if hint is not None:
+        with _lock:
+            _hints.pop(id(context), None)
+        for slot in offered:
+            if slot.value == hint.slot.value:
+                return slot.value
+
+    unclaimed = [s for s in offered if not claimed_recently(context, s.value)]
+    return context.constraints.best(unclaimed) or context.constraints.best(offered)
@@ -0,0 +1,142 @@
+import re
+from bisect import bisect_left
+from dataclasses import dataclass
+from datetime import date, datetime as dt, time, timedelta
+from itertools import islice
+from typing import Any, Iterable, List, NamedTuple, Optional, Sequence
+
+__all__ = ["Window", "SlotConstraints", "parse_when", "sort_slots"]
+
+DATE_RE = re.compile(r"\d{2}/\d{2}/\d{4}")
+TIME_RE = re.compile(r"\b\d{1,2}:\d{2}\b")
+DATE_FORMAT = "%d/%m/%Y"
+TIME_FORMAT = "%H:%M"
+ALL_WEEKDAYS = 0b1111111  # Monday is bit 0
+
+
+class Slot(NamedTuple):
+    day: date
+    at: Optional[time]
+    value: Any
+
+
+def parse_date(value: Optional[str]):
+    return dt.strptime(value, DATE_FORMAT).date() if value else None
+
+
+def parse_time(value: Optional[str]):
+    return dt.strptime(value, TIME_FORMAT).time() if value else None
+
+
+def parse_when(text: str):
+    # "LUNES 03/06/2024", "CITA 1 Día: 05/06/2024 Hora: 09:20 ..." or "03/06/2024 09:20"
+    found = DATE_RE.search(text)
+    if not found:
+        return None, None
+    at = TIME_RE.search(text, found.end()) or TIME_RE.search(text)
+    return parse_date(found.group()), parse_time(at.group()) if at else None
+
+
+@dataclass(frozen=True)
+class Window:
+    min_date: Optional[date] = None
+    max_date: Optional[date] = None
+    min_time: Optional[time] = None
+    max_time: Optional[time] = None
+    weekdays: int = ALL_WEEKDAYS
+    days_ahead: Optional[int] = None  # relative to the day the slot is offered
+
+    @classmethod
+    def parse(
+        cls,
+        min_date: Optional[str] = None,
+        max_date: Optional[str] = None,
+        min_time: Optional[str] = None,
+        max_time: Optional[str] = None,
+        weekdays: Optional[list] = None,
+        days_ahead: Optional[int] = None,
+    ):
+        mask = ALL_WEEKDAYS
+        if weekdays:
+            mask = 0
+            for day in weekdays:
+                assert 0 <= day <= 6, "Weekdays go from 0 (Monday) to 6 (Sunday)"
+                mask |= 1 << day
+
+        return cls(
+            parse_date(min_date),
+            parse_date(max_date),
+            parse_time(min_time),
+            parse_time(max_time),
+            mask,
+            days_ahead,
+        )
+
+    def is_open(self):
+        return self == Window()
+
+    def accepts(self, day: date, at: Optional[time] = None):
+        if self.min_date and day < self.min_date:
+            return False
+        if self.max_date and day > self.max_date:
+            return False
+        if self.days_ahead is not None and day > date.today() + timedelta(days=self.days_ahead):
+            return False
+        if not self.weekdays & (1 << day.weekday()):
+            return False
+        if at is not None:
+            if self.min_time and at < self.min_time:
+                return False
+            if self.max_time and at > self.max_time:
+                return False
+        return True
+
+
+class SlotConstraints:
+    def __init__(self, windows: List[Window]):
+        self.windows = windows or [Window()]
+        self.is_open = any(window.is_open() for window in self.windows)
+        starts = [window.min_date for window in self.windows]
+        self.earliest = None if None in starts else min(starts)  # type: ignore
+
+    @classmethod
+    def from_profile(cls, context):
+        windows = [
+            Window.parse(
+                context.min_date,
+                context.max_date,
+                context.min_time,
+                context.max_time,
+                context.weekdays,
+            )
+        ]
+        if context.windows:
+            windows = [Window.parse(**window) for window in context.windows]
+        return cls(windows)
+
+    def accepts(self, day: date, at: Optional[time] = None):
+        return any(window.accepts(day, at) for window in self.windows)
+
+    def best(self, slots: Sequence[Slot]):
+        # Slots must be sorted by date and time (see sort_slots): skip everything before
+        # the earliest window with a bisect, the first accepted slot after that is the best
+        start = 0
+        if self.earliest:
+            start = bisect_left(slots, self.earliest, key=lambda s: s.day)
+
+        for slot in islice(slots, start, None):
+            if self.is_open or self.accepts(slot.day, slot.at):
+                return slot.value
+        return None
+
+    def best_label(self, labels: Iterable[str]):
+        slots = []
+        for label in labels:
+            day, at = parse_when(label)
+            if day:
+                slots.append(Slot(day, at, label))
+        return self.best(sort_slots(slots))
+
+
+def sort_slots(slots: Iterable[Slot]) -> List[Slot]:
+    return sorted(slots, key=lambda s: (s.day, s.at or time.min))
@@ -0,0 +1,186 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+__all__ = ["ObservationStore", "PollingSchedule", "polling_schedule", "release_times"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS observations (
+    at REAL NOT NULL,
+    province TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    office TEXT NOT NULL DEFAULT '',
+    shown INTEGER NOT NULL,
+    slots INTEGER
+);
+CREATE INDEX IF NOT EXISTS observations_key ON observations (province, operation, office, at);
+"""
+
+DAY = 24 * 3600
+RELEASE_GAP = 900  # a closed observation older than this doesn't date a release
+MIN_RELEASES = 3  # fewer than this and there is nothing to learn yet
+DENSE_INTERVAL = 2.0  # seconds between polls around a likely release
+SPARSE_INTERVAL = 60.0
+LEAD = 60  # start polling densely this many seconds before a release
+TAIL = 120  # and keep going for this long after it
+
+Row = Tuple[float, str, bool, Optional[int]]  # (at, office, shown, slots)
+
+
+class ObservationStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def add(
+        self,
+        province: str,
+        operation: str,
+        shown: bool,
+        office: str = "",
+        slots: Optional[int] = None,
+        at: Optional[float] = None,
+    ):
+        self.add_many([(at or time.time(), province, operation, office, shown, slots)])
+
+    def add_many(self, rows: List[tuple]):
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO observations (at, province, operation, office, shown, slots) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(at, p, o, office, int(shown), slots) for at, p, o, office, shown, slots in rows],
+            )
+
+    def observations(
+        self, province: str, operation: str, office: Optional[str] = None, since: float = 0
+    ) -> List[Row]:
+        query = "SELECT at, office, shown, slots FROM observations WHERE province = ? AND operation = ? AND at >= ?"
+        params: list = [province, operation, since]
+        if office is not None:
+            # Rows without an office are about the whole province
+            query += " AND office IN (?, '')"
+            params.append(office)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY at", params).fetchall()
+        return [(at, office, bool(shown), slots) for at, office, shown, slots in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_stores: Dict[str, ObservationStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path: str) -> ObservationStore:
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = ObservationStore(path)
+        return _stores[path]
+
+
+def record(context, shown: bool, slots: Optional[int] = None, office: str = ""):
+    # Called from the booking flow, a broken store must never cost an attempt
+    if not context.history_path:
+        return
+    try:
+        get_store(context.history_path).add(
+            context.province.name, context.operation_code.name, shown, office, slots
+        )
+    except sqlite3.Error as e:
+        logging.error(f"Unable to record observation: {e}")
+
+
+def release_times(rows: List[Row], gap: float = RELEASE_GAP) -> List[float]:
+    # A release is the first time citas are shown right after they were seen closed
+    releases = []
+    closed_at = None
+    for at, _, shown, _ in rows:
+        if not shown:
+            closed_at = at
+        elif closed_at is not None:
+            if at - closed_at <= gap:
+                releases.append(at)
+            closed_at = None
+    return releases
+
+
+def second_of_day(when: datetime) -> int:
+    return when.hour * 3600 + when.minute * 60 + when.second
+
+
+@dataclass(frozen=True)
+class PollingSchedule:
+    windows: Tuple[Tuple[int, int], ...]  # (start, end) seconds of the local day, polled densely
+    releases: Tuple[int, ...] = ()  # learnt release moments, seconds of the local day
+    dense: float = DENSE_INTERVAL
+    sparse: float = SPARSE_INTERVAL
+
+    def interval_at(self, when: datetime) -> float:
+        now = second_of_day(when)
+        if any(start <= now < end for start, end in self.windows):
+            return self.dense
+        # Don't sleep through the start of the next window
+        upcoming = [(start - now) % DAY for start, _ in self.windows]
+        return max(min([self.sparse, *upcoming]), self.dense)
+
+    def exact_times(self) -> List[List[int]]:
+        # [[minute, second]] for CustomerProfile.wait_exact_time
+        return [list(t) for t in sorted({(s // 60 % 60, s % 60) for s in self.releases})]
+
+
+def build_schedule(
+    releases: List[float],
+    bin_seconds: int = 60,
+    min_releases: int = MIN_RELEASES,
+    min_share: float = 0.1,
+    lead: int = LEAD,
+    tail: int = TAIL,
+) -> Optional[PollingSchedule]:
+    if len(releases) < min_releases:
+        return None
+
+    bins = Counter(second_of_day(datetime.fromtimestamp(at)) // bin_seconds for at in releases)
+    threshold = max(2, min_share * len(releases))
+    hot = sorted(b for b, count in bins.items() if count >= threshold)
+    if not hot:
+        return None
+
+    windows: List[Tuple[int, int]] = []
+    for b in hot:
+        start, end = b * bin_seconds - lead, (b + 1) * bin_seconds + tail
+        if windows and start <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], end)
+        else:
+            windows.append((start, end))
+
+    # Split windows crossing midnight so each one is a plain range of the day
+    split: List[Tuple[int, int]] = []
+    for start, end in windows:
+        if start < 0:
+            split += [(start + DAY, DAY), (0, end)]
+        elif end > DAY:
+            split += [(start, DAY), (0, end - DAY)]
+        else:
+            split.append((start, end))
+    return PollingSchedule(tuple(split), tuple(b * bin_seconds for b in hot))
+
+
+def polling_schedule(
+    store: ObservationStore,
+    province: str,
+    operation: str,
+    office: Optional[str] = None,
+    days: int = 28,
+) -> Optional[PollingSchedule]:
+    rows = store.observations(province, operation, office, since=time.time() - days * DAY)
+    return build_schedule(release_times(rows))
@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+
+__all__ = ["Outcome", "Tracer", "tracer"]
+
+
+class Outcome(str, Enum):
+    BOOKED = "booked"
+    HANDED_OVER = "handed_over"  # slot taken, a human finishes the confirmation
+    NO_CITAS = "no_citas"
+    NO_OFFICES = "no_offices"
+    MISSED_SELECTION = "missed_selection"
+    NO_MATCHING_SLOT = "no_matching_slot"
+    CAPTCHA_FAILED = "captcha_failed"
+    MISSED_CONFIRMATION = "missed_confirmation"
+    CANCELLED = "cancelled"  # stopped before confirming, e.g. the queue lease was lost
+    TIMEOUT = "timeout"
+    ERROR = "error"
+    FAILED = "failed"  # ended early without a more specific reason
+
+
+@dataclass
+class AttemptTrace:
+    profile: str
+    province: str
+    operation: str
+    started_at: float
+    steps: List[dict] = field(default_factory=list)
+    outcome: Optional[str] = None
+    seconds: float = 0
+
+
+class Tracer:
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.step_seconds: Dict[Tuple[str, str, str], float] = defaultdict(float)
+        self.step_count: Dict[Tuple[str, str, str], int] = defaultdict(int)
+        self.attempt_seconds: Dict[Tuple[str, str], float] = defaultdict(float)
+        self.outcomes: Dict[Tuple[str, str, str], int] = defaultdict(int)
+
+    @property
+    def current(self) -> Optional[AttemptTrace]:
+        return getattr(self._local, "trace", None)
+
+    @contextmanager
+    def attempt(self, context):
+        trace = AttemptTrace(
+            context.name, context.province.name, context.operation_code.name, time.time()
+        )
+        self._local.trace = trace
+        self._local.paths = (context.trace_path, context.metrics_path)
+        self._local.started = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            self.finish()
+
+    @contextmanager
+    def step(self, name: str):
+        trace = self.current
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if trace is not None:
+                trace.steps.append(
+                    {"step": name, "seconds": round(time.perf_counter() - started, 3)}
+                )
+
+    def outcome(self, code: Outcome):
+        # The first, most specific reason wins
+        trace = self.current
+        if trace is not None and trace.outcome is None:
+            trace.outcome = code.value
+
+    def finish(self):
+        trace = self.current
+        if trace is None:
+            return
+        self._local.trace = None
+        trace.seconds = round(time.perf_counter() - self._local.started, 3)
+        trace.outcome = trace.outcome or Outcome.FAILED.value
+
+        with self._lock:
+            labels = (trace.province, trace.operation)
+            for step in trace.steps:
+                self.step_seconds[(step["step"], *labels)] += step["seconds"]
+                self.step_count[(step["step"], *labels)] += 1
+            self.attempt_seconds[labels] += trace.seconds
+            self.outcomes[(trace.outcome, *labels)] += 1
+
+            trace_path, metrics_path = self._local.paths
+            if trace_path:
+                with open(trace_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(asdict(trace), ensure_ascii=False) + "\n")
+            if metrics_path:
+                self._write(metrics_path, self.prometheus())
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP bcncita_step_seconds Time spent in each step of cycle_cita.",
+            "# TYPE bcncita_step_seconds summary",
+        ]
+        for (step, province, operation), total in sorted(self.step_seconds.items()):
+            labels = f'step="{step}",province="{province}",operation="{operation}"'
+            lines.append(f"bcncita_step_seconds_sum{{{labels}}} {total:.3f}")
+            lines.append(
+                f"bcncita_step_seconds_count{{{labels}}} {self.step_count[(step, province, operation)]}"
+            )
+
+        lines += [
+            "# HELP bcncita_attempt_seconds Time spent in whole attempts.",
+            "# TYPE bcncita_attempt_seconds counter",
+        ]
+        for (province, operation), total in sorted(self.attempt_seconds.items()):
+            labels = f'province="{province}",operation="{operation}"'
+            lines.append(f"bcncita_attempt_seconds_total{{{labels}}} {total:.3f}")
+
+        lines += [
+            "# HELP bcncita_attempts Attempts by outcome.",
+            "# TYPE bcncita_attempts counter",
+        ]
+        for (outcome, province, operation), count in sorted(self.outcomes.items()):
+            labels = f'outcome="{outcome}",province="{province}",operation="{operation}"'
+            lines.append(f"bcncita_attempts_total{{{labels}}} {count}")
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write(path: str, text: str):
+        # Scrapers must never see a half written file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+tracer = Tracer()
@@ -0,0 +1,230 @@
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime
+from enum import Enum
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from selenium import webdriver
+
+from .browserless import offered_offices, post, walk_forms
+from .cita import (
+    CustomerProfile,
+    Engine,
+    OperationType,
+    Province,
+    fast_forward_urls,
+    init_wedriver,
+)
+from .history import PollingSchedule, get_store, polling_schedule
+from .scheduler import run_profiles
+from .sessions import BrowserPool
+
+__all__ = ["Monitor", "Observation", "ProbeStatus", "probe"]
+
+PROBE_INTERVAL = 10  # seconds between probes of the same province and procedure
+SCHEDULE_TTL = 3600  # how often polling schedules are learnt again from the history
+ESCALATE_CYCLES = 3  # full attempts per waiting profile once citas show up
+
+
+class ProbeStatus(str, Enum):
+    CITAS = "citas"
+    NO_CITAS = "no_citas"
+    NO_OFFICES = "no_offices"
+    CAPTCHA = "captcha"  # the personal info form asks for one, can't look further
+    ERROR = "error"
+
+
+@dataclass
+class Observation:
+    at: float
+    province: str
+    operation: str
+    status: ProbeStatus
+    offices: List[str] = field(default_factory=list)  # idSede values with citas
+    seconds: float = 0
+
+
+def probe(context: CustomerProfile, fast_forward_url, fast_forward_url2) -> Observation:
+    # Instructions, personal info and one "Solicitar cita", nothing is booked or held
+    started = time.perf_counter()
+    observation = Observation(
+        time.time(), context.province.name, context.operation_code.name, ProbeStatus.ERROR
+    )
+    try:
+        walked = walk_forms(context, fast_forward_url, fast_forward_url2)
+        if walked is None:
+            pass
+        elif walked[0] == "personal":
+            observation.status = ProbeStatus.CAPTCHA
+        else:
+            page = post(context.http_session, walked[1])
+            if "Seleccione la oficina donde solicitar la cita" in page.text:
+                observation.offices = offered_offices(page)
+                # An office page without any office to pick is not an opening
+                observation.status = (
+                    ProbeStatus.CITAS if observation.offices else ProbeStatus.NO_OFFICES
+                )
+            elif "En este momento no hay citas disponibles" in page.text:
+                observation.status = ProbeStatus.NO_CITAS
+            else:
+                observation.status = ProbeStatus.NO_OFFICES
+    except Exception as e:
+        logging.error(f"Probe failed for {context.province.name}: {e}")
+
+    observation.seconds = round(time.perf_counter() - started, 3)
+    return observation
+
+
+def wants(context: CustomerProfile, offices: List[str]):
+    if context.offices:
+        return any(office.value in offices for office in context.offices)
+    return any(office not in (context.except_offices or []) for office in offices)
+
+
+class Monitor:
+    # One probe stream per province and procedure serves every profile waiting for it
+    def __init__(
+        self,
+        profiles: List[CustomerProfile],
+        interval: float = PROBE_INTERVAL,
+        pool_size: int = 2,
+        cycles: int = ESCALATE_CYCLES,
+        log_path: Optional[str] = None,
+        route: Callable[[CustomerProfile], Tuple[str, str]] = fast_forward_urls,
+        history_path: Optional[str] = None,
+    ):
+        # With a history the interval is only used until release times have been learnt
+        self.interval = interval
+        self.pool_size = pool_size
+        self.cycles = cycles
+        self.log_path = log_path
+        self.route = route
+        self.pool: Optional[BrowserPool] = None
+        self.booked: List[Tuple[CustomerProfile, webdriver.Chrome]] = []  # with their browser
+        self.observations: Deque[Observation] = deque(maxlen=1000)
+        self.waiting: Dict[Tuple[Province, OperationType], List[CustomerProfile]] = {}
+        self.probes: Dict[Tuple[Province, OperationType], CustomerProfile] = {}
+        for context in profiles:
+            key = (context.province, context.operation_code)
+            self.waiting.setdefault(key, []).append(context)
+            if key not in self.probes:
+                self.probes[key] = replace(context, engine=Engine.HTTP, http_session=None)
+        self._last: Dict[Tuple[Province, OperationType], ProbeStatus] = {}
+        self._due: Dict[Tuple[Province, OperationType], float] = {}
+        self._schedules: Dict[Tuple[Province, OperationType], tuple] = {}
+        # Attempts run beside the probes, one at a time per group
+        self.escalations: Dict[Tuple[Province, OperationType], Future] = {}
+        self.executor = ThreadPoolExecutor(
+            max(len(self.waiting), 1), thread_name_prefix="escalate"
+        )
+        history_path = history_path or (profiles[0].history_path if profiles else None)
+        self.store = get_store(history_path) if history_path else None
+
+    def run(self, duration: Optional[float] = None):
+        ends = None if duration is None else time.monotonic() + duration
+        try:
+            while self.waiting and (ends is None or time.monotonic() < ends):
+                self.collect()
+                now = time.monotonic()
+                self.poll([key for key in self.waiting if self._due.get(key, 0) <= now])
+                if self.waiting:
+                    next_due = min(self._due.get(key, 0) for key in self.waiting)
+                    time.sleep(max(next_due - time.monotonic(), 0))
+        finally:
+            # Attempts already started are let finish, a booking must not be thrown away
+            self.executor.shutdown(wait=True)
+            self.collect()
+            if self.pool is not None:
+                self.pool.close()
+        return self.booked
+
+    def poll(self, keys: Optional[list] = None):
+        for key in list(self.waiting) if keys is None else keys:
+            if key not in self.waiting:
+                continue
+            context = self.probes[key]
+            observation = probe(context, *self.route(context))
+            self.record(key, observation)
+            if observation.status == ProbeStatus.CITAS and key not in self.escalations:
+                self.escalate(key, observation.offices)
+            self._due[key] = time.monotonic() + self.interval_for(key)
+
+    def interval_for(self, key) -> float:
+        schedules = self.schedules(key)
+        if not schedules:
+            return self.interval
+        now = datetime.now()
+        return min(schedule.interval_at(now) for schedule in schedules)
+
+    def schedules(self, key) -> List[PollingSchedule]:
+        if self.store is None:
+            return []
+        learnt_at, schedules = self._schedules.get(key, (0, []))
+        if time.monotonic() - learnt_at < SCHEDULE_TTL:
+            return schedules
+
+        # One schedule per office somebody is waiting for, the province as a whole otherwise
+        offices = {o.value for c in self.waiting.get(key, []) for o in c.offices or []}
+        province, operation = key
+        schedules = [
+            schedule
+            for office in sorted(offices) or [None]
+            for schedule in [polling_schedule(self.store, province.name, operation.name, office)]
+            if schedule
+        ]
+        self._schedules[key] = (time.monotonic(), schedules)
+        return schedules
+
+    def record(self, key, observation: Observation):
+        self.observations.append(observation)
+        if self._last.get(key) != observation.status:
+            offices = f" {', '.join(observation.offices)}" if observation.offices else ""
+            logging.info(
+                f"[Monitor] {observation.province}/{observation.operation}: "
+                f"{observation.status.value}{offices}"
+            )
+        self._last[key] = observation.status
+        if self.store and observation.status in (ProbeStatus.CITAS, ProbeStatus.NO_CITAS):
+            at, province, operation = observation.at, observation.province, observation.operation
+            if observation.status == ProbeStatus.CITAS:
+                rows = [(office, True) for office in observation.offices]
+            else:
+                rows = [("", False)]
+            self.store.add_many([(at, province, operation, o, shown, None) for o, shown in rows])
+        if self.log_path:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(asdict(observation)) + "\n")
+
+    def escalate(self, key, offices: List[str]):
+        matching = [context for context in self.waiting[key] if wants(context, offices)]
+        if not matching:
+            return
+
+        if self.pool is None:
+            template = replace(matching[0], chrome_profile_path=None, chrome_profile_name=None)
+            self.pool = BrowserPool(lambda: init_wedriver(template), self.pool_size)
+        self.escalations[key] = self.executor.submit(
+            run_profiles, matching, cycles=self.cycles, pool=self.pool
+        )
+
+    def collect(self):
+        # Bookings are taken in on the probing thread, the waiting lists are only touched here
+        for key, future in list(self.escalations.items()):
+            if not future.done():
+                continue
+            del self.escalations[key]
+            try:
+                booked = future.result()
+            except Exception as e:
+                logging.error(f"[Monitor] Attempts failed for {key[0].name}: {e}")
+                continue
+
+            self.booked += booked
+            booked_ids = {id(context) for context, _ in booked}
+            self.waiting[key] = [c for c in self.waiting[key] if id(c) not in booked_ids]
+            if not self.waiting[key]:
+                del self.waiting[key]
@@ -0,0 +1,49 @@
+import io
+from importlib.util import find_spec
+from shutil import which
+from typing import Optional, Tuple, Union
+
+__all__ = ["TesseractOcr", "new_ocr"]
+
+MIN_CONFIDENCE = 80.0  # 0-100, anything below goes to Anti-Captcha
+
+Image = Union[bytes, memoryview]
+
+
+class TesseractOcr:
+    # pip install pytesseract pillow, plus the tesseract binary
+    @classmethod
+    def is_applicable(cls):
+        return bool(find_spec("pytesseract") and find_spec("PIL") and which("tesseract"))
+
+    def __init__(self, min_confidence: float = MIN_CONFIDENCE, config: str = "--psm 7"):
+        self.min_confidence = min_confidence
+        self.config = config
+
+    def read(self, image: Image) -> Tuple[str, float]:
+        import pytesseract
+        from PIL import Image as PILImage
+
+        with PILImage.open(io.BytesIO(image)) as picture:
+            data = pytesseract.image_to_data(
+                picture, config=self.config, output_type=pytesseract.Output.DICT
+            )
+        words = [
+            (text.strip(), float(conf))
+            for text, conf in zip(data["text"], data["conf"])
+            if text.strip() and float(conf) >= 0
+        ]
+        if not words:
+            return "", 0.0
+        return "".join(text for text, _ in words), min(conf for _, conf in words)
+
+    def solve(self, image: Image) -> Optional[str]:
+        text, confidence = self.read(image)
+        return text if text and confidence >= self.min_confidence else None
+
+
+def new_ocr(min_confidence: float = MIN_CONFIDENCE):
+    for cls in [TesseractOcr]:
+        if cls.is_applicable():
+            return cls(min_confidence)
+    return None
@@ -0,0 +1,46 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .claims import hint_for
+from .profile import OperationType
+
+__all__ = ["mark_empty", "rank_offices"]
+
+EMPTY_TTL = 60  # an office that had no slots isn't tried again for this long
+
+_empty: Dict[Tuple[str, str, str], float] = {}
+_empty_lock = threading.Lock()
+
+
+def office_key(context, office: str):
+    return (context.province.name, context.operation_code.name, office)
+
+
+def mark_empty(context, office: Optional[str]):
+    # Seen on the offices list, but the slot page came back without citas
+    if office:
+        with _empty_lock:
+            _empty[office_key(context, office)] = time.monotonic()
+
+
+def empty_recently(context, office: str, ttl: float = EMPTY_TTL):
+    with _empty_lock:
+        seen = _empty.get(office_key(context, office))
+    return seen is not None and time.monotonic() - seen < ttl
+
+
+def rank_offices(context, available: List[str]) -> List[str]:
+    # Preferred offices in the profile's order, then the rest in the page's order
+    preferred = [o.value for o in context.offices or [] if o.value in available]
+    if context.offices and context.operation_code == OperationType.RECOGIDA_DE_TARJETA:
+        candidates = preferred
+    else:
+        rest = [o for o in available if o not in preferred]
+        candidates = preferred + [o for o in rest if o not in (context.except_offices or [])]
+    ranked = [o for o in candidates if not empty_recently(context, o)]
+    hint = hint_for(context)
+    if hint is not None and hint.office in candidates:
+        # Another session has just seen a slot for this profile there
+        ranked = [hint.office] + [o for o in ranked if o != hint.office]
+    return ranked
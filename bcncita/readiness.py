@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Optional
+
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.support.wait import WebDriverWait
+
+__all__ = ["LoadTimes", "load_times", "wait_ready"]
+
+# Milliseconds since the last resource finished loading, or -1 while the document is loading
+SETTLED_SCRIPT = """
+if (document.readyState !== 'complete') return -1;
+if (window.jQuery && window.jQuery.active > 0) return -1;
+const entries = performance.getEntriesByType('resource');
+const last = entries.reduce((acc, e) => Math.max(acc, e.responseEnd), 0);
+return performance.now() - last;
+"""
+
+
+class LoadTimes:
+    # Timeouts follow recent page loads instead of a fixed guess
+    def __init__(
+        self, window: int = 50, factor: float = 3.0, floor: float = 5, ceiling: float = 60
+    ):
+        self.factor = factor
+        self.floor = floor
+        self.ceiling = ceiling
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def timeout(self) -> float:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return self.ceiling
+
+        p90 = samples[min(len(samples) - 1, int(len(samples) * 0.9))]
+        return min(max(p90 * self.factor, self.floor), self.ceiling)
+
+
+load_times = LoadTimes()
+
+
+def page_settled(idle: float):
+    def check(driver: webdriver):
+        try:
+            quiet = driver.execute_script(SETTLED_SCRIPT)
+        except WebDriverException:
+            # Navigation in progress, the old document is gone
+            return False
+        return quiet is not None and quiet >= idle * 1000
+
+    return check
+
+
+def wait_ready(driver: webdriver, timeout: Optional[float] = None, idle: float = 0.3):
+    start = time.monotonic()
+    try:
+        WebDriverWait(driver, timeout or load_times.timeout(), poll_frequency=0.1).until(
+            page_settled(idle)
+        )
+    except TimeoutException:
+        logging.info("Timed out waiting for page to settle")
+        return False
+
+    load_times.record(time.monotonic() - start)
+    return True
@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import re
+import time
+from dataclasses import asdict, dataclass
+from html.parser import HTMLParser
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+from .profile import ICP_URL, OperationType, Province
+
+if TYPE_CHECKING:
+    import requests
+
+__all__ = ["ROUTES", "Route", "parse_citar", "refresh_routes", "route_urls"]
+
+ROUTES_TTL = 24 * 3600  # the site moves procedures between groups rarely
+CATEGORY_RE = re.compile(r"^icp[a-z]*$")
+PARAM_RE = re.compile(r"^tramiteGrupo\[\d\]$")
+
+
+@dataclass(frozen=True)
+class Route:
+    category: str = "icpplus"  # path prefix of the province's pages
+    param: str = "tramiteGrupo[1]"  # select listing the procedure on the citar page
+
+    def urls(self, province: Province, operation: OperationType) -> Tuple[str, str]:
+        return (
+            f"{ICP_URL}/{self.category}/citar?p={province.value}",
+            f"{ICP_URL}/{self.category}/acInfo?{self.param}={operation.value}",
+        )
+
+
+PROVINCE_ROUTES = {
+    Province.BARCELONA: Route("icpplustieb", "tramiteGrupo[0]"),
+    Province.ALICANTE: Route("icpco"),
+    Province.ILLES_BALEARS: Route("icpco"),
+    Province.LAS_PALMAS: Route("icpco"),
+    Province.S_CRUZ_TENERIFE: Route("icpco"),
+    Province.MADRID: Route("icpplustiem"),
+    Province.MÁLAGA: Route("icpco", "tramiteGrupo[0]"),
+    Province.MELILLA: Route("icpplus", "tramiteGrupo[0]"),
+    Province.SEVILLA: Route("icpplus", "tramiteGrupo[0]"),
+}
+
+RouteKey = Tuple[Province, OperationType]
+ROUTES: Dict[RouteKey, Route] = {
+    (province, operation): PROVINCE_ROUTES.get(province, Route())
+    for province in Province
+    for operation in OperationType
+}
+URLS: Dict[RouteKey, Tuple[str, str]] = {}
+
+
+def validate_routes(routes: Dict[RouteKey, Route]):
+    for province in Province:
+        for operation in OperationType:
+            route = routes.get((province, operation))
+            if route is None:
+                raise ValueError(f"No route for {province.name}/{operation.name}")
+            if not CATEGORY_RE.match(route.category) or not PARAM_RE.match(route.param):
+                raise ValueError(f"Bad route for {province.name}/{operation.name}: {route}")
+
+
+def update_routes(routes: Dict[RouteKey, Route]):
+    validate_routes({**ROUTES, **routes})
+    ROUTES.update(routes)
+    URLS.update({key: route.urls(*key) for key, route in routes.items()})
+
+
+update_routes(dict(ROUTES))
+
+
+def route_urls(province: Province, operation: OperationType) -> Tuple[str, str]:
+    return URLS[(province, operation)]
+
+
+class CitarParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.action: Optional[str] = None
+        self.options: Dict[str, str] = {}  # procedure code -> select name
+        self._select: Optional[str] = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {k: v or "" for k, v in attrs}
+        if tag == "form" and self.action is None:
+            self.action = attrs.get("action", "")
+        elif tag == "select" and PARAM_RE.match(attrs.get("name", "")):
+            self._select = attrs["name"]
+        elif tag == "option" and self._select:
+            self.options.setdefault(attrs.get("value", ""), self._select)
+
+    def handle_endtag(self, tag):
+        if tag == "select":
+            self._select = None
+
+
+def parse_citar(url: str, html: str) -> Dict[OperationType, Route]:
+    # The province page lists every procedure it offers under one of the tramiteGrupo selects
+    parser = CitarParser()
+    parser.feed(html)
+    if parser.action is None:
+        return {}
+
+    category = urlsplit(urljoin(url, parser.action)).path.strip("/").split("/")[0]
+    codes = {operation.value: operation for operation in OperationType}
+    return {
+        codes[code]: Route(category, param)
+        for code, param in parser.options.items()
+        if code in codes
+    }
+
+
+def refresh_routes(
+    cache_path: Optional[str] = None,
+    ttl: float = ROUTES_TTL,
+    provinces: Optional[Iterable[Province]] = None,
+    session: Optional["requests.Session"] = None,
+    base: str = ICP_URL,
+):
+    # Reads the cache if it is fresh, otherwise scrapes citar?p= for each province
+    if cache_path and load_routes(cache_path, ttl):
+        return True
+
+    import requests
+
+    from .cita import DELAY, USER_AGENT
+
+    session = session or requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    scraped: Dict[RouteKey, Route] = {}
+    for province in provinces or Province:
+        category = ROUTES[(province, OperationType.TOMA_HUELLAS)].category
+        url = f"{base}/{category}/citar?p={province.value}"
+        try:
+            resp = session.get(url, timeout=DELAY)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            logging.error(f"Unable to refresh routes for {province.name}: {e}")
+            continue
+
+        offered = parse_citar(resp.url, resp.text)
+        if not offered:
+            logging.error(f"No procedures found for {province.name}, keeping its routes")
+            continue
+        scraped.update({(province, operation): route for operation, route in offered.items()})
+
+    if not scraped:
+        return False
+    update_routes(scraped)
+    if cache_path:
+        save_routes(cache_path, scraped)
+    return True
+
+
+def save_routes(path: str, routes: Dict[RouteKey, Route]):
+    entries: List[dict] = [
+        {"province": province.name, "operation": operation.name, **asdict(route)}
+        for (province, operation), route in routes.items()
+    ]
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"fetched_at": time.time(), "routes": entries}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def load_routes(path: str, ttl: float = ROUTES_TTL):
+    try:
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if time.time() - cached.get("fetched_at", 0) > ttl:
+        return False
+
+    try:
+        routes = {
+            (Province[e["province"]], OperationType[e["operation"]]): Route(
+                e["category"], e["param"]
+            )
+            for e in cached["routes"]
+        }
+        update_routes(routes)
+    except (KeyError, TypeError, ValueError) as e:
+        logging.error(f"Ignoring broken routes cache {path}: {e}")
+        return False
+    return True
@@ -0,0 +1,158 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Deque, Dict, List, Optional, Tuple
+
+from selenium import webdriver
+
+from . import claims
+from .captcha import presolving
+from .checkpoint import end_run, is_booked, resume
+from .cita import CYCLES, CustomerProfile, Province, fast_forward_urls, init_wedriver, run_attempt
+from .sessions import BrowserPool
+from .sms import clear_inbox
+
+__all__ = ["run_profiles"]
+
+
+@dataclass
+class Job:
+    context: CustomerProfile
+    fast_forward_url: str
+    fast_forward_url2: str
+    attempt: int = 0
+
+
+class ProvinceQueue:
+    # Round-robin over provinces so a crowded province can't starve the others
+    def __init__(self, max_per_province: Optional[int] = None):
+        self.max_per_province = max_per_province
+        self._jobs: "OrderedDict[Province, Deque[Job]]" = OrderedDict()
+        self._running: Dict[Province, int] = {}
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self._jobs.values())
+
+    def put(self, job: Job):
+        self._jobs.setdefault(job.context.province, deque()).append(job)
+
+    def pop(self) -> Optional[Job]:
+        # A profile another session has found a slot for goes first, regardless of the cap
+        for province, jobs in self._jobs.items():
+            for job in jobs:
+                if claims.hint_for(job.context) is not None:
+                    jobs.remove(job)
+                    self._running[province] = self._running.get(province, 0) + 1
+                    return job
+
+        for province in list(self._jobs):
+            jobs = self._jobs[province]
+            running = self._running.get(province, 0)
+            if not jobs or (self.max_per_province and running >= self.max_per_province):
+                continue
+
+            self._jobs.move_to_end(province)
+            self._running[province] = running + 1
+            return jobs.popleft()
+
+        return None
+
+    def done(self, job: Job):
+        self._running[job.context.province] -= 1
+
+
+def run_profiles(
+    profiles: List[CustomerProfile],
+    pool_size: int = 4,
+    max_per_province: Optional[int] = None,
+    cycles: int = CYCLES,
+    pool: Optional[BrowserPool] = None,
+):
+    # Returns (profile, browser) for every booking, the browser is left open on the
+    # confirmation for whoever finishes it and quits it
+    if not profiles:
+        return []
+
+    logging.basicConfig(
+        format="%(asctime)s - %(message)s", level=logging.INFO, **profiles[0].log_settings  # type: ignore
+    )
+
+    own_pool = pool is None
+    if pool is None:
+        # Chrome refuses to share a user-data-dir between running instances
+        template = replace(profiles[0], chrome_profile_path=None, chrome_profile_name=None)
+        pool = BrowserPool(lambda: init_wedriver(template), pool_size)
+
+    queue = ProvinceQueue(max_per_province)
+    for context in profiles:
+        if is_booked(context):
+            continue
+        context.exit_on_success = False
+        clear_inbox(context)
+        # Pooled browsers are shared, only the attempt counter is resumed
+        queue.put(Job(context, *fast_forward_urls(context), attempt=resume(context)))
+        claims.wait(context)
+
+    cond = threading.Condition()
+    running = 0
+    booked: List[Tuple[CustomerProfile, webdriver.Chrome]] = []
+
+    def attempt(job: Job):
+        result, driver = None, None
+        try:
+            driver = pool.acquire(job.context)
+            logging.info(f"\033[33m[{job.context.name}] [Attempt {job.attempt}/{cycles}]\033[0m")
+            result = run_attempt(driver, job.context, job.fast_forward_url, job.fast_forward_url2)
+            if result:
+                # Leave the winning browser open for the confirmation
+                pool.discard(driver, quit=False)
+            else:
+                pool.release(driver)
+        except Exception as e:
+            logging.error(f"SMTH BROKEN: {e}")
+            if driver is not None:
+                # The pool slot must be freed or the run waits for it forever
+                pool.discard(driver)
+
+        nonlocal running
+        with cond:
+            running -= 1
+            queue.done(job)
+            if result:
+                logging.info(f"[{job.context.name}] WIN")
+                booked.append((job.context, driver))
+                claims.leave(job.context)
+            elif job.attempt < cycles:
+                queue.put(job)
+            else:
+                logging.error(f"[{job.context.name}] FAIL")
+                end_run(job.context)
+                claims.leave(job.context)
+            cond.notify()
+
+    def wake(context):
+        with cond:
+            cond.notify()
+
+    claims.on_hint(wake)
+
+    try:
+        with presolving(profiles), ThreadPoolExecutor(max_workers=pool.size) as executor:
+            with cond:
+                while len(queue) or running:
+                    job = queue.pop() if running < pool.size else None
+                    if job is None:
+                        cond.wait()
+                        continue
+
+                    running += 1
+                    job.attempt += 1
+                    executor.submit(attempt, job)
+    finally:
+        claims.remove_listener(wake)
+        if own_pool:
+            pool.close()
+
+    return booked
@@ -0,0 +1,184 @@
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from queue import Empty, Queue
+from typing import Any, Callable, Dict, List, Optional
+
+from selenium import webdriver
+
+__all__ = ["BrowserPool", "is_poisoned"]
+
+# Pages that mean the server side session is burnt and only a cold reset helps
+POISONED_MARKERS = [
+    "The requested URL was rejected",
+    "Request Rejected",
+    "Too Many Requests",
+    "Access Denied",
+    "Su sesión ha caducado",
+    "ERROR 500",
+]
+
+
+def is_poisoned(page_text: str):
+    return any(marker in page_text for marker in POISONED_MARKERS)
+
+
+@dataclass
+class SessionStats:
+    uses: int = 0
+    baseline_memory: Optional[int] = None
+    owner: Any = None
+
+
+class BrowserPool:
+    def __init__(
+        self,
+        factory: Callable[[], webdriver.Chrome],
+        size: int,
+        max_uses: int = 300,
+        max_memory_growth: float = 3.0,
+    ):
+        self.factory = factory
+        self.size = size
+        self.max_uses = max_uses
+        self.max_memory_growth = max_memory_growth
+        self._idle: Queue = Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._stats: Dict[int, SessionStats] = {}
+
+    def acquire(self, context):
+        while True:
+            driver = self._take()
+            if self.healthy(driver):
+                break
+            logging.info("Browser session is not responding, replacing it")
+            self.discard(driver)
+
+        stats = self._stats.setdefault(id(driver), SessionStats())
+        # Another customer's cookies must not leak into this attempt
+        if stats.owner is not context:
+            context.first_load = True
+        stats.owner = context
+        stats.uses += 1
+        return driver
+
+    def _take(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if not create:
+            return self._idle.get()
+
+        try:
+            return self.factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def release(self, driver: webdriver.Chrome):
+        stats = self._stats.get(id(driver), SessionStats())
+        if stats.uses >= self.max_uses:
+            logging.info(f"Recycling browser session after {stats.uses} uses")
+            self.discard(driver)
+            return
+
+        memory = self.memory(driver)
+        if memory and stats.baseline_memory is None:
+            stats.baseline_memory = memory
+        elif (
+            memory
+            and stats.baseline_memory
+            and memory > stats.baseline_memory * self.max_memory_growth
+        ):
+            logging.info(f"Recycling browser session, Chrome grew to {memory / 2**20:0.1f} MB")
+            self.discard(driver)
+            return
+
+        self._idle.put(driver)
+
+    def discard(self, driver: webdriver.Chrome, quit: bool = True):
+        self._stats.pop(id(driver), None)
+        with self._lock:
+            self._created -= 1
+        if quit:
+            try:
+                driver.quit()
+            except Exception as e:
+                logging.error(e)
+
+    def close(self):
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except Empty:
+                break
+            self.discard(driver)
+
+    @staticmethod
+    def healthy(driver: webdriver.Chrome):
+        # Cheapest round trip through chromedriver into the browser process
+        try:
+            driver.execute_cdp_cmd("Browser.getVersion", {})
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def memory(driver: webdriver.Chrome) -> Optional[int]:
+        # Chrome runs as children of chromedriver: the browser, its renderers and the GPU process
+        try:
+            pid = driver.service.process.pid
+        except AttributeError:
+            return None  # a remote browser
+        return process_tree_rss(pid)
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+    # Resident memory of a process and everything under it, in bytes
+    try:
+        import psutil
+    except ImportError:
+        return proc_tree_rss(pid)
+    try:
+        root = psutil.Process(pid)
+        return sum(p.memory_info().rss for p in [root, *root.children(recursive=True)])
+    except psutil.Error:
+        return None
+
+
+def proc_tree_rss(pid: int) -> Optional[int]:
+    # Linux without psutil
+    if not os.path.isdir("/proc"):
+        return None
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    total, todo = 0, [pid]
+    while todo:
+        current = todo.pop()
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, IndexError, ValueError):
+            if current == pid:
+                return None
+            continue
+        todo += children.get(current, [])
+    return total
@@ -0,0 +1,138 @@
+import logging
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from typing import List, Optional
+
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+
+from .constraints import Slot, parse_when, sort_slots
+
+__all__ = ["SlotTable", "extract_slot_table", "parse_slot_table", "extract_slot_labels"]
+
+SLOT_TABLE_SCRIPT = """
+const table = document.getElementById('CitaMAP_HORAS');
+if (!table) return null;
+const dates = [...table.querySelectorAll('thead [class^=colFecha]')].map(el => el.innerText.trim());
+const rows = [...table.querySelectorAll('tbody tr')].map(row => {
+    const th = row.querySelector('th');
+    return {
+        time: th ? th.innerText.trim() : '',
+        slots: [...row.querySelectorAll('td')].map(td => {
+            const hueco = td.querySelector('[id^=HUECO]');
+            return hueco ? hueco.id : null;
+        }),
+    };
+});
+return {dates: dates, rows: rows};
+"""
+
+SLOT_LABELS_SCRIPT = """
+return [...document.querySelectorAll('[id^=lCita_]')].map(el => el.innerText);
+"""
+
+
+@dataclass
+class SlotRow:
+    time: str
+    slots: List[Optional[str]]
+
+
+@dataclass
+class SlotTable:
+    dates: List[str] = field(default_factory=list)
+    rows: List[SlotRow] = field(default_factory=list)
+
+    @classmethod
+    def from_json(cls, data: Optional[dict]):
+        if not data:
+            return cls()
+        rows = [SlotRow(row["time"], row["slots"]) for row in data["rows"]]
+        return cls(data["dates"], rows)
+
+    def slot_list(self) -> List[Slot]:
+        # Sorted once here, SlotConstraints.best bisects it as is
+        slots = []
+        for row in self.rows:
+            for date, slot in zip(self.dates, row.slots):
+                if slot:
+                    day, at = parse_when(f"{date} {row.time}")
+                    if day:
+                        slots.append(Slot(day, at, slot))
+        return sort_slots(slots)
+
+
+class SlotTableParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.table = SlotTable()
+        self._root = ""  # tag carrying id=CitaMAP_HORAS
+        self._depth = 0  # > 0 while inside it
+        self._section = ""
+        self._cell: Optional[str] = None
+        self._text: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if not self._depth:
+            if attrs.get("id") == "CitaMAP_HORAS":
+                self._root = tag
+                self._depth = 1
+            return
+        if tag == self._root:
+            self._depth += 1
+
+        if tag in ("thead", "tbody"):
+            self._section = tag
+        elif tag == "tr" and self._section == "tbody":
+            self.table.rows.append(SlotRow("", []))
+        elif tag == "th":
+            if self._section == "thead" and (attrs.get("class") or "").startswith("colFecha"):
+                self._cell = "date"
+                self._text = []
+            elif self._section == "tbody" and self.table.rows and not self.table.rows[-1].time:
+                self._cell = "time"
+                self._text = []
+        elif tag == "td" and self._section == "tbody" and self.table.rows:
+            self.table.rows[-1].slots.append(None)
+        elif (attrs.get("id") or "").startswith("HUECO") and self.table.rows:
+            row = self.table.rows[-1]
+            if row.slots and row.slots[-1] is None:
+                row.slots[-1] = attrs["id"]
+
+    def handle_endtag(self, tag):
+        if not self._depth:
+            return
+        if tag == self._root:
+            self._depth -= 1
+        elif tag == "th" and self._cell:
+            text = " ".join("".join(self._text).split())
+            if self._cell == "date":
+                self.table.dates.append(text)
+            elif self.table.rows:
+                self.table.rows[-1].time = text
+            self._cell = None
+
+    def handle_data(self, data):
+        if self._cell:
+            self._text.append(data)
+
+
+def extract_slot_table(driver: webdriver) -> SlotTable:
+    try:
+        return SlotTable.from_json(driver.execute_script(SLOT_TABLE_SCRIPT))
+    except (WebDriverException, KeyError, TypeError) as e:
+        # Slower, but the page source is there even when the script can't run
+        logging.error(f"Slot table script failed, parsing the page instead: {e}")
+        return parse_slot_table(driver.page_source)
+
+
+def parse_slot_table(html: str) -> SlotTable:
+    parser = SlotTableParser()
+    parser.feed(html)
+    parser.close()
+    return parser.table
+
+
+def extract_slot_labels(driver: webdriver) -> List[str]:
+    return driver.execute_script(SLOT_LABELS_SCRIPT) or []
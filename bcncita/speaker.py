@@ -1,36 +1,169 @@
-import os
+import atexit
+import json
+import logging
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from collections import deque
+from datetime import datetime
+from queue import Queue
 from shutil import which
+from typing import Deque, Dict, List, Optional
 
+__all__ = ["BellSink", "FileSink", "Notifier", "WebhookSink", "new_speaker", "notifier"]
+
+DEDUP_SECONDS = 10  # the same phrase again within this window is dropped
+MAX_PER_MINUTE = 20
+FLUSH_TIMEOUT = 10  # seconds given to pending alerts when the process exits
+
+
+class TtsSink:
+    command = ""
+    audible = True
 
-class eSpeakSpeaker:
     @classmethod
     def is_applicable(cls):
-        return which("espeak") is not None
+        return which(cls.command) is not None
 
     def say(self, phrase):
-        os.system("espeak '" + phrase + "'")
+        # No shell, so the phrase can't break out of the command line
+        subprocess.run(
+            [self.command, phrase],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=60,
+        )
+
+
+class eSpeakSpeaker(TtsSink):
+    command = "espeak"
+
+
+class saySpeaker(TtsSink):
+    command = "say"
+
 
+class wSaySpeaker(TtsSink):
+    command = "wsay"
+
+
+class BellSink:
+    audible = True
 
-class saySpeaker:
     @classmethod
     def is_applicable(cls):
-        return which("say") is not None
+        return True
 
     def say(self, phrase):
-        os.system("say '" + phrase + "'")
+        sys.stdout.write(f"\a{phrase}\n")
+        sys.stdout.flush()
 
 
-class wSaySpeaker:
-    @classmethod
-    def is_applicable(cls):
-        return which("wsay") is not None
+class FileSink:
+    audible = False
+
+    def __init__(self, path: str):
+        self.path = path
 
     def say(self, phrase):
-        os.system('wsay "' + phrase + '"')
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(f"{datetime.now().isoformat(timespec='seconds')} {phrase}\n")
+
 
+class WebhookSink:
+    audible = False
 
-def new_speaker():
+    def __init__(self, url: str, timeout: float = 5):
+        self.url = url
+        self.timeout = timeout
+
+    def say(self, phrase):
+        body = json.dumps({"text": phrase, "at": time.time()}).encode()
+        request = urllib.request.Request(
+            self.url, data=body, headers={"Content-Type": "application/json"}
+        )
+        urllib.request.urlopen(request, timeout=self.timeout).close()
+
+
+def default_sinks():
     for cls in [eSpeakSpeaker, saySpeaker, wSaySpeaker]:
         if cls.is_applicable():
-            return cls()
-    raise ValueError("Please download wsay (Windows) or espeak (Linux). See README for more info")
+            return [cls()]
+    logging.error("No espeak (Linux) or wsay (Windows) found, alerts go to the terminal bell")
+    return [BellSink()]
+
+
+class Notifier:
+    # say() only queues the alert, a background thread talks to the sinks
+    def __init__(
+        self,
+        sinks: Optional[list] = None,
+        dedup_seconds: float = DEDUP_SECONDS,
+        max_per_minute: int = MAX_PER_MINUTE,
+    ):
+        self.sinks = sinks  # found on the first alert when not given
+        self.dedup_seconds = dedup_seconds
+        self.max_per_minute = max_per_minute
+        self._queue: Queue = Queue()
+        self._lock = threading.Lock()
+        self._last: Dict[str, float] = {}
+        self._sent: Deque[float] = deque()
+        self._thread: Optional[threading.Thread] = None
+
+    def add_sink(self, sink):
+        with self._lock:
+            self.sinks = (default_sinks() if self.sinks is None else self.sinks) + [sink]
+
+    def say(self, phrase: str, repeat: int = 1):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last.get(phrase, -self.dedup_seconds) < self.dedup_seconds:
+                return
+            while self._sent and now - self._sent[0] > 60:
+                self._sent.popleft()
+            if len(self._sent) >= self.max_per_minute:
+                return
+            self._last[phrase] = now
+            self._sent.append(now)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        self._queue.put((phrase, repeat))
+
+    def flush(self, timeout: float = FLUSH_TIMEOUT):
+        ends = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < ends:
+            time.sleep(0.05)
+
+    def _run(self):
+        while True:
+            phrase, repeat = self._queue.get()
+            try:
+                self._dispatch(phrase, repeat)
+            finally:
+                self._queue.task_done()
+
+    def _dispatch(self, phrase: str, repeat: int):
+        with self._lock:
+            if self.sinks is None:
+                self.sinks = default_sinks()
+            sinks: List = list(self.sinks)
+
+        for sink in sinks:
+            for _ in range(repeat if sink.audible else 1):
+                try:
+                    sink.say(phrase)
+                except Exception as e:
+                    logging.error(f"Unable to send alert to {type(sink).__name__}: {e}")
+                    break
+
+
+notifier = Notifier()
+
+
+def new_speaker(sinks: Optional[list] = None) -> Notifier:
+    return Notifier(sinks)
@@ -0,0 +1,165 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from .profile import ICP_URL
+
+if sys.platform == "win32":
+    import msvcrt
+
+    def lock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+    def unlock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+else:
+    import fcntl
+
+    def lock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def unlock_file(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+__all__ = ["RateLimiter", "is_throttled", "pace", "rate_limiter", "report", "retry_after"]
+
+RATE = 1.0  # navigations per second for all bots on this machine, 0 disables the limiter
+BURST = 10
+MIN_RATE = 1 / 60
+RATE_STEP = 0.05  # added to the rate after every good page
+RATE_FACTOR = 0.5  # applied to the rate when the site throttles us
+MAX_COOLDOWN = 350  # longest pause after repeated failures
+MAX_SLEEP = 5  # re-read the shared state at least this often while waiting
+THROTTLED_DOMAINS = ("administracionelectronica.gob.es",)
+THROTTLED_STATUSES = (429, 503)
+THROTTLED_MARKERS = [
+    "Too Many Requests",
+    "The requested URL was rejected",
+    "Request Rejected",
+    "Access Denied",
+]
+
+
+class RateLimiter:
+    # Token bucket with AIMD rate control, the state lives in a file shared by every process
+    def __init__(self, path: str, rate: float = RATE, burst: int = BURST):
+        self.path = path
+        self.max_rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _state(self):
+        with self._lock, open(self.path, "a+", encoding="utf-8") as f:
+            lock_file(f)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+
+                now = time.time()
+                rate = state.get("rate", self.max_rate)
+                elapsed = max(now - state.get("updated", now), 0)
+                state["tokens"] = min(self.burst, state.get("tokens", self.burst) + elapsed * rate)
+                state.update(rate=rate, updated=now)
+                state.setdefault("cooldown_until", 0)
+                state.setdefault("failures", 0)
+                yield state
+
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                unlock_file(f)
+
+    def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            with self._state() as state:
+                wait = max(
+                    state["cooldown_until"] - state["updated"],
+                    (1 - state["tokens"]) / state["rate"],
+                )
+                if wait <= 0:
+                    state["tokens"] -= 1
+                    return waited
+            # A little jitter so the waiting processes don't all wake up together
+            wait = min(wait, MAX_SLEEP) * random.uniform(1, 1.1)
+            time.sleep(wait)
+            waited += wait
+
+    def success(self):
+        with self._state() as state:
+            state["rate"] = min(state["rate"] + RATE_STEP, self.max_rate)
+            state["failures"] = 0
+
+    def failure(self):
+        with self._state() as state:
+            now = state["updated"]
+            if now < state["cooldown_until"]:
+                return  # Other bots already reported this one
+            state["failures"] += 1
+            state["rate"] = max(state["rate"] * RATE_FACTOR, MIN_RATE)
+            state["cooldown_until"] = now + min(2 ** state["failures"], MAX_COOLDOWN)
+            state["tokens"] = 0
+
+    def retry_after(self) -> float:
+        with self._state() as state:
+            return max(state["cooldown_until"] - state["updated"], 0)
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def rate_limiter(url: str = ICP_URL) -> Optional[RateLimiter]:
+    host = urlsplit(url).hostname or ""
+    if RATE <= 0 or not host.endswith(THROTTLED_DOMAINS):
+        return None
+    with _limiters_lock:
+        if host not in _limiters:
+            path = os.path.join(tempfile.gettempdir(), f"bcncita-{host}.rate")
+            _limiters[host] = RateLimiter(path)
+        return _limiters[host]
+
+
+def pace(url: str = ICP_URL):
+    # Call before every navigation: page loads, refreshes and form submissions
+    limiter = rate_limiter(url)
+    if limiter:
+        limiter.acquire()
+
+
+def is_throttled(page_text: str, status: Optional[int] = None) -> bool:
+    # Only the site pushing back counts against the shared rate. A slow page or a hung
+    # chromedriver is this bot's problem and mustn't slow down every other one.
+    if status in THROTTLED_STATUSES:
+        return True
+    return not page_text.strip() or any(marker in page_text for marker in THROTTLED_MARKERS)
+
+
+def report(ok: bool, url: str = ICP_URL):
+    limiter = rate_limiter(url)
+    if limiter and ok:
+        limiter.success()
+    elif limiter:
+        limiter.failure()
+
+
+def retry_after(url: str = ICP_URL) -> float:
+    limiter = rate_limiter(url)
+    return max(limiter.retry_after(), 1) if limiter else MAX_COOLDOWN
@@ -0,0 +1,482 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, fields, replace
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .profile import CustomerProfile, DocType, Engine, Office, OperationType, Province
+
+__all__ = ["Lease", "QueueBackend", "RedisQueue", "SQLiteQueue", "enqueue", "run_worker"]
+
+LEASE_SECONDS = 120  # a job whose worker stops heartbeating is claimed again after this
+HEARTBEAT_SECONDS = 30
+LEASE_CYCLES = 12  # attempts per claim, then the job goes back so every profile gets a turn
+IDLE_SECONDS = 10  # wait between claims when the queue is empty
+MAX_ATTEMPTS = 144
+
+ENUMS = {
+    "doc_type": DocType,
+    "province": Province,
+    "operation_code": OperationType,
+    "engine": Engine,
+}
+# Objects and runtime state stay on the node, see run_worker(configure=...)
+LOCAL_FIELDS = {
+    "sms_provider",
+    "bot_result",
+    "first_load",
+    "failed_loads",
+    "selected_office",
+    "exit_on_success",
+    "log_settings",
+    "recaptcha_solver",
+    "image_captcha_solver",
+    "captcha_ocr",
+    "current_solver",
+    "http_session",
+    "constraints",
+    "cancelled",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT NOT NULL DEFAULT '',
+    lease_until REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    outcome TEXT NOT NULL DEFAULT '',
+    updated REAL NOT NULL DEFAULT 0
+);
+"""
+
+
+def dump_profile(context: CustomerProfile) -> str:
+    data = {}
+    for f in fields(context):
+        if f.name in LOCAL_FIELDS:
+            continue
+        value = getattr(context, f.name)
+        if isinstance(value, Enum):
+            value = value.name
+        elif f.name in ("offices", "except_offices") and value:
+            value = [office.name for office in value]
+        data[f.name] = value
+    return json.dumps(data)
+
+
+def load_profile(payload: str) -> CustomerProfile:
+    data = json.loads(payload)
+    for name, enum in ENUMS.items():
+        if data.get(name) is not None:
+            data[name] = enum[data[name]]
+    for name in ("offices", "except_offices"):
+        if data.get(name):
+            data[name] = [Office[office] for office in data[name]]
+    return CustomerProfile(**data)
+
+
+def job_id(context: CustomerProfile) -> str:
+    # One job per customer and procedure, so a profile can't be queued twice
+    from .checkpoint import profile_key
+
+    return profile_key(context)
+
+
+@dataclass
+class Lease:
+    job_id: str
+    payload: str
+    worker: str
+    attempts: int
+    max_attempts: int
+
+
+class QueueBackend(ABC):
+    # Jobs are pending, leased, booked or failed. A booked job is never handed out again.
+    @abstractmethod
+    def put(self, job_id: str, payload: str, max_attempts: int = MAX_ATTEMPTS):
+        pass
+
+    @abstractmethod
+    def claim(self, worker: str, lease: float = LEASE_SECONDS) -> Optional[Lease]:
+        pass
+
+    @abstractmethod
+    def heartbeat(self, job_id: str, worker: str, lease: float = LEASE_SECONDS) -> bool:
+        # False once the lease has been lost, the worker must stop working on the job
+        pass
+
+    @abstractmethod
+    def complete(
+        self, job_id: str, worker: str, attempts: int, booked: bool, outcome: str = ""
+    ) -> bool:
+        pass
+
+    @abstractmethod
+    def states(self) -> Dict[str, str]:
+        pass
+
+
+class SQLiteQueue(QueueBackend):
+    # Processes on one machine. WAL needs shared memory and file locks over NFS can't be
+    # trusted, so nodes on several machines use RedisQueue.
+    def __init__(self, path: str, timeout: float = 30):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=timeout, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def put(self, job_id: str, payload: str, max_attempts: int = MAX_ATTEMPTS):
+        # Queuing a failed job again gives it a fresh set of attempts
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, payload, max_attempts, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET payload = excluded.payload, "
+                "max_attempts = excluded.max_attempts, "
+                "attempts = CASE WHEN state = 'failed' THEN 0 ELSE attempts END, "
+                "state = CASE WHEN state = 'failed' THEN 'pending' ELSE state END",
+                (job_id, payload, max_attempts, time.time()),
+            )
+
+    def claim(self, worker: str, lease: float = LEASE_SECONDS) -> Optional[Lease]:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT id, payload, attempts, max_attempts FROM jobs "
+                    "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                    "ORDER BY updated LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, "
+                        "updated = ? WHERE id = ?",
+                        (worker, now + lease, now, row[0]),
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return Lease(row[0], row[1], worker, row[2], row[3])
+
+    def heartbeat(self, job_id: str, worker: str, lease: float = LEASE_SECONDS) -> bool:
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                (time.time() + lease, job_id, worker),
+            )
+        return cursor.rowcount == 1
+
+    def complete(
+        self, job_id: str, worker: str, attempts: int, booked: bool, outcome: str = ""
+    ) -> bool:
+        with self._lock:
+            if booked:
+                # Recorded even if the lease was lost meanwhile, the cita is taken either way
+                cursor = self._db.execute(
+                    "UPDATE jobs SET state = 'booked', worker = '', lease_until = 0, "
+                    "attempts = attempts + ?, outcome = ?, updated = ? WHERE id = ?",
+                    (attempts, outcome, time.time(), job_id),
+                )
+            else:
+                cursor = self._db.execute(
+                    "UPDATE jobs SET state = CASE WHEN attempts + ? >= max_attempts "
+                    "THEN 'failed' ELSE 'pending' END, worker = '', lease_until = 0, "
+                    "attempts = attempts + ?, outcome = ?, updated = ? "
+                    "WHERE id = ? AND worker = ? AND state = 'leased'",
+                    (attempts, attempts, outcome, time.time(), job_id, worker),
+                )
+        return cursor.rowcount == 1
+
+    def states(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._db.execute("SELECT id, state FROM jobs").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class RedisQueue(QueueBackend):
+    # pip install redis. Every change is a WATCH/MULTI transaction, redis-py retries it when
+    # another node touched the same keys first. Pass client= to use another Redis client.
+    def __init__(self, url: str = "redis://localhost:6379/0", name: str = "bcncita", client=None):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self._redis = client
+        self._index = f"{name}:jobs"  # job ids, scored by when they were last claimed
+        self._prefix = f"{name}:job:"
+
+    def _transaction(self, update, *keys):
+        return self._redis.transaction(update, *keys, value_from_callable=True)
+
+    def put(self, job_id: str, payload: str, max_attempts: int = MAX_ATTEMPTS):
+        key = self._prefix + job_id
+
+        def update(pipe):
+            state = pipe.hget(key, "state")
+            pipe.multi()
+            if state is None or state == "failed":
+                # New, or queued again after failing: a fresh set of attempts
+                pipe.hset(
+                    key,
+                    mapping={
+                        "state": "pending",
+                        "worker": "",
+                        "lease_until": 0,
+                        "attempts": 0,
+                        "outcome": "",
+                    },
+                )
+            pipe.hset(key, mapping={"payload": payload, "max_attempts": max_attempts})
+            pipe.zadd(self._index, {job_id: time.time()}, nx=True)
+
+        self._transaction(update, key)
+
+    def claim(self, worker: str, lease: float = LEASE_SECONDS) -> Optional[Lease]:
+        def update(pipe):
+            now = time.time()
+            for job_id in pipe.zrange(self._index, 0, -1):
+                key = self._prefix + job_id
+                pipe.watch(key)
+                job = pipe.hgetall(key)
+                state = job.get("state")
+                if state == "pending" or (state == "leased" and float(job["lease_until"]) < now):
+                    pipe.multi()
+                    pipe.hset(
+                        key,
+                        mapping={"state": "leased", "worker": worker, "lease_until": now + lease},
+                    )
+                    pipe.zadd(self._index, {job_id: now})
+                    return Lease(
+                        job_id,
+                        job["payload"],
+                        worker,
+                        int(job["attempts"]),
+                        int(job["max_attempts"]),
+                    )
+            return None
+
+        return self._transaction(update, self._index)
+
+    def heartbeat(self, job_id: str, worker: str, lease: float = LEASE_SECONDS) -> bool:
+        key = self._prefix + job_id
+
+        def update(pipe):
+            job = pipe.hgetall(key)
+            if job.get("state") != "leased" or job.get("worker") != worker:
+                return False
+            pipe.multi()
+            pipe.hset(key, mapping={"lease_until": time.time() + lease})
+            return True
+
+        return self._transaction(update, key)
+
+    def complete(
+        self, job_id: str, worker: str, attempts: int, booked: bool, outcome: str = ""
+    ) -> bool:
+        key = self._prefix + job_id
+
+        def update(pipe):
+            job = pipe.hgetall(key)
+            if not job:
+                return False
+            # A booking is recorded even if the lease was lost meanwhile
+            if not booked and (job["state"] != "leased" or job["worker"] != worker):
+                return False
+            total = int(job["attempts"]) + attempts
+            state = "pending"
+            if booked:
+                state = "booked"
+            elif total >= int(job["max_attempts"]):
+                state = "failed"
+            pipe.multi()
+            pipe.hset(
+                key,
+                mapping={
+                    "state": state,
+                    "worker": "",
+                    "lease_until": 0,
+                    "attempts": total,
+                    "outcome": outcome,
+                },
+            )
+            pipe.zadd(self._index, {job_id: time.time()})
+            return True
+
+        return self._transaction(update, key)
+
+    def states(self) -> Dict[str, str]:
+        ids = self._redis.zrange(self._index, 0, -1)
+        return {job_id: self._redis.hget(self._prefix + job_id, "state") for job_id in ids}
+
+
+def enqueue(
+    backend: QueueBackend, profiles: List[CustomerProfile], max_attempts: int = MAX_ATTEMPTS
+) -> List[str]:
+    ids: List[str] = []
+    for context in profiles:
+        if job_id(context) in ids:
+            continue
+        ids.append(job_id(context))
+        backend.put(ids[-1], dump_profile(context), max_attempts)
+    return ids
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def keep_alive(backend: QueueBackend, lease: Lease, every: float, seconds: float, done, lost):
+    # Without a renewal for a whole lease another node may claim the job, stop before that
+    renewed = time.monotonic()
+    while not done.wait(every):
+        sent = time.monotonic()
+        try:
+            if backend.heartbeat(lease.job_id, lease.worker, seconds):
+                renewed = sent
+                continue
+            logging.error(f"[{lease.job_id}] Lease lost, leaving the job to another worker")
+        except Exception as e:
+            logging.error(f"Unable to renew lease {lease.job_id}: {e}")
+            if time.monotonic() + every - renewed < seconds:
+                continue
+            logging.error(f"[{lease.job_id}] Lease not renewed in time, leaving the job")
+        lost.set()
+        return
+
+
+def run_worker(
+    backend: QueueBackend,
+    pool_size: int = 2,
+    cycles: int = LEASE_CYCLES,
+    lease_seconds: float = LEASE_SECONDS,
+    heartbeat_seconds: float = HEARTBEAT_SECONDS,
+    idle_seconds: float = IDLE_SECONDS,
+    configure: Optional[Callable[[CustomerProfile], None]] = None,
+    stop: Optional[threading.Event] = None,
+    pool=None,
+    name: Optional[str] = None,
+):
+    # Every node runs the same loop: claim a profile, run a few attempts, report, repeat
+    from .captcha import presolving, start_presolver
+    from .checkpoint import is_booked, resume
+    from .cita import fast_forward_urls, init_wedriver, run_attempt
+    from .sessions import BrowserPool
+    from .sms import clear_inbox
+
+    stop = stop or threading.Event()
+    name = name or worker_name()
+    own_pool = pool is None
+    pool_lock = threading.Lock()
+    booked: List[Tuple[CustomerProfile, Any]] = []  # with the browser left on the confirmation
+
+    def get_pool(context):
+        nonlocal pool
+        with pool_lock:
+            if pool is None:
+                # Chrome refuses to share a user-data-dir between running instances
+                template = replace(context, chrome_profile_path=None, chrome_profile_name=None)
+                pool = BrowserPool(lambda: init_wedriver(template), pool_size)
+            return pool
+
+    def work(lease: Lease):
+        context = load_profile(lease.payload)
+        context.exit_on_success = False
+        context.cancelled = lost = threading.Event()
+        if configure is not None:
+            configure(context)
+        start_presolver(context)
+        if is_booked(context):
+            backend.complete(lease.job_id, lease.worker, 0, True, "booked")
+            return
+
+        done = threading.Event()
+        beat = threading.Thread(
+            target=keep_alive,
+            args=(backend, lease, heartbeat_seconds, lease_seconds, done, lost),
+            daemon=True,
+        )
+        beat.start()
+
+        attempts, result = 0, None
+        try:
+            clear_inbox(context)
+            resume(context)
+            urls = fast_forward_urls(context)
+            browsers = get_pool(context)
+            for _ in range(min(cycles, lease.max_attempts - lease.attempts)):
+                if lost.is_set() or stop.is_set():
+                    break
+                attempts += 1
+                logging.info(
+                    f"\033[33m[{context.name}] [Attempt {lease.attempts + attempts}"
+                    f"/{lease.max_attempts}] on {lease.worker}\033[0m"
+                )
+                driver = browsers.acquire(context)
+                result = run_attempt(driver, context, *urls)
+                if result:
+                    # Leave the winning browser open for the confirmation
+                    browsers.discard(driver, quit=False)
+                    break
+                browsers.release(driver)
+        finally:
+            done.set()
+            beat.join()
+            outcome = "booked" if result else ("lease_lost" if lost.is_set() else "no_cita")
+            backend.complete(lease.job_id, lease.worker, attempts, bool(result), outcome)
+
+        if result:
+            logging.info(f"[{context.name}] WIN")
+            booked.append((context, driver))
+
+    def loop(slot: int):
+        worker = f"{name}/{slot}"
+        while not stop.is_set():
+            try:
+                lease = backend.claim(worker, lease_seconds)
+            except Exception as e:
+                logging.error(f"Unable to claim a job: {e}")
+                lease = None
+            if lease is None:
+                stop.wait(idle_seconds)
+                continue
+            try:
+                work(lease)
+            except Exception as e:
+                logging.error(f"[{lease.job_id}] SMTH BROKEN: {e}")
+
+    threads = [threading.Thread(target=loop, args=(slot,)) for slot in range(pool_size)]
+    try:
+        with presolving([]):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        if own_pool and pool is not None:
+            pool.close()
+
+    return booked
@@ -0,0 +1,36 @@
+import statistics
+import subprocess
+import sys
+
+REPEAT = 10
+
+# What a worker imports, each measured in a fresh interpreter
+STATEMENTS = {
+    "python": "pass",
+    "profile": "from bcncita import CustomerProfile, Province",
+    "routes": "from bcncita import route_urls",
+    "monitor": "from bcncita import Monitor",
+    "engine": "from bcncita import try_cita",
+    "star": "from bcncita import *",  # the engine, as it always has
+    "everything": "import bcncita; [getattr(bcncita, name) for name in dir(bcncita)]",
+}
+
+
+def measure(statement: str) -> float:
+    code = (
+        "import time; started = time.perf_counter(); "
+        f"{statement}; print(time.perf_counter() - started)"
+    )
+    times = [
+        float(subprocess.run([sys.executable, "-c", code], capture_output=True, check=True).stdout)
+        for _ in range(REPEAT)
+    ]
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    for name, statement in STATEMENTS.items():
+        print(f"{name:>10}: {measure(statement) * 1000:8.1f} ms  ({statement})")
+
+# In Terminal run:
+#   python3 -m benchmarks.import_time
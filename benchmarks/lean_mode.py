@@ -0,0 +1,43 @@
+import logging
+import sys
+from dataclasses import replace
+
+from bcncita import CustomerProfile, DocType, OperationType, Province, init_wedriver
+from bcncita.cita import fast_forward_urls
+from bcncita.lean import page_report, savings
+from bcncita.readiness import wait_ready
+
+
+def load_pages(context: CustomerProfile):
+    driver = init_wedriver(context)
+    reports = []
+    try:
+        for url in fast_forward_urls(context):
+            driver.get(url)
+            wait_ready(driver)
+            reports.append(page_report(driver))
+    finally:
+        driver.quit()
+    return reports
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    context = CustomerProfile(
+        name="BENCH",
+        doc_type=DocType.PASSPORT,
+        doc_value="0",
+        phone="0",
+        email="bench@localhost",
+        province=Province.BARCELONA,
+        operation_code=OperationType.TOMA_HUELLAS,
+        chrome_driver_path=sys.argv[1] if len(sys.argv) > 1 else "chromedriver",
+    )
+    baseline = load_pages(context)
+    lean = load_pages(replace(context, lean_mode=True))
+    for before, after in zip(baseline, lean):
+        logging.info(f"{before.url}: {before.bytes} -> {after.bytes} bytes")
+    savings(baseline, lean)
+
+# In Terminal run:
+#   python3 -m benchmarks.lean_mode /usr/local/bin/chromedriver
@@ -0,0 +1,153 @@
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+__all__ = ["ReplayConfig", "ReplayServer"]
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), "pages")
+
+# Last path segment -> fixture, the province prefix (icpplus, icpplustieb...) doesn't matter
+ROUTES = {
+    "citar": "citar.html",
+    "acInfo": "instructions.html",
+    "acEntrada": "personal.html",
+    "acValidarEntrada": "solicitar.html",
+    "acCitar": "offices.html",
+    "acVerFormulario": "contact.html",
+    "acOfertarCita": None,  # slot layout depends on the config
+    "acReservar": "confirmation.html",
+    "acGrabarCita": "confirmed.html",
+}
+
+RECAPTCHA_INPUTS = """<input type="hidden" id="reCAPTCHA_site_key" value="6Lc-replay-site-key">
+      <input type="hidden" id="action" value="replay">
+      <input type="hidden" id="g-recaptcha-response" name="g-recaptcha-response" value="">"""
+SMS_INPUT = '<input type="text" id="txtCodigoVerificacion" name="txtCodigoVerificacion">'
+
+
+@dataclass
+class ReplayConfig:
+    latency: float = 0.0  # seconds added to every response
+    jitter: float = 0.0  # uniform extra delay on top of latency
+    failure_rate: float = 0.0  # share of responses replaced by the "Request Rejected" page
+    timeout_rate: float = 0.0  # share of responses held back for timeout_delay
+    timeout_delay: float = 35.0  # longer than DELAY, so waits in the bot give up
+    no_citas_rate: float = 0.0  # share of acCitar responses saying there are no citas
+    slot_layout: str = "map_horas"  # or "lcita"
+    captcha: bool = False
+    sms_code: Optional[str] = None  # ask for this SMS code on the confirmation page
+    seed: Optional[int] = None
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    server: "ReplayServer"
+
+    def do_GET(self):
+        self.reply({})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+        self.reply({k: v[0] for k, v in parse_qs(body).items()})
+
+    def reply(self, fields: Dict[str, str]):
+        path = urlsplit(self.path).path
+        page = self.server.respond(self.command, path, fields)
+        if page is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = page.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: Optional[ReplayConfig] = None, port: int = 0):
+        super().__init__(("127.0.0.1", port), ReplayHandler)
+        self.config = config or ReplayConfig()
+        self.random = random.Random(self.config.seed)
+        self.hits: List[Tuple[float, str, str]] = []  # (time, method, path)
+        self.posted: Dict[str, Dict[str, str]] = {}  # last form posted to each step
+        self._lock = threading.Lock()
+        self._pages: Dict[str, str] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def first_hit(self, step: str, since: float = 0) -> Optional[float]:
+        with self._lock:
+            return next(
+                (t for t, _, path in self.hits if t >= since and path.endswith(f"/{step}")), None
+            )
+
+    def respond(self, method: str, path: str, fields: Dict[str, str]) -> Optional[str]:
+        step = path.rsplit("/", 1)[-1]
+        with self._lock:
+            self.hits.append((time.time(), method, path))
+            if method == "POST":
+                self.posted[step] = fields
+            failed = self.random.random() < self.config.failure_rate
+            held = self.random.random() < self.config.timeout_rate
+            no_citas = self.random.random() < self.config.no_citas_rate
+            delay = self.config.latency + self.random.uniform(0, self.config.jitter)
+
+        time.sleep(delay + (self.config.timeout_delay if held else 0))
+        if step == "robots.txt":
+            return ""
+        if step not in ROUTES:
+            return None
+        if failed:
+            return self.page("rejected.html")
+
+        if step == "acEntrada":
+            return self.with_captcha(self.page("personal.html"))
+        if step == "acCitar" and no_citas:
+            return self.page("no_citas.html")
+        if step == "acOfertarCita":
+            return self.with_captcha(self.page(f"slots_{self.config.slot_layout}.html"))
+        if step == "acReservar" and self.config.sms_code:
+            return self.page("confirmation.html").replace("<!-- sms -->", SMS_INPUT)
+        if step == "acGrabarCita" and self.config.sms_code:
+            if fields.get("txtCodigoVerificacion") != self.config.sms_code:
+                return self.page("wrong_code.html")
+        return self.page(ROUTES[step])
+
+    def with_captcha(self, html: str):
+        return html.replace("<!-- captcha -->", RECAPTCHA_INPUTS if self.config.captcha else "")
+
+    def page(self, name: str) -> str:
+        if name not in self._pages:
+            with open(os.path.join(PAGES_DIR, name), encoding="utf-8") as f:
+                self._pages[name] = f.read()
+        return self._pages[name]
@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+from datetime import date
+from typing import Dict
+
+from selenium.webdriver.common.by import By
+
+from bcncita import CustomerProfile, DocType, init_wedriver
+from bcncita.constraints import parse_when
+from bcncita.slots import extract_slot_table, parse_slot_table
+
+PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pages")
+REPEAT = 20
+
+
+def first_per_day(slots):
+    # slot_list() is sorted, the first slot of each day is its earliest
+    found: Dict[date, str] = {}
+    for slot in slots:
+        found.setdefault(slot.day, slot.value)
+    return found
+
+
+def per_cell(driver):
+    # What cita_selection used to do: a chromedriver round trip per row, cell and attribute
+    date_els = driver.find_elements(By.CSS_SELECTOR, "#CitaMAP_HORAS thead [class^=colFecha]")
+    dates = [parse_when(el.text)[0] for el in date_els]
+    slots: Dict[date, str] = {}
+    slot_table = driver.find_element(By.CSS_SELECTOR, "#CitaMAP_HORAS tbody")
+    for row in slot_table.find_elements(By.CSS_SELECTOR, "tr"):
+        row.find_elements(By.TAG_NAME, "th")[0].text
+        for idx, cell in enumerate(row.find_elements(By.TAG_NAME, "td")):
+            if dates[idx] in slots:
+                continue
+            try:
+                slots[dates[idx]] = cell.find_element(
+                    By.CSS_SELECTOR, "[id^=HUECO]"
+                ).get_attribute("id")
+            except Exception:
+                pass
+    return slots
+
+
+def single_script(driver):
+    return first_per_day(extract_slot_table(driver).slot_list())
+
+
+def page_source(driver):
+    return first_per_day(parse_slot_table(driver.page_source).slot_list())
+
+
+def measure(fn, driver):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = fn(driver)
+    return (time.perf_counter() - start) / REPEAT, result
+
+
+if __name__ == "__main__":
+    context = CustomerProfile(
+        name="BENCH",
+        doc_type=DocType.PASSPORT,
+        doc_value="0",
+        phone="0",
+        email="bench@localhost",
+        chrome_driver_path=sys.argv[1] if len(sys.argv) > 1 else "chromedriver",
+    )
+    driver = init_wedriver(context)
+    try:
+        driver.get("file://" + os.path.join(PAGES, "slots_map_horas.html"))
+        expected = None
+        for fn in (per_cell, single_script, page_source):
+            seconds, result = measure(fn, driver)
+            expected = expected or result
+            assert result == expected, f"{fn.__name__} disagrees with per_cell"
+            print(f"{fn.__name__:>14}: {seconds * 1000:8.1f} ms")
+    finally:
+        driver.quit()
+
+# In Terminal run:
+#   python3 -m benchmarks.slot_extraction /usr/local/bin/chromedriver
@@ -0,0 +1,128 @@
+import argparse
+import logging
+import statistics
+import time
+from contextlib import contextmanager
+from dataclasses import replace
+
+from bcncita import (
+    CustomerProfile,
+    DocType,
+    Engine,
+    OperationType,
+    Province,
+    browserless,
+    cita,
+    init_wedriver,
+    routes,
+    throttle,
+)
+from bcncita.cita import start_with
+from bcncita.profile import ICP_URL
+
+from .replay import ReplayConfig, ReplayServer
+
+
+@contextmanager
+def replayed(config: ReplayConfig):
+    # start_with takes its URLs from the route table, point every route at the replay server
+    saved = dict(routes.URLS)
+    with ReplayServer(config) as server:
+        routes.URLS.update(
+            {
+                key: (url.replace(ICP_URL, server.base), url2.replace(ICP_URL, server.base))
+                for key, (url, url2) in saved.items()
+            }
+        )
+        try:
+            yield server
+        finally:
+            routes.URLS.update(saved)
+
+
+def attempts_per_minute(driver, context: CustomerProfile, attempts: int, config: ReplayConfig):
+    # Nothing is ever offered, so every attempt runs the whole refresh loop and gives up
+    with replayed(replace(config, no_citas_rate=1.0)):
+        started = time.perf_counter()
+        start_with(driver, context, cycles=attempts, quit_on_fail=False)
+        return attempts * 60 / (time.perf_counter() - started)
+
+
+def time_to_slot(driver, context: CustomerProfile, runs: int, config: ReplayConfig):
+    timings = []
+    with replayed(config) as server:
+        for _ in range(runs):
+            started = time.time()
+            while time.time() - started < 600:
+                start_with(driver, context, cycles=1, quit_on_fail=False)
+                offered = server.first_hit("acOfertarCita", since=started)
+                if offered:
+                    timings.append(offered - started)
+                    break
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark start_with against the replay server")
+    parser.add_argument("--chromedriver", default="chromedriver")
+    parser.add_argument("--engine", choices=[e.value for e in Engine], default=Engine.BROWSER)
+    parser.add_argument("--operation", choices=[o.name for o in OperationType], action="append")
+    parser.add_argument("--attempts", type=int, default=5)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--no-citas-rate", type=float, default=0.8)
+    parser.add_argument("--slot-layout", choices=["map_horas", "lcita"], default="map_horas")
+    parser.add_argument(
+        "--refresh-interval",
+        type=float,
+        default=cita.REFRESH_INTERVAL,
+        help="pause between refreshes while there are no citas",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+    cita.REFRESH_INTERVAL = browserless.REFRESH_INTERVAL = args.refresh_interval
+    throttle.RATE = 0  # the replay server doesn't need protecting
+    config = ReplayConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        no_citas_rate=args.no_citas_rate,
+        slot_layout=args.slot_layout,
+    )
+    template = CustomerProfile(
+        name="BORIS JOHNSON",
+        doc_type=DocType.PASSPORT,
+        doc_value="132435465",
+        phone="600000000",
+        email="bench@localhost",
+        province=Province.BARCELONA,
+        chrome_driver_path=args.chromedriver,
+        engine=Engine(args.engine),
+        auto_office=True,
+        auto_captcha=True,
+        anticaptcha_api_key="replay",  # fixtures carry no captcha unless asked to
+        headless=True,
+        exit_on_success=False,
+    )
+
+    driver = init_wedriver(template)
+    try:
+        for name in args.operation or [o.name for o in OperationType]:
+            context = replace(template, operation_code=OperationType[name])
+            apm = attempts_per_minute(driver, context, args.attempts, config)
+            timings = time_to_slot(driver, context, args.runs, config)
+            median = f"{statistics.median(timings):0.2f}s" if timings else "-"
+            print(f"{name:28} {apm:6.1f} attempts/min   time-to-slot median {median}")
+    finally:
+        driver.quit()
+
+
+if __name__ == "__main__":
+    main()
+
+# In Terminal run:
+#   python3 -m benchmarks.start_with --chromedriver /usr/local/bin/chromedriver
+#   python3 -m benchmarks.start_with --engine http --operation BREXIT --refresh-interval 0
@@ -1,34 +1,38 @@
+import asyncio
+import json
 import logging
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
-from bcncita import (
-    CustomerProfile,
-    DocType,
-    Office,
-    OperationType,
-    Province,
-    init_wedriver,
-    start_with,
-    try_cita,
-)
+from selenium.common.exceptions import TimeoutException
+
+from bcncita import CustomerProfile, DocType, Office, OperationType, Province, try_cita
+from bcncita.cita import find_best_date
+from benchmarks.replay import ReplayConfig, ReplayServer
+
+
+def new_customer(**overrides):
+    params = dict(
+        name="BORIS JOHNSON",
+        doc_type=DocType.PASSPORT,
+        doc_value="132435465",
+        phone="600000000",
+        email="ghtvgdr@affecting.org",
+    )
+    params.update(overrides)
+    return CustomerProfile(**params)
 
 
 class TestBot(unittest.TestCase):
     def test_cita(self):
-        params = {
-            "chrome_driver_path": "chromedriver",
-            "auto_office": True,
-            "auto_captcha": True,
-            "name": "BORIS JOHNSON",
-            "doc_type": DocType.PASSPORT,
-            "doc_value": "132435465",
-            "phone": "600000000",
-            "email": "ghtvgdr@affecting.org",
-        }
-
-        customer = CustomerProfile(
-            **params,
+        customer = new_customer(
+            chrome_driver_path="chromedriver",
+            auto_office=True,
+            auto_captcha=True,
             province=Province.BARCELONA,
             operation_code=OperationType.BREXIT,
             offices=[Office.BARCELONA],
@@ -42,23 +46,1246 @@ class TestBot(unittest.TestCase):
         self.assertIn("INFO:root:[Step 3/6] Contact info", logs.output)
         self.assertIn("INFO:root:[Step 4/6] Cita attempt -> selection hit!", logs.output)
 
-        driver = init_wedriver(customer)
+
+class TestImports(unittest.TestCase):
+    def test_lazy(self):
+        import subprocess
+        import sys
+
+        code = (
+            "import sys; from bcncita import CustomerProfile, Province, route_urls; "
+            "print(sorted({m.split('.')[0] for m in sys.modules} & {'selenium', 'requests'}))"
+        )
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        self.assertEqual(out.stdout.strip(), "[]")
+
+    def test_star(self):
+        import subprocess
+        import sys
+
+        # The names a star import gave before the engine was loaded lazily
+        code = (
+            "from bcncita import *; "
+            "print(try_cita.__name__, start_with.__name__, init_wedriver.__name__, "
+            "CustomerProfile.__name__); "
+            "print('run_worker' in dir())"
+        )
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        self.assertEqual(
+            out.stdout.split("\n")[:2],
+            ["try_cita start_with init_wedriver CustomerProfile", "False"],
+            out.stderr,
+        )
+
+
+class TestRoutes(unittest.TestCase):
+    def test_table(self):
+        from bcncita.routes import route_urls
+
         for province in Province:
-            customer = CustomerProfile(
-                **params,
-                province=province,
-                operation_code=OperationType.TOMA_HUELLAS,
+            for operation in OperationType:
+                url, url2 = route_urls(province, operation)
+                self.assertRegex(
+                    url,
+                    rf"^https://icp\.administracionelectronica\.gob\.es/icp\w+/citar\?p={province.value}$",
+                )
+                self.assertRegex(url2, rf"/acInfo\?tramiteGrupo\[[01]\]={operation.value}$")
+
+        self.assertEqual(
+            route_urls(Province.BARCELONA, OperationType.TOMA_HUELLAS)[1],
+            "https://icp.administracionelectronica.gob.es/icpplustieb/acInfo?tramiteGrupo[0]=4010",
+        )
+
+    def test_refresh(self):
+        from bcncita import routes
+
+        server = ReplayServer().start()
+        self.addCleanup(server.stop)
+        self.addCleanup(routes.update_routes, dict(routes.ROUTES))
+        cache = os.path.join(tempfile.mkdtemp(), "routes.json")
+
+        self.assertTrue(
+            routes.refresh_routes(cache, provinces=[Province.BARCELONA], base=server.base)
+        )
+        _, url2 = routes.route_urls(Province.BARCELONA, OperationType.CARTA_INVITACION)
+        self.assertTrue(url2.endswith("/icpplustieb/acInfo?tramiteGrupo[1]=4037"))
+
+        # A fresh cache is used as is, the server isn't asked again
+        hits = len(server.hits)
+        self.assertTrue(routes.refresh_routes(cache, base=server.base))
+        self.assertEqual(len(server.hits), hits)
+        self.assertFalse(routes.load_routes(cache, ttl=-1))
+
+
+class TestBrowserless(unittest.TestCase):
+    def test_walk_forms(self):
+        from bcncita.browserless import request_office, walk_forms
+        from bcncita.history import get_store
+
+        server = ReplayServer(ReplayConfig(seed=1)).start()
+        self.addCleanup(server.stop)
+        base = f"{server.base}/icpplustieb"
+
+        history_path = os.path.join(tempfile.mkdtemp(), "history.db")
+        customer = new_customer(offices=[Office.BARCELONA_MALLORCA], history_path=history_path)
+        step, submission = walk_forms(customer, f"{base}/citar?p=8", f"{base}/acInfo?x=4010")
+        self.assertEqual(step, "solicitar")
+        self.assertEqual(submission.url, f"{base}/acCitar")
+        self.assertEqual(server.posted["acEntrada"], {"sede": "99"})
+        self.assertEqual(
+            server.posted["acValidarEntrada"],
+            {
+                "rdbTipoDoc": "PASAPORTE",
+                "txtIdCitado": "132435465",
+                "txtDesCitado": "BORIS JOHNSON",
+                "txtPaisNac": "149",
+            },
+        )
+
+        submission = request_office(customer.http_session, customer, submission)
+        self.assertEqual(server.posted["acVerFormulario"], {"idSede": "14"})
+        self.assertEqual(submission.url, f"{base}/acOfertarCita")
+        self.assertEqual(submission.fields["emailDOS"], "ghtvgdr@affecting.org")
+        # The attempt goes on to the slot page, that's the step that gets recorded
+        store = get_store(history_path)
+        self.assertEqual(store.observations("BARCELONA", "TOMA_HUELLAS"), [])
+
+        _, submission = walk_forms(customer, f"{base}/citar?p=8", f"{base}/acInfo?x=4010")
+        self.assertIsNone(request_office(customer.http_session, customer, submission, rank=9))
+        rows = store.observations("BARCELONA", "TOMA_HUELLAS")
+        self.assertEqual([(office, shown) for _, office, shown, _ in rows], [("", True)])
+
+        server.config.failure_rate = 1.0
+        with self.assertRaises(TimeoutException):
+            walk_forms(customer, f"{base}/citar?p=8", f"{base}/acInfo?x=4010")
+
+    def test_fan_out(self):
+        from bcncita import browserless
+        from bcncita.browserless import fan_out, walk_forms
+        from bcncita.offices import mark_empty, rank_offices
+
+        closed = []
+        original = browserless.new_http_session
+
+        def new_http_session():
+            session = original()
+            session.close = lambda: closed.append(session)
+            return session
+
+        browserless.new_http_session = new_http_session
+        self.addCleanup(setattr, browserless, "new_http_session", original)
+
+        server = ReplayServer(ReplayConfig(seed=1)).start()
+        self.addCleanup(server.stop)
+        urls = (f"{server.base}/icpplustieb/citar", f"{server.base}/icpplustieb/acInfo")
+
+        customer = new_customer(
+            province=Province.MADRID,
+            offices=[Office.BARCELONA_MALLORCA],
+            except_offices=["18"],
+            office_fanout=3,
+        )
+        self.assertEqual(rank_offices(customer, ["16", "14", "18", "30"]), ["14", "16", "30"])
+        mark_empty(customer, "14")
+        self.assertEqual(rank_offices(customer, ["16", "14", "18", "30"]), ["16", "30"])
+
+        _, submission = walk_forms(customer, *urls)
+        branch, page = fan_out(customer, submission, urls)
+        self.assertIn(branch.selected_office, ["16", "30"])
+        self.assertIn("acReservar", page.html)
+        self.assertIsNot(branch.http_session, None)
+        # The losing branches' sessions are closed, the winner's and the profile's are kept
+        self.assertNotIn(branch.http_session, closed)
+        self.assertNotIn(customer.http_session, closed)
+        losers = 2 if branch.http_session is customer.http_session else 1
+        ends = time.monotonic() + 5  # the losing branches close their session on their way out
+        while len(closed) < losers and time.monotonic() < ends:
+            time.sleep(0.05)
+        self.assertEqual(len(closed), losers)
+
+
+class TestForms(unittest.TestCase):
+    def test_form_specs(self):
+        from bcncita.cita import form_spec
+
+        customer = new_customer(
+            doc_type=DocType.NIE,
+            doc_value="T1111111R",
+            operation_code=OperationType.ASIGNACION_NIE,
+            year_of_birth="1964",
+        )
+        values = form_spec(customer).values(customer)
+        self.assertIsNone(values["radio"])  # the form only has a passport radio
+        self.assertEqual(values["inputs"][-1], ["txtAnnoCitado", "1964"])
+        self.assertEqual(values["selects"], [["txtPaisNac", "RUSIA"]])
+
+        customer.operation_code = OperationType.FINGERP_RINT
+        values = form_spec(customer).values(customer)
+        self.assertEqual(values["radio"], "rdbTipoDocNie")
+        self.assertEqual([i for i, _ in values["inputs"]], ["txtIdCitado", "txtDesCitado"])
+
+
+class TestMonitor(unittest.TestCase):
+    def test_probe(self):
+        from bcncita.monitor import Monitor, ProbeStatus
+
+        server = ReplayServer(ReplayConfig(no_citas_rate=1.0)).start()
+        self.addCleanup(server.stop)
+        customers = [
+            new_customer(offices=offices)
+            for offices in ([Office.BARCELONA_MALLORCA], [Office.MATARO])
+        ]
+
+        escalated = []
+        monitor = Monitor(
+            customers,
+            route=lambda c: (
+                f"{server.base}/icpplustieb/citar",
+                f"{server.base}/icpplustieb/acInfo",
+            ),
+        )
+        monitor.escalate = lambda key, offices: escalated.append(offices)  # type: ignore
+
+        monitor.poll()
+        self.assertEqual(monitor.observations[-1].status, ProbeStatus.NO_CITAS)
+        self.assertEqual(escalated, [])
+
+        server.config.no_citas_rate = 0.0
+        monitor.poll()
+        self.assertEqual(monitor.observations[-1].status, ProbeStatus.CITAS)
+        self.assertIn("14", escalated[0])
+        self.assertNotIn("acVerFormulario", server.posted)  # nothing was booked by the probe
+
+    def test_escalate(self):
+        from bcncita import monitor as module
+        from bcncita.history import get_store
+        from bcncita.monitor import Monitor, Observation, ProbeStatus
+
+        release = threading.Event()
+        calls = []
+
+        def run_profiles(profiles, cycles, pool):
+            calls.append([c.name for c in profiles])
+            release.wait(5)
+            return [(profiles[0], FakeDriver())]
+
+        original = module.run_profiles
+        module.run_profiles = run_profiles
+        self.addCleanup(setattr, module, "run_profiles", original)
+
+        path = os.path.join(tempfile.mkdtemp(), "history.db")
+        customers = [
+            new_customer(name=name, offices=[Office.BARCELONA_MALLORCA], history_path=path)
+            for name in ("A", "B")
+        ]
+        monitor = Monitor(customers, route=lambda c: ("", ""))
+        self.addCleanup(monitor.executor.shutdown)
+        key = (Province.BARCELONA, OperationType.TOMA_HUELLAS)
+
+        observations = iter(
+            [
+                Observation(1.0, "BARCELONA", "TOMA_HUELLAS", ProbeStatus.CITAS, ["14"]),
+                Observation(2.0, "BARCELONA", "TOMA_HUELLAS", ProbeStatus.CITAS, ["14"]),
+                Observation(3.0, "BARCELONA", "TOMA_HUELLAS", ProbeStatus.NO_OFFICES),
+            ]
+        )
+        original_probe = module.probe
+        module.probe = lambda context, *urls: next(observations)
+        self.addCleanup(setattr, module, "probe", original_probe)
+
+        # The probe loop goes on while the attempts run, and doesn't start them twice
+        monitor.poll()
+        monitor.poll()
+        self.assertEqual(calls, [["A", "B"]])
+        self.assertIn(key, monitor.escalations)
+
+        release.set()
+        monitor.escalations[key].result(5)
+        monitor.collect()
+        self.assertEqual([c.name for c, _ in monitor.booked], ["A"])
+        self.assertEqual([c.name for c in monitor.waiting[key]], ["B"])
+        self.assertEqual(monitor.escalations, {})
+
+        # An office page without offices is neither an opening nor a closed one
+        monitor.poll()
+        rows = get_store(path).observations("BARCELONA", "TOMA_HUELLAS")
+        self.assertEqual(
+            [(at, office, shown) for at, office, shown, _ in rows],
+            [
+                (1.0, "14", True),
+                (2.0, "14", True),
+            ],
+        )
+
+
+class TestHistory(unittest.TestCase):
+    def test_schedule(self):
+        from datetime import datetime, timedelta
+
+        from bcncita.history import ObservationStore, polling_schedule
+
+        store = ObservationStore(os.path.join(tempfile.mkdtemp(), "history.db"))
+        self.addCleanup(store.close)
+        today = datetime.now().replace(hour=8, minute=59, second=50, microsecond=0)
+        for day in range(1, 5):
+            closed = (today - timedelta(days=day)).timestamp()
+            store.add("BARCELONA", "TOMA_HUELLAS", False, at=closed)
+            store.add("BARCELONA", "TOMA_HUELLAS", True, "14", slots=12, at=closed + 15)
+            # Shown after a long silence, that doesn't date a release
+            store.add("BARCELONA", "TOMA_HUELLAS", False, at=closed + 3600)
+            store.add("BARCELONA", "TOMA_HUELLAS", True, "14", at=closed + 3600 + 7200)
+
+        schedule = polling_schedule(store, "BARCELONA", "TOMA_HUELLAS", "14")
+        self.assertEqual(schedule.exact_times(), [[0, 0]])
+        self.assertEqual(schedule.interval_at(datetime(2024, 7, 1, 9, 0, 30)), schedule.dense)
+        self.assertEqual(schedule.interval_at(datetime(2024, 7, 1, 12, 0)), schedule.sparse)
+        self.assertEqual(schedule.interval_at(datetime(2024, 7, 1, 8, 58, 30)), 30)
+        self.assertIsNone(polling_schedule(store, "MADRID", "TOMA_HUELLAS"))
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_resume(self):
+        import requests
+
+        from bcncita import Engine, start_with
+        from bcncita.checkpoint import end_run, resume, save_attempt, save_booked
+        from bcncita.metrics import AttemptTrace
+
+        def customer():
+            return new_customer(
+                engine=Engine.HTTP,
+                checkpoint_path=os.path.join(tmp, "checkpoints.db"),
             )
-            with self.assertLogs(None, level=logging.INFO) as logs:
-                start_with(driver=driver, context=customer, cycles=1)
 
-            self.assertIn(
-                "INFO:root:Instructions page loaded",
-                logs.output,
-                msg=f"Can't load instructions for province={province}",
+        tmp = tempfile.mkdtemp()
+        before = customer()
+        before.first_load = False
+        before.http_session = requests.Session()
+        before.http_session.cookies.set("JSESSIONID", "abc", domain="icp.example", path="/")
+        trace = AttemptTrace("BORIS JOHNSON", "BARCELONA", "TOMA_HUELLAS", time.time())
+        trace.steps.append({"step": "office_selection", "seconds": 1.0})
+        trace.outcome = "no_citas"
+        for _ in range(3):
+            save_attempt(before, trace)
+
+        # A new process picks up where the old one stopped, with a warm session
+        after = customer()
+        self.assertEqual(resume(after), 3)
+        self.assertFalse(after.first_load)
+        self.assertEqual(after.http_session.cookies.get("JSESSIONID"), "abc")
+
+        end_run(after)
+        self.assertEqual(resume(customer()), 0)
+
+        save_booked(after, "ABC123")
+        self.assertTrue(start_with(None, customer(), quit_on_fail=False))  # never retried
+
+
+class FakeRedis:
+    # The few redis-py calls RedisQueue makes, WATCH can't conflict in a single thread
+    def __init__(self):
+        self.hashes, self.zsets = {}, {}
+
+    def transaction(self, func, *watches, value_from_callable=False):
+        pipe = FakePipeline(self)
+        value = func(pipe)
+        pipe.execute()
+        return value if value_from_callable else None
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update({k: str(v) for k, v in mapping.items()})
+
+    def zadd(self, key, mapping, nx=False):
+        scores = self.zsets.setdefault(key, {})
+        scores.update({m: v for m, v in mapping.items() if not (nx and m in scores)})
+
+    def zrange(self, key, start, end):
+        scores = self.zsets.get(key, {})
+        return sorted(scores, key=scores.get)
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.queued = None
+
+    def watch(self, *keys):
+        pass
+
+    def multi(self):
+        self.queued = []
+
+    def execute(self):
+        for name, args, kwargs in self.queued or []:
+            getattr(self.redis, name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # Reads run right away, writes after multi() wait for execute()
+        def command(*args, **kwargs):
+            if self.queued is None:
+                return getattr(self.redis, name)(*args, **kwargs)
+            self.queued.append((name, args, kwargs))
+
+        return command
+
+
+class TestWorkQueue(unittest.TestCase):
+    def test_backend_interface(self):
+        from bcncita.workqueue import QueueBackend
+
+        class Partial(QueueBackend):
+            def put(self, job_id, payload, max_attempts=1):
+                pass
+
+        # A backend missing a method fails when it is built, not in the middle of a lease
+        with self.assertRaisesRegex(TypeError, "claim"):
+            Partial()
+
+    def check_leases(self, node1, node2):
+        from bcncita.workqueue import enqueue, load_profile
+
+        customer = new_customer(offices=[Office.BADALONA])
+        (job,) = enqueue(node1, [customer, customer], max_attempts=5)
+
+        lease = node1.claim("node1", lease=60)
+        self.assertEqual(load_profile(lease.payload).offices, [Office.BADALONA])
+        self.assertIsNone(node2.claim("node2"))  # never handed out twice
+        self.assertTrue(node1.complete(job, "node1", attempts=3, booked=False))
+
+        # node1 dies holding the lease, node2 takes over once it expires
+        node1.claim("node1", lease=-1)
+        lease = node2.claim("node2")
+        self.assertEqual((lease.worker, lease.attempts), ("node2", 3))
+        self.assertFalse(node1.heartbeat(job, "node1"))
+        self.assertTrue(node2.heartbeat(job, "node2"))
+        self.assertFalse(node1.complete(job, "node1", attempts=1, booked=False))
+
+        self.assertTrue(node2.complete(job, "node2", attempts=1, booked=True))
+        self.assertIsNone(node1.claim("node1"))
+        self.assertEqual(node1.states(), {job: "booked"})
+
+    def test_sqlite_leases(self):
+        from bcncita.workqueue import SQLiteQueue
+
+        path = os.path.join(tempfile.mkdtemp(), "queue.db")
+        self.check_leases(SQLiteQueue(path), SQLiteQueue(path))
+
+    def test_redis_leases(self):
+        from bcncita.workqueue import RedisQueue
+
+        redis = FakeRedis()
+        self.check_leases(RedisQueue(client=redis), RedisQueue(client=redis))
+
+    def test_unreachable_backend(self):
+        from bcncita.workqueue import Lease, SQLiteQueue, keep_alive
+
+        class Unreachable(SQLiteQueue):
+            def heartbeat(self, job_id, worker, lease=0):
+                raise ConnectionError("no route to host")
+
+        done, lost = threading.Event(), threading.Event()
+        lease = Lease("job", "{}", "node1", 0, 5)
+        started = time.monotonic()
+        with self.assertLogs(level=logging.ERROR):
+            keep_alive(
+                Unreachable(os.path.join(tempfile.mkdtemp(), "queue.db")),
+                lease,
+                0.01,
+                0.1,
+                done,
+                lost,
+            )
+        # Given up before the lease could expire on the server
+        self.assertTrue(lost.is_set())
+        self.assertLess(time.monotonic() - started, 0.1)
+
+
+class TestThrottle(unittest.TestCase):
+    def test_shared_bucket(self):
+        from bcncita.throttle import RateLimiter
+
+        path = os.path.join(tempfile.mkdtemp(), "icp.rate")
+        limiter, other_process = RateLimiter(path, rate=10, burst=2), RateLimiter(path, rate=10)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertEqual(other_process.acquire(), 0)
+        self.assertGreater(limiter.acquire(), 0)  # the burst is shared
+
+        limiter.failure()
+        other_process.failure()  # same incident, no extra penalty
+        self.assertGreater(other_process.retry_after(), 1.5)
+        with open(path) as f:
+            state = json.load(f)
+        self.assertEqual((state["failures"], state["rate"]), (1, 5))
+
+        limiter.success()
+        with open(path) as f:
+            self.assertEqual(json.load(f)["failures"], 0)
+
+    def test_throttle_signals(self):
+        from bcncita import throttle
+        from bcncita.cita import initial_page
+
+        self.assertTrue(throttle.is_throttled("", 200))
+        self.assertTrue(throttle.is_throttled("<html>busy</html>", 503))
+        self.assertTrue(throttle.is_throttled("<h1>Too Many Requests</h1>", 200))
+        self.assertTrue(throttle.is_throttled("Request Rejected. Your support ID is 1"))
+        self.assertFalse(throttle.is_throttled("Cargando...", 200))
+
+        path = os.path.join(tempfile.mkdtemp(), "icp.rate")
+        limiter = throttle.RateLimiter(path, rate=1000, burst=100)
+        original = throttle.rate_limiter
+        throttle.rate_limiter = lambda url=None: limiter
+        self.addCleanup(setattr, throttle, "rate_limiter", original)
+
+        def failures():
+            with open(path) as f:
+                return json.load(f)["failures"]
+
+        load = initial_page.__wrapped__  # without the backoff
+        urls = ("http://localhost/citar", "http://localhost/acInfo")
+        customer = new_customer()
+
+        # A page that is only slow to show up doesn't slow the other bots down
+        driver = FakeDriver(text="Cargando...")
+        with self.assertRaises(TimeoutException):
+            load(driver, customer, *urls)
+        self.assertEqual(failures(), 0)
+
+        driver.text = "The requested URL was rejected. Please consult with your administrator."
+        with self.assertRaises(TimeoutException):
+            load(driver, customer, *urls)
+        self.assertEqual(failures(), 1)
+
+
+class TestSms(unittest.TestCase):
+    def test_push_receiver(self):
+        import requests
+
+        from bcncita.sms import PushReceiver
+
+        receiver = PushReceiver(port=0, token="secret").start()
+        self.addCleanup(receiver.close)
+        self.assertEqual(receiver.server.server_address[0], "127.0.0.1")
+        url = f"http://127.0.0.1:{receiver.port}/?token=secret"
+
+        # The gateway puts its own number and a reference before the code
+        text = "De +34 911 222 333 ref 987654321: CITA PREVIA CODIGO 111111, DE VERIFICACION"
+
+        def forward():
+            time.sleep(0.2)
+            requests.post(url, json={"to": "+34 600 000 001", "text": text})
+            requests.post(url, data={"to": "600000002", "text": text.replace("1", "2")})
+
+        threading.Thread(target=forward).start()
+        started = time.monotonic()
+        self.assertEqual(receiver.wait_code("600000002", timeout=5), "222222")
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(receiver.wait_code("+34600000001", timeout=1), "111111")
+        self.assertIsNone(receiver.wait_code("600000001", timeout=0.3))
+
+        # Without a recipient field the numbers in the text don't pick the profile
+        requests.post(url, data={"text": text.replace("1", "3")})
+        self.assertEqual(sorted(receiver.inbox._by_phone), ["", "600000001", "600000002"])
+        self.assertEqual(receiver.wait_code("600000004", timeout=1), "333333")
+
+        # Without the token nothing is queued
+        base = f"http://127.0.0.1:{receiver.port}/"
+        text = text.replace("1", "4")
+        self.assertEqual(requests.post(base, data={"text": text}).status_code, 403)
+        self.assertEqual(
+            requests.post(f"{base}?token=guess", data={"text": text}).status_code, 403
+        )
+        headers = {"Authorization": "Bearer secret"}
+        self.assertEqual(
+            requests.post(base, data={"text": text}, headers=headers).status_code, 204
+        )
+        self.assertEqual(receiver.wait_code("600000004", timeout=1), "444444")
+        self.assertIsNone(receiver.wait_code("600000004", timeout=0.3))
+
+    def test_shared_webhook_token(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        from bcncita.sms import WebhookSiteProvider
+
+        inbox, requests_seen = [], []
+
+        class FakeWebhook(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_seen.append(("GET", self.path))
+                body = json.dumps({"data": list(reversed(inbox))}).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_DELETE(self):
+                requests_seen.append(("DELETE", self.path))
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeWebhook)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        provider = WebhookSiteProvider("token", base=f"http://127.0.0.1:{server.server_port}")
+        self.addCleanup(provider.close)
+
+        provider.clear()
+        provider.clear()  # the second profile sharing the token doesn't wipe it again
+        phones = [f"60000000{i}" for i in range(4)]
+        for i, phone in enumerate(phones):
+            text = f"From 911222333: CITA PREVIA CODIGO {i}{i}{i}, DE VERIFICACION"
+            inbox.append({"uuid": f"m{i}", "text_content": text, "request": {"to": phone}})
+
+        with ThreadPoolExecutor(len(phones)) as executor:
+            codes = list(executor.map(lambda p: provider.wait_code(p, timeout=5), phones))
+        self.assertEqual(codes, ["000", "111", "222", "333"])
+        self.assertLess(len([r for r in requests_seen if r[0] == "GET"]), 3)
+
+        time.sleep(0.5)  # deletes go out from the poller after the codes are handed over
+        deleted = sorted(path for method, path in requests_seen if method == "DELETE")
+        self.assertEqual(
+            deleted, ["/token/token/request/"] + [f"/token/token/request/m{i}" for i in range(4)]
+        )
+
+
+class TestSlots(unittest.TestCase):
+    def test_parse_slot_table(self):
+        from bcncita.constraints import SlotConstraints, Window, sort_slots
+        from bcncita.slots import parse_slot_table
+
+        path = os.path.join(
+            os.path.dirname(__file__), "benchmarks", "pages", "slots_map_horas.html"
+        )
+        with open(path, encoding="utf-8") as f:
+            table = parse_slot_table(f.read())
+
+        self.assertEqual(len(table.dates), 8)
+        self.assertEqual(len(table.rows), 36)
+        self.assertEqual(table.rows[0].time, "08:00")
+        self.assertTrue(all(len(row.slots) == len(table.dates) for row in table.rows))
+
+        slots = table.slot_list()
+        self.assertEqual(slots, sort_slots(slots))
+        mornings = SlotConstraints([Window.parse(min_time="09:00", max_time="12:00")])
+        self.assertEqual(mornings.best(slots), "HUECO41051142")  # LUNES 03/06/2024
+        tuesday = SlotConstraints([Window.parse(min_date="04/06/2024", min_time="09:00")])
+        self.assertEqual(tuesday.best(slots), "HUECO41051139")
+
+    def test_extract_fallback(self):
+        from selenium.common.exceptions import JavascriptException
+
+        from bcncita.slots import extract_slot_table, parse_slot_table
+
+        path = os.path.join(
+            os.path.dirname(__file__), "benchmarks", "pages", "slots_map_horas.html"
+        )
+        driver = FakeDriver()
+        with open(path, encoding="utf-8") as f:
+            driver.page_source = f.read()
+        driver.settled = lambda: {"dates": ["LUNES 03/06/2024"]}  # a table without rows
+        with self.assertLogs(None, level=logging.ERROR):
+            self.assertEqual(extract_slot_table(driver), parse_slot_table(driver.page_source))
+
+        def broken():
+            raise JavascriptException("javascript error: table.querySelectorAll is not a function")
+
+        driver.settled = broken
+        with self.assertLogs(None, level=logging.ERROR):
+            self.assertEqual(len(extract_slot_table(driver).slot_list()), 93)
+
+
+class TestClaims(unittest.TestCase):
+    def test_share_slots(self):
+        from datetime import date, time as at
+
+        from bcncita import claims
+        from bcncita.constraints import Slot
+        from bcncita.offices import rank_offices
+
+        def customer(name, **kwargs):
+            return new_customer(name=name, doc_value=name, **kwargs)
+
+        finder = customer("FINDER", min_time="12:00")
+        early = customer("EARLY", max_time="09:30")
+        anyone = customer("ANYONE")
+        elsewhere = customer("ELSEWHERE", offices=[Office.BADALONA])
+        offered = [
+            Slot(date(2024, 6, 3), at(9, 0), "HUECO1"),
+            Slot(date(2024, 6, 3), at(12, 0), "HUECO2"),
+            Slot(date(2024, 6, 4), at(9, 10), "HUECO3"),
+        ]
+        for context in [finder, early, anyone, elsewhere]:
+            claims.wait(context)
+        finder.selected_office = Office.BARCELONA.value
+
+        slot = claims.pick_slot(finder, offered)
+        assigned = claims.share_slots(finder, offered, taken=slot)
+        # ANYONE would take HUECO1 too, but EARLY has fewer options and chooses first
+        self.assertEqual(
+            [(c.name, s.value) for c, s in assigned], [("EARLY", "HUECO1"), ("ANYONE", "HUECO3")]
+        )
+        self.assertEqual(rank_offices(anyone, ["14", "16"]), ["16", "14"])
+        self.assertEqual(claims.pick_slot(anyone, offered), "HUECO3")
+        self.assertEqual(claims.pick_slot(customer("LATE"), offered[:2]), "HUECO2")
+        for context in [finder, early, anyone, elsewhere]:
+            claims.leave(context)
+
+
+class TestConstraints(unittest.TestCase):
+    def test_windows(self):
+        customer = new_customer(
+            min_date="04/06/2024",
+            min_time="09:00",
+            weekdays=[1, 3],
+        )
+        labels = [
+            "CITA 1 Día: 11/06/2024 Hora: 08:10",
+            "CITA 2 Día: 03/06/2024 Hora: 09:20",
+            "CITA 3 Día: 13/06/2024 Hora: 09:30",
+            "CITA 4 Día: 12/06/2024 Hora: 10:00",
+        ]
+        self.assertEqual(find_best_date(labels, customer), labels[2])
+
+        customer.windows = [{"min_date": "01/07/2024"}, {"max_date": "03/06/2024"}]
+        customer.__post_init__()
+        self.assertEqual(find_best_date(labels, customer), labels[1])
+
+
+class TestCaptcha(unittest.TestCase):
+    def test_presolver(self):
+        from bcncita.captcha import RecaptchaPresolver
+
+        solved = []
+
+        def solve():
+            solved.append(f"token-{len(solved)}")
+            return solved[-1]
+
+        presolver = RecaptchaPresolver(solve, size=2, workers=2, ttl=0.2, retry_delay=0.01)
+        presolver.start()
+        self.addCleanup(presolver.stop)
+
+        for _ in range(50):
+            if len(presolver.cache) == 2:
+                break
+            time.sleep(0.01)
+        self.assertIn(presolver.take(), ["token-0", "token-1"])
+
+        # Tokens past their TTL are dropped and solved again
+        time.sleep(0.3)
+        self.assertNotIn(presolver.take(), ["token-0", "token-1"])
+
+    def test_presolving(self):
+        from bcncita import captcha
+
+        original = captcha.anticaptcha_recaptcha
+        captcha.anticaptcha_recaptcha = lambda *key: lambda: "token"
+        self.addCleanup(setattr, captcha, "anticaptcha_recaptcha", original)
+        customer = new_customer(
+            anticaptcha_api_key="key",
+            presolve_captcha=1,
+            recaptcha_site_key="site",
+            recaptcha_action="action",
+        )
+
+        with captcha.presolving([customer]):
+            presolver = captcha.get_presolver("key", "site", "action")
+            with captcha.presolving([]):
+                pass
+            self.assertFalse(presolver._stopped.is_set())  # another run still needs it
+        self.assertTrue(presolver._stopped.is_set())
+        self.assertEqual(captcha._presolvers, {})
+
+    def test_image_captcha_ocr(self):
+        from bcncita.cita import solve_image_captcha
+
+        class Element:
+            def __init__(self, src=""):
+                self.src, self.typed = src, []
+
+            def get_attribute(self, name):
+                return self.src
+
+            def send_keys(self, text):
+                self.typed.append(text)
+
+        class Ocr:
+            def solve(self, image):
+                self.image = bytes(image)
+                return "x7k2p" if image[:4] == b"\x89PNG" else None
+
+        img, field = Element("data:image/png;base64,iVBORw0KGgo="), Element()
+        driver = type("Driver", (), {})()
+        driver.find_elements = lambda by, value: [img]
+        driver.find_element = lambda by, value: field
+        customer = new_customer(captcha_ocr=Ocr())
+
+        self.assertTrue(solve_image_captcha(driver, customer))
+        self.assertEqual(field.typed, ["x7k2p"])
+        self.assertEqual(customer.captcha_ocr.image, b"\x89PNG\r\n\x1a\n")
+        self.assertIsNone(customer.image_captcha_solver)  # Anti-Captcha wasn't needed
+
+
+class TestSpeaker(unittest.TestCase):
+    def test_notifier(self):
+        from bcncita.speaker import FileSink, Notifier
+
+        class SlowSink:
+            audible = True
+
+            def __init__(self):
+                self.said = []
+
+            def say(self, phrase):
+                time.sleep(0.1)
+                self.said.append(phrase)
+
+        path = os.path.join(tempfile.mkdtemp(), "alerts.log")
+        slow = SlowSink()
+        notifier = Notifier([slow, FileSink(path)], max_per_minute=3)
+
+        started = time.monotonic()
+        notifier.say("ALARM", repeat=3)
+        notifier.say("ALARM")  # duplicate
+        notifier.say("MAKE A CHOICE")
+        notifier.say("FAIL")
+        notifier.say("ONE TOO MANY")
+        self.assertLess(time.monotonic() - started, 0.05)
+
+        notifier.flush()
+        self.assertEqual(slow.said, ["ALARM"] * 3 + ["MAKE A CHOICE", "FAIL"])
+        with open(path) as f:
+            self.assertEqual(
+                [line.split(" ", 1)[1] for line in f], ["ALARM\n", "MAKE A CHOICE\n", "FAIL\n"]
             )
 
 
+class TestMetrics(unittest.TestCase):
+    def test_tracer(self):
+        from bcncita.metrics import Outcome, Tracer
+
+        tmp = tempfile.mkdtemp()
+        customer = new_customer(
+            trace_path=os.path.join(tmp, "trace.jsonl"),
+            metrics_path=os.path.join(tmp, "metrics.prom"),
+        )
+        tracer = Tracer()
+        for _ in range(2):
+            with tracer.attempt(customer):
+                with tracer.step("initial_page"):
+                    pass
+                tracer.outcome(Outcome.NO_CITAS)
+                tracer.outcome(Outcome.TIMEOUT)
+
+        with open(customer.trace_path) as f:
+            traces = [json.loads(line) for line in f]
+        self.assertEqual(len(traces), 2)
+        self.assertEqual(traces[0]["outcome"], "no_citas")
+        self.assertEqual(traces[0]["steps"][0]["step"], "initial_page")
+
+        with open(customer.metrics_path) as f:
+            metrics = f.read()
+        self.assertIn(
+            'bcncita_attempts_total{outcome="no_citas",province="BARCELONA",operation="TOMA_HUELLAS"} 2',
+            metrics,
+        )
+        self.assertIn('bcncita_step_seconds_count{step="initial_page"', metrics)
+
+
+class HangingDriver:
+    # Every command blocks until quit(), like a browser stuck on a slow page
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def quit(self):
+        self.closed.set()
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.closed.wait()
+            raise ConnectionError("browser closed")
+
+        return command
+
+
+class FakeDriver:
+    # A browser without pages: CDP answers come from a table (values, callables or exceptions
+    # to raise), scripts return `settled` (ms since the last resource) and every page is `text`
+    def __init__(self, cdp=None, text=""):
+        self.cdp = cdp or {}
+        self.text = text
+        self.settled = 1000
+        self.commands = []
+        self.visited = []
+        self.cookies_deleted = 0
+        self.closed = False
+
+    def execute_cdp_cmd(self, cmd, params):
+        self.commands.append((cmd, params))
+        result = self.cdp.get(cmd, {})
+        if isinstance(result, Exception):
+            raise result
+        return result() if callable(result) else result
+
+    def execute_script(self, script, *args):
+        return self.settled() if callable(self.settled) else self.settled
+
+    def get(self, url):
+        self.visited.append(url)
+
+    def set_page_load_timeout(self, seconds):
+        pass
+
+    def delete_all_cookies(self):
+        self.cookies_deleted += 1
+
+    def find_element(self, by, value):
+        return type("Element", (), {"text": self.text})()
+
+    def quit(self):
+        self.closed = True
+
+
+class TestAsync(unittest.TestCase):
+    def test_deadline(self):
+        from bcncita.aio import async_start_with
+
+        customer = new_customer()
+        driver = HangingDriver()
+        started = time.monotonic()
+        success = asyncio.run(async_start_with(driver, customer, cycles=3, deadline=0.2))
+        self.assertFalse(success)
+        self.assertTrue(driver.closed.is_set())
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_winner(self):
+        from bcncita import aio
+        from bcncita.sessions import BrowserPool
+
+        original = aio.run_attempt
+        aio.run_attempt = lambda driver, context, *urls: context.doc_value == "1"
+        self.addCleanup(setattr, aio, "run_attempt", original)
+
+        profiles = [new_customer(doc_value=str(i)) for i in range(2)]
+        pool = BrowserPool(FakeDriver, 2)
+        booked = asyncio.run(aio.async_run_profiles(profiles, cycles=2, pool=pool))
+        self.assertEqual(
+            [(context.doc_value, type(driver)) for context, driver in booked], [("1", FakeDriver)]
+        )
+        # The winner is out of the pool and still open, the loser's browser went back to it
+        pool.close()
+        self.assertFalse(booked[0][1].closed)
+
+
+class TestScheduler(unittest.TestCase):
+    def run_profiles(self, profiles, attempt, pool_size=1, **kwargs):
+        from bcncita import scheduler
+        from bcncita.sessions import BrowserPool
+
+        original = scheduler.run_attempt
+        scheduler.run_attempt = attempt
+        self.addCleanup(setattr, scheduler, "run_attempt", original)
+        return scheduler.run_profiles(profiles, pool=BrowserPool(FakeDriver, pool_size), **kwargs)
+
+    def test_round_robin(self):
+        profiles = [new_customer(doc_value=str(i)) for i in range(3)]
+        profiles.append(new_customer(province=Province.MADRID))
+        order = []
+
+        def attempt(driver, context, *urls):
+            order.append(context.province)
+
+        self.assertEqual(self.run_profiles(profiles, attempt, cycles=2), [])
+        # Madrid isn't starved by the three Barcelona profiles queued before it
+        self.assertEqual(order[:4], [Province.BARCELONA, Province.MADRID] * 2)
+        self.assertEqual(len(order), 8)
+
+    def test_max_per_province(self):
+        profiles = [new_customer(doc_value=str(i)) for i in range(3)]
+        profiles.append(new_customer(province=Province.MADRID))
+        lock = threading.Lock()
+        running, most = {}, {}
+
+        def attempt(driver, context, *urls):
+            with lock:
+                running[context.province] = running.get(context.province, 0) + 1
+                most[context.province] = max(
+                    most.get(context.province, 0), running[context.province]
+                )
+            time.sleep(0.02)
+            with lock:
+                running[context.province] -= 1
+
+        self.run_profiles(profiles, attempt, pool_size=3, max_per_province=1, cycles=2)
+        self.assertEqual(most, {Province.BARCELONA: 1, Province.MADRID: 1})
+
+    def test_win_and_errors(self):
+        winner, broken = new_customer(), new_customer(doc_value="X1234567Z")
+        attempts = []
+
+        def attempt(driver, context, *urls):
+            attempts.append(context)
+            if context is broken:
+                raise ConnectionError("chrome crashed")
+            return context is winner and len(attempts) > 2
+
+        with self.assertLogs(level=logging.ERROR):
+            booked = self.run_profiles([winner, broken], attempt, cycles=3)
+        # Broken attempts free their browser, the single pool slot is never lost
+        self.assertEqual(attempts.count(broken), 3)
+        ((context, driver),) = booked
+        self.assertIs(context, winner)
+        self.assertFalse(driver.closed)  # left on the confirmation for the caller
+
+    def test_queue_accounting(self):
+        from datetime import date
+
+        from bcncita import claims
+        from bcncita.constraints import Slot
+        from bcncita.scheduler import Job, ProvinceQueue
+
+        queue = ProvinceQueue(max_per_province=1)
+        first, second = Job(new_customer(), "", ""), Job(new_customer(doc_value="2"), "", "")
+        queue.put(first)
+        queue.put(second)
+        self.assertIs(queue.pop(), first)
+        self.assertIsNone(queue.pop())  # the province is at its cap
+
+        # A profile another session found a slot for goes past the cap
+        claims._hints[id(second.context)] = claims.Hint(
+            None, Slot(date.today(), None, "HUECO1"), time.monotonic()
+        )
+        self.addCleanup(claims.leave, second.context)
+        self.assertIs(queue.pop(), second)
+        queue.done(first)
+        queue.done(second)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue._running, {Province.BARCELONA: 0})
+
+
+class TestSessions(unittest.TestCase):
+    def test_recycling(self):
+        from bcncita.sessions import BrowserPool, process_tree_rss
+
+        customer = new_customer()
+        pool = BrowserPool(FakeDriver, 1, max_uses=2)
+        first = pool.acquire(customer)
+        pool.release(first)
+        self.assertIs(pool.acquire(customer), first)
+        pool.release(first)  # second use, recycled
+        self.assertTrue(first.closed)
+
+        # Chrome's memory is read on release, the first reading is the baseline
+        readings = [100, 250, 301]
+        pool = BrowserPool(FakeDriver, 1, max_memory_growth=3.0)
+        pool.memory = lambda driver: readings.pop(0)  # type: ignore
+        driver = pool.acquire(customer)
+        for _ in range(2):
+            pool.release(driver)
+            self.assertIs(pool.acquire(customer), driver)
+        pool.release(driver)
+        self.assertTrue(driver.closed)
+        self.assertGreater(process_tree_rss(os.getpid()), 0)
+
+    def test_health_check(self):
+        from bcncita.sessions import BrowserPool
+
+        dead = FakeDriver({"Browser.getVersion": ConnectionError("chrome is gone")})
+        drivers = [dead, FakeDriver()]
+        pool = BrowserPool(lambda: drivers.pop(0), 1)
+        driver = pool.acquire(new_customer())
+        self.assertTrue(dead.closed)
+        self.assertIsNot(driver, dead)
+
+    def test_cold_reset(self):
+        from bcncita.cita import COLD_RESET_AFTER, initial_page
+        from bcncita.sessions import is_poisoned
+
+        self.assertTrue(is_poisoned("The requested URL was rejected. Please consult..."))
+        self.assertFalse(is_poisoned("INTERNET CITA PREVIA"))
+        load = initial_page.__wrapped__  # without the backoff
+        urls = ("http://localhost/citar", "http://localhost/acInfo")
+        customer = new_customer()
+        customer.first_load = False
+
+        # Slow or empty loads keep the warm session, a few in a row wipe it
+        driver = FakeDriver(text="")
+        for i in range(COLD_RESET_AFTER):
+            with self.assertRaises(TimeoutException):
+                load(driver, customer, *urls)
+            self.assertEqual(customer.first_load, i == COLD_RESET_AFTER - 1)
+        self.assertEqual(customer.failed_loads, 0)
+
+        driver.text = "INTERNET CITA PREVIA"
+        load(driver, customer, *urls)
+        self.assertEqual((customer.first_load, driver.cookies_deleted), (False, 1))
+
+        # A rejected page wipes it straight away
+        driver.text = "Request Rejected"
+        with self.assertRaises(TimeoutException):
+            load(driver, customer, *urls)
+        self.assertTrue(customer.first_load)
+
+
+class ScriptedPage:
+    # Runs the page's scripts in node against a stand-in document and performance timeline,
+    # `now` and `resources` (responseEnd of each entry) in milliseconds
+    def __init__(self, ready_state="complete", jquery_active=None, resources=(), now=1000):
+        self.page = dict(
+            readyState=ready_state, jquery=jquery_active, resources=list(resources), now=now
+        )
+
+    def execute_script(self, script, *args):
+        import subprocess
+
+        code = (
+            f"const p = {json.dumps(self.page)};"
+            "const document = {readyState: p.readyState};"
+            "const window = p.jquery === null ? {} : {jQuery: {active: p.jquery}};"
+            "const performance = {now: () => p.now,"
+            " getEntriesByType: () => p.resources.map((end) => ({responseEnd: end}))};"
+            f"console.log(JSON.stringify((function () {{{script}}})()));"
+        )
+        out = subprocess.run(["node", "-e", code], capture_output=True, text=True, check=True)
+        return json.loads(out.stdout)
+
+
+class TestReadiness(unittest.TestCase):
+    @unittest.skipUnless(shutil.which("node"), "node is needed to run the page script")
+    def test_settled(self):
+        from bcncita.readiness import page_settled
+
+        settled = page_settled(0.3)
+        self.assertFalse(settled(ScriptedPage(ready_state="interactive")))
+        self.assertFalse(settled(ScriptedPage(jquery_active=2)))
+        self.assertTrue(settled(ScriptedPage(jquery_active=0)))
+        # Quiet for 200ms since the last resource, then for 500ms
+        self.assertFalse(settled(ScriptedPage(resources=[100, 800, 300])))
+        self.assertTrue(settled(ScriptedPage(resources=[100, 500, 300])))
+        self.assertTrue(settled(ScriptedPage()))
+
+    def test_timeout(self):
+        from bcncita import readiness
+        from bcncita.readiness import LoadTimes, wait_ready
+
+        def timeout(samples):
+            load_times = LoadTimes()
+            for seconds in samples:
+                load_times.record(seconds)
+            return load_times.timeout()
+
+        self.assertEqual(timeout([]), 60)  # nothing learnt yet
+        self.assertEqual(timeout(range(1, 11)), 30)  # p90 * 3
+        self.assertEqual(timeout([0.5] * 9 + [1.0]), 5)  # 3 is under the floor
+        self.assertEqual(timeout([25] * 10), 60)  # 75 is capped
+        self.assertEqual(timeout([100] + [1] * 50), 5)  # the window only keeps the last 50
+
+        # Without an explicit timeout the learnt one is used, and a settled page teaches it
+        original = readiness.load_times
+        readiness.load_times = LoadTimes(floor=0.2, ceiling=0.2)
+        self.addCleanup(setattr, readiness, "load_times", original)
+
+        driver = FakeDriver()
+        driver.settled = -1
+        started = time.monotonic()
+        self.assertFalse(wait_ready(driver))
+        self.assertLess(time.monotonic() - started, 2)
+
+        driver.settled = 1000
+        self.assertTrue(wait_ready(driver))
+        self.assertEqual(len(readiness.load_times._samples), 1)
+
+
+class TestLean(unittest.TestCase):
+    def test_handover(self):
+        from fnmatch import fnmatch
+
+        from selenium.common.exceptions import WebDriverException
+
+        from bcncita.browserless import Page, Submission, handover, handover_page, new_http_session
+        from bcncita.lean import enable_lean_mode
+
+        class BlockingDriver(FakeDriver):
+            # Fails navigations the way Chrome does for URLs blocked through CDP
+            def get(self, url):
+                blocked = [p["urls"] for c, p in self.commands if c == "Network.setBlockedURLs"]
+                if any(fnmatch(url, pattern) for pattern in sum(blocked, [])):
+                    raise WebDriverException("net::ERR_BLOCKED_BY_CLIENT")
+                super().get(url)
+
+        driver = BlockingDriver()
+        enable_lean_mode(driver)
+        url = "https://icp.administracionelectronica.gob.es/icpplustieb/acCitar"
+        handover(driver, new_http_session(), Submission(url, {"sede": "99"}))
+        self.assertEqual(len(driver.visited), 1)
+        handover_page(driver, new_http_session(), Page.parse(url, "<html><head></head></html>"))
+        self.assertEqual(len(driver.visited), 2)
+        self.assertTrue(all(v.startswith(url.split("/icpplustieb")[0]) for v in driver.visited))
+
+    def test_blocked_urls(self):
+        from fnmatch import fnmatch
+
+        from bcncita.lean import LEAN_BLOCKED_URLS, enable_lean_mode
+
+        driver = FakeDriver()
+        enable_lean_mode(driver)
+        self.assertEqual(
+            driver.commands,
+            [("Network.enable", {}), ("Network.setBlockedURLs", {"urls": LEAN_BLOCKED_URLS})],
+        )
+
+        def blocked(url):
+            return any(fnmatch(url, pattern) for pattern in LEAN_BLOCKED_URLS)
+
+        self.assertTrue(
+            blocked("https://icp.administracionelectronica.gob.es/icpplus/img/logo.png")
+        )
+        self.assertTrue(blocked("https://icp.administracionelectronica.gob.es/icpplus/css/x.css"))
+        self.assertTrue(blocked("https://www.googletagmanager.com/gtag/js?id=UA-1"))
+        self.assertFalse(blocked("https://icp.administracionelectronica.gob.es/icpplus/acEntrada"))
+        self.assertFalse(
+            blocked("https://icp.administracionelectronica.gob.es/icpplus/js/jquery.js")
+        )
+        self.assertFalse(blocked("https://www.google.com/recaptcha/api.js?render=6Lc"))
+        self.assertFalse(blocked("data:image/png;base64,iVBORw0KGgo"))
+
+    def test_savings(self):
+        from bcncita.lean import PageReport, savings
+
+        baseline = [
+            PageReport("https://icp/citar?p=8&x=1", 900, 300 * 1024, 40),
+            PageReport("https://icp/acInfo", 600, 100 * 1024, 20),
+            PageReport("https://icp/acEntrada", 500, 50 * 1024, 10),
+        ]
+        lean = [
+            PageReport("https://icp/citar?p=8&x=2", 400, 60 * 1024, 5),
+            PageReport("https://icp/acInfo", 650, 100 * 1024, 20),
+        ]
+        self.assertEqual(
+            savings(baseline, lean),
+            {
+                "https://icp/citar": {
+                    "bytes_saved": 240 * 1024,
+                    "ms_saved": 500,
+                    "requests_saved": 35,
+                },
+                "https://icp/acInfo": {"bytes_saved": 0, "ms_saved": -50, "requests_saved": 0},
+            },
+        )
+
+
 if __name__ == "__main__":
     if not os.environ.get("CITA_TEST"):
         os._exit(0)